@@ -4,13 +4,15 @@
 # SPDX-License-Identifier: Apache-2.0
 # Author: Vassilis Vassiliadis
 
+import collections
+import concurrent.futures
+import functools
 import logging
+import time
 import traceback
 import urllib.parse
 import datetime
 
-import stream_zip
-
 unquote = urllib.parse.unquote
 
 
@@ -29,12 +31,13 @@ rootLogger.addHandler(handler)
 import urllib.parse
 
 unquote = urllib.parse.unquote
-from flask import Flask, request, Blueprint, Response
+from flask import Flask, request, Blueprint, Response, send_file
 from flask_restx import Api, Resource, Namespace, reqparse, fields
 from flask_cors import CORS
+from werkzeug.exceptions import TooManyRequests
 from werkzeug.middleware.proxy_fix import ProxyFix
 from experiment.model.data import Experiment
-from experiment.model.storage import ExperimentInstanceDirectory
+from experiment.model.storage import ExperimentInstanceDirectory, IsExperimentTopLevel, IsExperimentInstanceDirectory
 
 import os
 import sys
@@ -42,8 +45,15 @@ from st4sd_datastore.middlelayer import PrefixMiddleware
 import flask_restx.apidoc
 
 from st4sd_datastore.experiment_registry import ExperimentRegistry
+from st4sd_datastore.file_manifest import FileInfo, ManifestCache, file_matches
+from st4sd_datastore.directory_walker import DirectoryWalker, SYMLINK_MODES, SYMLINKS_FILES, SYMLINKS_FOLLOW
+from st4sd_datastore.archive_cache import ArchiveCache
+from st4sd_datastore import archive_formats
+from st4sd_datastore.download_scheduler import DownloadScheduler, throttle
+from st4sd_datastore.checksums import ChecksumCache
+from st4sd_datastore.file_selection import FileSelector, InvalidSelection, SelectionReport, parse_selection
 
-from typing import Dict, List
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
 
 FLASK_URL_PREFIX = os.environ.get("FLASK_URL_PREFIX", "")
 
@@ -81,7 +91,10 @@ class HelloAPI(Resource):
         return "hello"
 
 os.umask(0o002)
-registry_exps = ExperimentRegistry()
+# VV: Set DS_REGISTRY_LEGACY_JSON to yes to also store the registry in the JSON list of older versions (e.g. while
+# a roll back may be necessary), otherwise a registration just rewrites the snapshot
+DS_REGISTRY_LEGACY_JSON = os.environ.get('DS_REGISTRY_LEGACY_JSON', 'no').lower() in ['yes', 'true', '1']
+registry_exps = ExperimentRegistry(legacy_json=DS_REGISTRY_LEGACY_JSON)
 
 DS_FILE_MAX_SIZE = os.environ.get('DS_FILE_MAX_SIZE')
 DS_MAX_FILES_PER_EXPERIMENT = os.environ.get('DS_MAX_FILES_PER_EXPERIMENT')
@@ -144,9 +157,206 @@ else:
     rootLogger.warning("Setting unlimited total maximum files")
 
 
+def int_from_env(name, default):
+    # type: (str, int) -> int
+    """Reads an integer from the environment variable @name, returns @default if it is unset or invalid"""
+    value = os.environ.get(name)
+
+    if value is None:
+        rootLogger.warning("%s environment variable not set, will default to %s" % (name, default))
+        return default
+
+    try:
+        value = int(value)
+    except Exception:
+        rootLogger.warning("Could not convert %s=\"%s\" to an integer, will default to %s" % (name, value, default))
+        return default
+
+    rootLogger.warning("%s is set to %s" % (name, value))
+    return value
+
+
+# VV: Number of threads which stat() and read() files ahead of the one that is currently being zipped,
+# set to 0 to disable prefetching
+DS_PREFETCH_WORKERS = int_from_env('DS_PREFETCH_WORKERS', 4)
+# VV: Maximum number of files that can be prefetched ahead of the one that is currently being zipped
+DS_PREFETCH_WINDOW = int_from_env('DS_PREFETCH_WINDOW', 32)
+# VV: Files up to this many bytes are read into memory by the prefetch threads, larger files are just stat()ed and
+# then streamed from the disk when their turn comes. Memory per stream is bounded by WINDOW * MAX_BYTES
+DS_PREFETCH_MAX_BYTES = int_from_env('DS_PREFETCH_MAX_BYTES', 256 * 1024)
+# VV: Upper bound (in seconds) for how long a tail request may block waiting for new bytes
+DS_TAIL_MAX_WAIT = int_from_env('DS_TAIL_MAX_WAIT', 30)
+# VV: The file manifests of instances are checked for changes at most once every DS_MANIFEST_TTL seconds,
+# and rebuilt from scratch every DS_MANIFEST_MAX_AGE seconds (to pick up files whose size changed in place)
+DS_MANIFEST_TTL = int_from_env('DS_MANIFEST_TTL', 5)
+DS_MANIFEST_MAX_AGE = int_from_env('DS_MANIFEST_MAX_AGE', 300)
+DS_MANIFEST_MAX_INSTANCES = int_from_env('DS_MANIFEST_MAX_INSTANCES', 256)
+
+# VV: Threads which scan sub-directories and stat() files in parallel when walking directories (0 to disable).
+# DS_WALK_SYMLINKS controls whether archives of directories follow symbolic links (follow, files, or skip, see
+# st4sd_datastore.directory_walker), file manifests never walk into symbolic links to directories
+DS_WALK_WORKERS = int_from_env('DS_WALK_WORKERS', 4)
+DS_WALK_SYMLINKS = os.environ.get('DS_WALK_SYMLINKS', SYMLINKS_FOLLOW)
+
+if DS_WALK_SYMLINKS not in SYMLINK_MODES:
+    rootLogger.warning("DS_WALK_SYMLINKS=\"%s\" is not one of %s, will default to %s" % (
+        DS_WALK_SYMLINKS, SYMLINK_MODES, SYMLINKS_FOLLOW))
+    DS_WALK_SYMLINKS = SYMLINKS_FOLLOW
+
+walk_pool = None
+if DS_WALK_WORKERS > 0:
+    walk_pool = concurrent.futures.ThreadPoolExecutor(max_workers=DS_WALK_WORKERS, thread_name_prefix='walk')
+
+directory_walker = DirectoryWalker(symlinks=DS_WALK_SYMLINKS, pool=walk_pool)
+
+manifest_walker = DirectoryWalker(symlinks=SYMLINKS_FILES, pool=walk_pool)
+
+manifests = ManifestCache(
+    max_instances=DS_MANIFEST_MAX_INSTANCES, ttl=DS_MANIFEST_TTL, max_age=DS_MANIFEST_MAX_AGE, walker=manifest_walker)
+
+# VV: Archives of component directories are cached under DS_ARCHIVE_CACHE_DIR, caching is disabled unless it is set.
+# Use a directory on a local disk which no other process writes to (e.g. /tmp/workdir/pod-reporter/archive_cache)
+DS_ARCHIVE_CACHE_DIR = os.environ.get('DS_ARCHIVE_CACHE_DIR', '')
+DS_ARCHIVE_CACHE_QUOTA = int_from_env('DS_ARCHIVE_CACHE_QUOTA', 10 * 1024 * 1024 * 1024)
+# VV: Only cache directories whose newest file is at least this many seconds old (i.e. finished components)
+DS_ARCHIVE_CACHE_MIN_AGE = int_from_env('DS_ARCHIVE_CACHE_MIN_AGE', 60)
+
+# VV: Bulk downloads (archives and raw files) may use at most DS_MAX_BULK_DOWNLOADS threads so that
+# DS_RESERVED_SMALL_THREADS threads are always available for small requests. Each client may run at most
+# DS_MAX_BULK_DOWNLOADS_PER_CLIENT bulk downloads at the same time. Excess requests get "429 Too Many Requests"
+WORKER_THREADS = int_from_env('WORKER_THREADS', 2)
+DS_RESERVED_SMALL_THREADS = int_from_env('DS_RESERVED_SMALL_THREADS', 1)
+DS_MAX_BULK_DOWNLOADS = int_from_env('DS_MAX_BULK_DOWNLOADS', max(1, WORKER_THREADS - DS_RESERVED_SMALL_THREADS))
+DS_MAX_BULK_DOWNLOADS_PER_CLIENT = int_from_env('DS_MAX_BULK_DOWNLOADS_PER_CLIENT', 2)
+DS_BULK_RETRY_AFTER = int_from_env('DS_BULK_RETRY_AFTER', 10)
+# VV: Maximum bytes per second for each bulk download stream, 0 means unlimited
+DS_STREAM_MAX_BYTES_PER_SEC = int_from_env('DS_STREAM_MAX_BYTES_PER_SEC', 0)
+
+download_scheduler = DownloadScheduler(DS_MAX_BULK_DOWNLOADS, DS_MAX_BULK_DOWNLOADS_PER_CLIENT)
+
+# VV: Checksums of files are computed by DS_CHECKSUM_WORKERS threads and cached until the size/mtime of the file changes
+DS_CHECKSUM_WORKERS = int_from_env('DS_CHECKSUM_WORKERS', 4)
+DS_CHECKSUM_CACHE_ENTRIES = int_from_env('DS_CHECKSUM_CACHE_ENTRIES', 100000)
+
+checksum_cache = ChecksumCache(max_entries=DS_CHECKSUM_CACHE_ENTRIES, workers=DS_CHECKSUM_WORKERS)
+
+# VV: Threads which stat() the files of multi-file downloads whose size is not in the file manifest (e.g. NFS/GPFS)
+DS_SELECT_STAT_WORKERS = int_from_env('DS_SELECT_STAT_WORKERS', 8)
+
+file_selector = FileSelector(
+    max_bytes=DS_FILE_MAX_SIZE, max_file_size=DS_FILE_MAX_SIZE, max_files_per_group=DS_MAX_FILES_PER_EXPERIMENT,
+    max_files_total=DS_MAX_FILES_TOTAL, workers=DS_SELECT_STAT_WORKERS)
+
+# VV: Checksum requests hash files only while they fit in the same limits as downloads. Unlike archives, where
+# a file counts as at most DS_FILE_MAX_SIZE bytes, every byte that is hashed counts towards the limit
+checksum_selector = FileSelector(
+    max_bytes=DS_FILE_MAX_SIZE, max_files_per_group=DS_MAX_FILES_PER_EXPERIMENT, max_files_total=DS_MAX_FILES_TOTAL,
+    workers=DS_SELECT_STAT_WORKERS)
+
+# VV: Threads which check the layout (or fully validate) instances during batch registrations
+DS_REGISTER_WORKERS = int_from_env('DS_REGISTER_WORKERS', 4)
+# VV: Threads which run deferred (full) validations in the background, separate from DS_REGISTER_WORKERS so that
+# registrations never queue behind the full validations of earlier batches
+DS_VALIDATION_WORKERS = int_from_env('DS_VALIDATION_WORKERS', 2)
+
+register_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=max(1, DS_REGISTER_WORKERS), thread_name_prefix='register')
+validation_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=max(1, DS_VALIDATION_WORKERS), thread_name_prefix='validate')
+
+if DS_ARCHIVE_CACHE_DIR:
+    rootLogger.warning("Caching archives under %s with a quota of %d bytes" % (
+        os.path.abspath(DS_ARCHIVE_CACHE_DIR), DS_ARCHIVE_CACHE_QUOTA))
+    archive_cache = ArchiveCache(DS_ARCHIVE_CACHE_DIR, DS_ARCHIVE_CACHE_QUOTA, DS_ARCHIVE_CACHE_MIN_AGE)
+else:
+    rootLogger.warning("DS_ARCHIVE_CACHE_DIR is not set, will not cache archives")
+    archive_cache = None
+
+
+def client_id():
+    # type: () -> str
+    """Returns the address of the peer that made the current request
+
+    X-Forwarded-For is not honoured, clients could otherwise pick any identity to evade the per-client limits.
+    """
+    return request.remote_addr or 'unknown'
+
+
+def release_on_close(response, release):
+    # type: (Response, Callable[[], Any]) -> None
+    """Arranges for @release to be invoked exactly once, when the WSGI server closes @response"""
+    pending = [release]
+
+    def release_once():
+        # VV: list.pop() is atomic, only the first caller gets to invoke release()
+        try:
+            pending.pop()()
+        except IndexError:
+            pass
+
+    # VV: werkzeug closes the response after sending it, this includes body-less responses (HEAD, 304)
+    response.call_on_close(release_once)
+
+    if response.direct_passthrough:
+        # VV: ... except for direct_passthrough responses with a body (e.g. the ones that send_file() generates),
+        # werkzeug hands their iterable to the WSGI server as is. Hook the close() of the iterable too, wrapping
+        # the iterable would prevent the WSGI server from using sendfile()
+        iterable = response.response
+        original_close = getattr(iterable, 'close', None)
+
+        def close():
+            try:
+                if original_close is not None:
+                    original_close()
+            finally:
+                release_once()
+
+        try:
+            iterable.close = close
+        except AttributeError:
+            response.direct_passthrough = False
+
+
+def bulk_download(func):
+    """Decorates Resource methods which stream large responses so that they go through the download_scheduler
+
+    The slot of the client is released when the WSGI server closes the response (i.e. after the last byte is sent
+    or the client disconnects). If DS_STREAM_MAX_BYTES_PER_SEC is positive the response is also throttled.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        client = client_id()
+        if download_scheduler.acquire(client) is False:
+            raise TooManyRequests("Too many concurrent downloads, try again later", retry_after=DS_BULK_RETRY_AFTER)
+
+        try:
+            response = func(*args, **kwargs)
+        except BaseException:
+            download_scheduler.release(client)
+            raise
+
+        if not isinstance(response, Response):
+            download_scheduler.release(client)
+            return response
+
+        if DS_STREAM_MAX_BYTES_PER_SEC > 0:
+            # VV: Throttled bytes go through python anyway, so the WSGI server cannot use sendfile()
+            response.response = throttle(response.response, DS_STREAM_MAX_BYTES_PER_SEC)
+            response.direct_passthrough = False
+
+        release_on_close(response, functools.partial(download_scheduler.release, client))
+
+        return response
+
+    return wrapper
+
+
 class IterableStreamZipOfDirectory:
-    def __init__(self, root):
+    """Streams the files under a directory as an archive (zip by default, see archive_formats.supported_formats())"""
+    def __init__(self, root, archive_format=archive_formats.FORMAT_ZIP, level=None):
         self.location = root
+        self.archive_format = archive_format
+        self.level = level
 
     @classmethod
     def iter_file(cls, full_path):
@@ -157,46 +367,237 @@ class IterableStreamZipOfDirectory:
 
         return iter_read(full_path)
 
-    def __iter__(self):
+    def iter_members(self):
+        # type: () -> Iterator[archive_formats.Member]
+        for full, rel_path, stat in directory_walker.walk(self.location):
+            mod_time = datetime.datetime.fromtimestamp(stat.st_mtime)
+            yield '/' + rel_path, mod_time, stat.st_mode, stat.st_size, self.iter_file(full)
 
-        def yield_recursively(location: str):
-            folders = [(location, '/')]
-            while folders:
-                abs_folder, in_zip_root = folders.pop(0)
-                for f in os.listdir(abs_folder):
-                    if f in ['.', '..']:
-                        continue
-
-                    full = os.path.join(abs_folder, f)
-                    rel_path = os.path.join(in_zip_root, f)
-                    if os.path.isdir(full):
-                        folders.append((full, rel_path))
-                    else:
-                        stat = os.stat(full)
-                        mod_time = datetime.datetime.fromtimestamp(stat.st_mtime)
-                        file_mode = stat.st_mode
-                        yield rel_path, mod_time, file_mode, stream_zip.ZIP_64, self.iter_file(full)
-
-        for zipped_chunk in stream_zip.stream_zip(yield_recursively(self.location)):
-            yield zipped_chunk
+    def __iter__(self):
+        for chunk in archive_formats.stream_archive(self.iter_members(), self.archive_format, self.level):
+            yield chunk
 
 
 class IterableStreamZipOfFiles(IterableStreamZipOfDirectory):
-    def __init__(self, files):
+    """Streams an archive of @files, prefetches the next files on a private pool of @prefetch_workers threads
+    (0 disables prefetching) or, if @prefetch_pool is not None, on that shared pool"""
+    def __init__(self, files, prefetch_workers=None, prefetch_window=None, prefetch_max_bytes=None,
+                 archive_format=archive_formats.FORMAT_ZIP, level=None, prefetch_pool=None):
         self.files = list(files)
+        self.prefetch_pool = prefetch_pool  # type: Optional[concurrent.futures.ThreadPoolExecutor]
+        self.archive_format = archive_format
+        self.level = level
+        self.prefetch_workers = prefetch_workers if prefetch_workers is not None else DS_PREFETCH_WORKERS
+        self.prefetch_window = max(1, prefetch_window if prefetch_window is not None else DS_PREFETCH_WINDOW)
+        self.prefetch_max_bytes = prefetch_max_bytes if prefetch_max_bytes is not None else DS_PREFETCH_MAX_BYTES
 
-    def __iter__(self):
-        def generator(files: List[str]):
-            while files:
-                rel_path = files.pop(0)
+    @classmethod
+    def prefetch_file(cls, full_path, max_bytes):
+        # type: (str, int) -> Tuple[os.stat_result, Optional[bytes]]
+        """Stats @full_path and returns (stat, contents), contents is None if the file is larger than @max_bytes"""
+        stat = os.stat(full_path)
+        contents = None
+
+        if stat.st_size <= max_bytes:
+            with open(full_path, 'rb') as f:
+                contents = f.read()
+
+        return stat, contents
+
+    def iter_prefetched(self, files):
+        # type: (List[str]) -> Iterator[Tuple[str, str, os.stat_result, Optional[bytes]]]
+        """Yields (rel_path, full_path, stat, contents) for @files in order while a bounded thread pool
+        stats and reads the next files in the background"""
+        if self.prefetch_pool is None and self.prefetch_workers <= 0:
+            for rel_path in files:
+                full = os.path.abspath(rel_path)
+                yield (rel_path, full) + self.prefetch_file(full, -1)
+            return
+
+        pool = self.prefetch_pool
+        if pool is None:
+            pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.prefetch_workers, thread_name_prefix='prefetch')
+        pending = collections.deque()
+        remaining = iter(files)
+
+        def submit_next():
+            for rel_path in remaining:
                 full = os.path.abspath(rel_path)
-                stat = os.stat(full)
-                mod_time = datetime.datetime.fromtimestamp(stat.st_mtime)
-                file_mode = stat.st_mode
-                yield rel_path, mod_time, file_mode, stream_zip.ZIP_64, self.iter_file(full)
+                pending.append((rel_path, full, pool.submit(self.prefetch_file, full, self.prefetch_max_bytes)))
+                return
+
+        try:
+            for _ in range(self.prefetch_window):
+                submit_next()
+
+            while pending:
+                rel_path, full, future = pending.popleft()
+                submit_next()
+                stat, contents = future.result()
+                yield rel_path, full, stat, contents
+        finally:
+            # VV: The client may disconnect mid-stream, do not waste time reading files nobody will receive
+            for _, _, future in pending:
+                future.cancel()
+            if pool is not self.prefetch_pool:
+                pool.shutdown(wait=False)
+
+    def iter_members(self):
+        # type: () -> Iterator[archive_formats.Member]
+        for rel_path, full, stat, contents in self.iter_prefetched(self.files):
+            mod_time = datetime.datetime.fromtimestamp(stat.st_mtime)
+            file_mode = stat.st_mode
+            if contents is not None:
+                file_chunks = (contents,)
+            else:
+                file_chunks = self.iter_file(full)
+            yield rel_path, mod_time, file_mode, stat.st_size, file_chunks
+
+
+def parse_archive_format(namespace):
+    # type: (Namespace) -> Tuple[str, Optional[int]]
+    """Returns the (archive_format, level) that the request asks for via the "format" and "level" query args"""
+    try:
+        return archive_formats.parse_format(request.args.get('format'), request.args.get('level'))
+    except ValueError as e:
+        namespace.abort(400, str(e))
+
+
+def archive_response(stream, archive_format):
+    # type: (Iterable[bytes], str) -> Response
+    response = Response(stream, mimetype=archive_formats.MIMETYPES[archive_format])
+    response.headers['Content-Disposition'] = 'attachment; filename={}'.format('files.%s' % archive_format)
+    return response
+
+
+archive_format_params = {
+    'format': 'Archive format, one of zip (default), tar, tar.zst (if the zstandard package is installed)',
+    'level': 'Compression level for tar.zst (default %d)' % archive_formats.DEFAULT_ZSTD_LEVEL,
+}
+
+
+# VV: How to validate an instance before registering it:
+#   full: load the instance (parse FlowIR, build the graph) before registering it
+#   layout: just check that the directory looks like an instance (conf/ with a FlowIR/experiment.conf, and stages/)
+#   deferred: check the layout, register, then load the instance in the background and unregister it if that fails
+VALIDATE_FULL = 'full'
+VALIDATE_LAYOUT = 'layout'
+VALIDATE_DEFERRED = 'deferred'
+VALIDATION_MODES = [VALIDATE_FULL, VALIDATE_LAYOUT, VALIDATE_DEFERRED]
+
+
+def check_instance_layout(path):
+    # type: (str) -> None
+    """Raises ValueError if @path does not look like an experiment instance directory (does not parse any files)"""
+    if os.path.isdir(path) is False:
+        raise ValueError("Instance directory \"%s\" does not exist" % path)
+
+    if IsExperimentTopLevel(path) is False or IsExperimentInstanceDirectory(path) is False:
+        raise ValueError("\"%s\" is not an experiment instance directory (missing conf/ or stages/)" % path)
+
 
-        for zipped_chunk in stream_zip.stream_zip(generator(self.files)):
-            yield zipped_chunk
+def load_instance(path):
+    # type: (str) -> Experiment
+    """Fully validates the instance at @path by loading it"""
+    expDir = ExperimentInstanceDirectory(path, attempt_shadowdir_repair=False)
+    return Experiment(expDir, updateInstanceConfiguration=False, is_instance=True)
+
+
+def validate_in_background(path, location):
+    # type: (str, str) -> None
+    """Loads the instance at @path, which the caller has just registered, and unregisters it if it is invalid"""
+    try:
+        exp = load_instance(path)
+    except Exception:
+        rootLogger.critical("Deferred validation of %s failed, will unregister it.\nEXCEPTION:%s" % (
+            location, traceback.format_exc()))
+        registry_exps.delete(path)
+        manifests.invalidate(path)
+    else:
+        rootLogger.info("Validated %s from %s" % (exp.name, location))
+
+
+def register_instance(location, validation=VALIDATE_FULL):
+    # type: (str, str) -> Dict[str, Any]
+    """Validates the experiment instance at the file:// URI @location and, if that works, adds it to the registry
+
+    Arguments:
+        location: The file:// URI of the instance
+        validation: One of VALIDATION_MODES
+
+    Returns:
+        A dictionary {"result": bool, "error": Optional[str]}
+    """
+    return register_instances([location], validation)[location]
+
+
+def register_instances(locations, validation=VALIDATE_DEFERRED):
+    # type: (List[str], str) -> Dict[str, Dict[str, Any]]
+    """Validates multiple experiment instances and registers the valid ones, storing the registry just once
+
+    Layout checks (and full validations when @validation is VALIDATE_FULL) run on the register_pool. Deferred
+    validations are queued on the validation_pool and this method returns without waiting for them. Only the
+    instances that this call registers are validated in the background, an instance which was already registered
+    is never unregistered because of a deferred validation.
+
+    Arguments:
+        locations: The file:// URIs of the instances
+        validation: One of VALIDATION_MODES
+
+    Returns:
+        A dictionary {location: {"result": bool, "error": Optional[str]}}
+    """
+    if validation not in VALIDATION_MODES:
+        raise ValueError("Unknown validation mode \"%s\", expected one of %s" % (validation, VALIDATION_MODES))
+
+    rootLogger.info("Will try to load %d new instances with %s validation" % (len(locations), validation))
+
+    def validate(location):
+        # type: (str) -> Tuple[Optional[str], Optional[str]]
+        try:
+            _, path = Experiment.split_instance_location(location)
+            check_instance_layout(path)
+
+            if validation == VALIDATE_FULL:
+                exp = load_instance(path)
+                rootLogger.info("Loaded %s from %s" % (exp.name, location))
+        except Exception:
+            rootLogger.critical("Failed to process %s.\nEXCEPTION:%s" % (location, traceback.format_exc()))
+            return None, traceback.format_exc()
+
+        return path, None
+
+    if len(locations) == 1:
+        validated = [validate(locations[0])]
+    else:
+        validated = list(register_pool.map(validate, locations))
+
+    ret = {}
+    valid = {}
+
+    for location, (path, error) in zip(locations, validated):
+        if path is None:
+            ret[location] = {'result': False, 'error': error}
+        else:
+            valid[location] = path
+
+    try:
+        added = set(registry_exps.register_many(valid.values()))
+    except Exception:
+        rootLogger.critical("Failed to register %d instances.\nEXCEPTION:%s" % (len(valid), traceback.format_exc()))
+        for location in valid:
+            ret[location] = {'result': False, 'error': traceback.format_exc()}
+        return ret
+
+    for location, path in valid.items():
+        manifests.invalidate(path)
+        ret[location] = {'result': True, 'error': None}
+
+        if validation == VALIDATE_DEFERRED and os.path.abspath(path) in added:
+            validation_pool.submit(validate_in_background, path, location)
+
+    return ret
 
 
 @api_experiment.route('/api/v1.0/location/<path:location>')
@@ -219,30 +620,19 @@ class DBExperimentAPI(Resource):
 
         return registry_exps.has_experiment(location)
 
+    @api_experiment.doc(params={'validation': 'One of %s (default %s)' % (VALIDATION_MODES, VALIDATE_FULL)})
     def post(self, location):
         location = unquote(location)
 
         if location.startswith('file://') is False:
             raise ValueError("Expected a file:// URI received \"%s\"" % location)
 
-        rootLogger.info("Will try to load new %s" % location)
-
-        try:
-            gateway, path = Experiment.split_instance_location(location)
-            expDir = ExperimentInstanceDirectory(path, attempt_shadowdir_repair=False)
-            exp = Experiment(expDir, updateInstanceConfiguration=False, is_instance=True)
+        validation = request.args.get('validation', VALIDATE_FULL)
+        if validation not in VALIDATION_MODES:
+            api_experiment.abort(400, "Unknown validation mode \"%s\", expected one of %s" % (
+                validation, VALIDATION_MODES))
 
-            rootLogger.info("Loaded:", exp.name, "from", location)
-
-            registry_exps.register(path)
-        except Exception:
-            rootLogger.critical("Failed to process %s.\nEXCEPTION:%s" %(
-                location, traceback.format_exc()
-            ))
-
-            return {'error': traceback.format_exc(), 'result': False}
-
-        return {'result': True, 'error': None}
+        return register_instance(location, validation)
 
     # VV: Uncomment to enable deleting entire experiments from the Registry
     # def delete(self, location):
@@ -254,7 +644,46 @@ class DBExperimentAPI(Resource):
     #     return 200
 
 
-def read_single_file(location, experiment=None):
+mExperimentLocations = api_experiment.model('register-many-experiments', {
+        "locations": fields.List(fields.String("file:// URI of experiment instance")),
+        "validation": fields.String(enum=VALIDATION_MODES, default=VALIDATE_DEFERRED),
+    },
+    example={
+        'locations': [
+            'file://tmp/workdir/<experiment_instance_dir.instance>',
+            'file://tmp/workdir/<other_experiment_instance_dir.instance>',
+        ],
+        'validation': VALIDATE_DEFERRED,
+    },
+)
+
+
+@api_experiment.route('/api/v1.0/locations')
+class DBExperimentManyAPI(Resource):
+    """Registers many instances with a single request (e.g. when importing historical instances)"""
+    @api_experiment.expect(mExperimentLocations)
+    def post(self):
+        data = request.get_json(force=True)
+        locations = data.get('locations') if isinstance(data, dict) else None
+        validation = data.get('validation', VALIDATE_DEFERRED) if isinstance(data, dict) else None
+
+        if not isinstance(locations, list) or any(not isinstance(x, str) for x in locations):
+            api_experiment.abort(400, "Expected {\"locations\": [file:// URIs]}")
+
+        invalid = [x for x in locations if x.startswith('file://') is False]
+        if invalid:
+            api_experiment.abort(400, "Expected file:// URIs received %s" % invalid)
+
+        if validation not in VALIDATION_MODES:
+            api_experiment.abort(400, "Unknown validation mode \"%s\", expected one of %s" % (
+                validation, VALIDATION_MODES))
+
+        return register_instances(locations, validation)
+
+
+def resolve_single_file(location, experiment=None):
+    # type: (str, Optional[str]) -> str
+    """Returns the absolute path to @location after checking that it belongs to the registered @experiment"""
     if location[0] != '/':
         location = '/' + location
 
@@ -262,11 +691,18 @@ def read_single_file(location, experiment=None):
         experiment = unquote(experiment)
         _, instance = Experiment.split_instance_location(experiment)
 
-        if registry_exps.contains(instance, location) is False:
+        # VV: contains() returns None (not False) when the instance is not registered
+        if not registry_exps.contains(instance, location):
             raise ValueError("Instance \"%s\" does not contain \"%s\"" % (
                 instance, location
             ))
 
+    return location
+
+
+def read_single_file(location, experiment=None):
+    location = resolve_single_file(location, experiment)
+
     if DS_FILE_MAX_SIZE == -1:
         with open(location, 'r') as f:
             return f.read()
@@ -276,7 +712,7 @@ def read_single_file(location, experiment=None):
             rootLogger.warning("File %s will be truncated to %d because its size is %d" % (
                 location, DS_FILE_MAX_SIZE, stat.st_size))
             with open(location, 'rt') as f:
-                buf = f.read(n=DS_FILE_MAX_SIZE)
+                buf = f.read(DS_FILE_MAX_SIZE)
             buf = '\n'.join(
                 (buf, 'FILE TRUNCATED to %d bytes, actual file size is %d' % (DS_FILE_MAX_SIZE, stat.st_size)))
             return buf
@@ -304,76 +740,267 @@ class DBFileAPI(Resource):
         contents = read_single_file(location, experiment)
         return contents, 200
 
+
+@api_file.route('/api/v1.1/<path:experiment>/location/<path:location>',)
+class DBFileRawAPI(Resource):
+    """Streams the raw bytes of a file without truncating it.
+
+    Supports Range/If-Range requests so that clients can resume downloads or fetch just a window of bytes.
+    """
+    @bulk_download
+    def get(self, location, experiment):
+        location = resolve_single_file(unquote(location), experiment)
+
+        if os.path.isfile(location) is False:
+            api_file.abort(404, "File \"%s\" does not exist" % location)
+
+        return send_file(location, mimetype='application/octet-stream', as_attachment=True,
+                         download_name=os.path.basename(location), conditional=True, etag=True)
+
+
+def utf8_char_length(lead):
+    # type: (int) -> int
+    """Returns the length of the UTF-8 character that starts with the byte @lead (1 for invalid lead bytes)"""
+    if lead >= 0xF0:
+        return 4
+    if lead >= 0xE0:
+        return 3
+    if lead >= 0xC0:
+        return 2
+    return 1
+
+
+def read_tail(location, offset, max_bytes=None):
+    # type: (str, int, Optional[int]) -> Dict[str, Union[str, int, bool]]
+    """Reads up to @max_bytes of @location starting at byte @offset
+
+    If the file shrank below @offset (e.g. it got truncated or replaced) reading restarts from the beginning
+    and the "reset" field of the returned dictionary is True. A multi-byte UTF-8 character that is cut by
+    @max_bytes is left for the next read so that "data" is always valid text. If there are new bytes the method
+    returns at least one character, even if it is longer than @max_bytes, so that clients always make progress.
+
+    Returns:
+        A dictionary {"data": str, "offset": int, "size": int, "reset": bool} where offset is the offset that the
+        client should ask for next time
+    """
+    reset = False
+
+    with open(location, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset > size:
+            offset = 0
+            reset = True
+
+        to_read = size - offset
+        if max_bytes is not None and max_bytes >= 0:
+            to_read = min(to_read, max_bytes)
+
+        f.seek(offset)
+        buf = f.read(to_read)
+
+        if offset < size:
+            if not buf:
+                buf = f.read(1)
+            missing = utf8_char_length(buf[0]) - len(buf)
+            if missing > 0:
+                buf += f.read(missing)
+
+    # VV: Do not split a multi-byte character - it'll be returned in its entirety by the next read
+    for cut in range(min(3, len(buf)) + 1):
+        try:
+            data = buf[:len(buf) - cut].decode('utf-8')
+        except UnicodeDecodeError:
+            continue
+        buf = buf[:len(buf) - cut]
+        break
+    else:
+        data = buf.decode('utf-8', errors='replace')
+
+    return {'data': data, 'offset': offset + len(buf), 'size': size, 'reset': reset}
+
+
+def parse_tail_args(args):
+    # type: (Mapping[str, str]) -> Tuple[int, float, int]
+    """Returns the (offset, wait, max_bytes) query arguments of a tail request, raises ValueError for invalid values"""
+    try:
+        offset = max(0, int(args.get('offset', 0)))
+        wait = min(max(0., float(args.get('wait', 0))), DS_TAIL_MAX_WAIT)
+        max_bytes = int(args.get('max_bytes', DS_FILE_MAX_SIZE))
+    except ValueError:
+        raise ValueError("Expected integer offset and max_bytes and a numeric wait, received offset=%s, wait=%s, "
+                         "max_bytes=%s" % (args.get('offset'), args.get('wait'), args.get('max_bytes')))
+
+    return offset, wait, max_bytes
+
+
+def tail_poll_delays(location, offset, wait):
+    # type: (str, int, float) -> Iterator[float]
+    """Long-polls @location: yields how many seconds to sleep before checking again whether the file grew past
+    @offset (or shrank, in which case read_tail() restarts from 0), stops when it did or after @wait seconds"""
+    wait_till = time.time() + wait
+    while os.path.getsize(location) == offset and time.time() < wait_till:
+        yield min(0.25, max(0., wait_till - time.time()))
+
+
+@api_file.route('/api/v1.0/tail/<path:experiment>/location/<path:location>',)
+class DBFileTailAPI(Resource):
+    """Returns the bytes of a file that come after a byte offset (for following logs of running experiments)"""
+    @api_file.doc(params={
+        'offset': 'Byte offset to start reading from, use the "offset" field of the previous response (default 0)',
+        'wait': 'Seconds to wait for new bytes if there are none past offset (default 0, capped by '
+                'DS_TAIL_MAX_WAIT)',
+        'max_bytes': 'Maximum number of bytes to return (default DS_FILE_MAX_SIZE)',
+    })
+    def get(self, location, experiment):
+        location = resolve_single_file(unquote(location), experiment)
+
+        try:
+            offset, wait, max_bytes = parse_tail_args(request.args)
+        except ValueError as e:
+            api_file.abort(400, str(e))
+
+        if os.path.isfile(location) is False:
+            api_file.abort(404, "File \"%s\" does not exist" % location)
+
+        # VV: Long-polling ties up a thread, so it counts as a bulk download. If there is no free slot reply right
+        # away (the client just polls again) instead of blocking the threads that are reserved for small requests
+        client = client_id()
+        if wait > 0 and download_scheduler.acquire(client) is False:
+            wait = 0
+
+        try:
+            for delay in tail_poll_delays(location, offset, wait):
+                time.sleep(delay)
+        finally:
+            if wait > 0:
+                download_scheduler.release(client)
+
+        return read_tail(location, offset, max_bytes)
+
+
 class ServeFiles:
-    def discover_file_paths(self, data):
-        # (Dict[str, List[str]) -> Dict[str, List[str]]
-        """Receives a Dictionary of workflow instances->List[files under workflow instance] and returns those
-        which are contained under the instance"""
+    def discover_files(self, data):
+        # type: (Dict[str, Union[List[str], Dict[str, Any]]]) -> Dict[str, List[Tuple[str, Optional[FileInfo]]]]
+        """Receives a Dictionary of workflow instances->selection of files under workflow instance and returns the
+        files which are contained under the instance along with their FileInfo
+
+        The file manifest just expands the glob patterns, the FileInfo is None for files that the FileSelector
+        should stat() when it considers them (the manifest may be a few seconds, or minutes, out of date).
+
+        See parse_selection() for the schema of selections. Files whose current checksum is the same as the
+        one in the "checksums" of the selection are left out.
+
+        Raises:
+            InvalidSelection: if @data does not follow the schema
+        """
+        if not isinstance(data, dict):
+            raise InvalidSelection("Expected a dictionary {instanceURI: selection}, not %s" % type(data).__name__)
+
         all_files = {}
         for exp_instance in data:
+            paths, patterns, filters, client_checksums = parse_selection(data[exp_instance])
 
-            files = ['/%s' % l if l[0] != '/' else l for l in data[exp_instance]]
+            files = ['/%s' % l if l[0] != '/' else l for l in paths]
 
             if exp_instance.startswith('file://') is False:
-                raise ValueError("Expected a file:// URI but got \"%s\"" % exp_instance)
+                raise InvalidSelection("Expected a file:// URI but got \"%s\"" % exp_instance)
 
             _, exp_location = Experiment.split_instance_location(exp_instance)
 
             filtered_files = []
-            for path in files:
-                if registry_exps.contains(exp_location, path):
-                    if os.path.exists(path):
-                        filtered_files.append(path)
+            if registry_exps.has_experiment(exp_location):
+                files = [path for path in files if registry_exps.contains(exp_location, path)]
+                filtered_files = [(path, None) for path in files]
+
+                if patterns:
+                    known = set(files)
+                    matched = [p for p in manifests.get(exp_location).match_files(patterns) if p not in known]
+                    if filters:
+                        # VV: Apply the filters to fresh stat() results, not the sizes/mtimes in the manifest
+                        fresh = file_selector.stat_many(matched)
+                        filtered_files.extend((path, info) for path, info in zip(matched, fresh)
+                                              if info is not None and file_matches(info, **filters))
+                    else:
+                        filtered_files.extend((path, None) for path in matched)
+
+                if client_checksums:
+                    # VV: Files whose checksum is not cached are hashed only while they fit in the byte budget of
+                    # checksum requests, the ones that do not fit are not compared (i.e. they are kept)
+                    current = checksum_cache.checksums([p for p, _ in filtered_files if p in client_checksums],
+                                                       max_bytes=checksum_selector.max_bytes)
+                    filtered_files = [(p, info) for p, info in filtered_files
+                                      if p not in current or current[p].digest != client_checksums[p]]
 
             if filtered_files:
                 all_files[exp_instance] = filtered_files
 
         return all_files
 
-    def select_files(self, all_files):
-        # type: (Dict[str, List[str]]) -> List[str]
-        """Filters all_files so that resulting list of files adheres to Datastore limiting constraints (max bytes, etc)
+    def discover_file_paths(self, data):
+        # type: (Dict[str, Union[List[str], Dict[str, Any]]]) -> Dict[str, List[str]]
+        """Same as discover_files() but returns just the paths of the files"""
+        return {exp_instance: [path for path, _ in files]
+                for exp_instance, files in self.discover_files(data).items()}
+
+    def checksums(self, data):
+        # type: (Dict[str, Union[List[str], Dict[str, Any]]]) -> Tuple[Dict[str, Dict[str, Dict[str, Any]]], SelectionReport]
+        """Receives the same input as discover_files() and returns a tuple whose first item is
+        {instanceURI: {path: {"sha256": str, "size": int, "mtime": float}}}
+
+        Hashing is subject to the same limits as downloads (see checksum_selector), the second item of the tuple
+        is the SelectionReport with the files that were left out.
         """
-        selected_files = []
-        max_bytes_total = DS_FILE_MAX_SIZE
-        max_files_per_experiment = DS_MAX_FILES_PER_EXPERIMENT
-        max_files_total = DS_MAX_FILES_TOTAL
-
-        total_bytes = 0
-        total_returned_files = 0
-
-        for exp_instance in all_files:
-            if max_files_total is not None and total_returned_files >= max_files_total:
-                break
+        discovered = self.discover_files(data)
+        report = self.select(discovered, checksum_selector)
+        selected = set(report.selected)
+        ret = {}
+
+        for exp_instance in discovered:
+            paths = [path for path, _ in discovered[exp_instance] if path in selected]
+            ret[exp_instance] = {
+                path: {'sha256': entry.digest, 'size': entry.size, 'mtime': entry.mtime}
+                for path, entry in checksum_cache.checksums(paths).items()
+            }
+
+        return ret, report
+
+    def select(self, discovered, selector=None):
+        # type: (Dict[str, List[Tuple[str, Optional[FileInfo]]]], Optional[FileSelector]) -> SelectionReport
+        """Picks the files in the output of discover_files() that fit in the Datastore limits (DS_FILE_MAX_SIZE,
+        DS_MAX_FILES_PER_EXPERIMENT, DS_MAX_FILES_TOTAL) and reports which files it skipped and why
+
+        Uses @selector if it is not None, file_selector otherwise.
+        """
+        report = (selector or file_selector).select(
+            (exp_instance, path, info) for exp_instance in discovered for path, info in discovered[exp_instance])
 
-            exp_returned_files = 0
-            for path in all_files[exp_instance]:
-                file_size = os.path.getsize(path)
+        if report.stop_reason is not None:
+            rootLogger.warning("Stopped selecting files (%s) after %d files and %d bytes, %d files not considered" % (
+                report.stop_reason, len(report.selected), report.total_bytes, report.not_considered))
 
-                if 0 <= DS_FILE_MAX_SIZE < file_size:
-                    file_size = DS_FILE_MAX_SIZE
+        for exp_instance, count in report.capped.items():
+            rootLogger.warning("Hit maximum number of files (%s) for %s, skipped %d files" % (
+                DS_MAX_FILES_PER_EXPERIMENT, exp_instance, count))
 
-                if file_size + total_bytes > max_bytes_total:
-                    rootLogger.warning("Will not return file %s because we would exceed max "
-                                       "number of bytes (%d + %d > %d)" % (
-                                           path, total_bytes, file_size, max_bytes_total))
-                    continue
-                selected_files.append(path)
+        return report
 
-                total_bytes += file_size
-                exp_returned_files += 1
-                total_returned_files += 1
+    def select_files(self, all_files):
+        # type: (Dict[str, List[str]]) -> List[str]
+        """Filters all_files so that resulting list of files adheres to Datastore limiting constraints (max bytes, etc)
+        """
+        discovered = {exp_instance: [(path, None) for path in all_files[exp_instance]] for exp_instance in all_files}
+        return self.select(discovered).selected
 
-                if max_files_per_experiment is not None and exp_returned_files >= max_files_per_experiment:
-                    rootLogger.warning("Hit maximum number of files (%d) for %s" % (
-                        max_files_per_experiment, exp_instance))
-                    break
 
-                if max_files_total is not None and total_returned_files >= max_files_total:
-                    rootLogger.warning("Hit maximum number of files (%d) per request" % max_files_total)
-                    break
+def selection_headers(report):
+    # type: (SelectionReport) -> Dict[str, str]
+    """Summarizes a SelectionReport in HTTP headers (use /files/api/v1.1/select for the full report)"""
+    return {
+        'X-Selected-Files': str(len(report.selected)),
+        'X-Skipped-Files': str(len(report.skipped) + sum(report.capped.values()) + report.not_considered),
+        'X-Selection-Stop-Reason': report.stop_reason or '',
+    }
 
-        return selected_files
 
 mFilesMany = api_files.model('get-many-files', {
         "instanceURI": fields.List(
@@ -383,10 +1010,24 @@ mFilesMany = api_files.model('get-many-files', {
     example={
         'file://tmp/workdir/<experiment_instance_dir.instance>': [
             '/tmp/workdir/<experiment_instance_dir.instance>/output/experiment.log'
-        ]
+        ],
+        'file://tmp/workdir/<other_experiment_instance_dir.instance>': {
+            'paths': ['/tmp/workdir/<other_experiment_instance_dir.instance>/output/experiment.log'],
+            'glob': ['stages/stage2/**/*.csv'],
+            'max_size': 1048576,
+            'modified_after': 1700000000,
+            'checksums': {
+                '/tmp/workdir/<other_experiment_instance_dir.instance>/stages/stage2/A/data.csv': '<sha256>',
+            },
+        },
     },
 )
 
+@api_files.errorhandler(InvalidSelection)
+def handle_invalid_selection(error):
+    return {'message': str(error)}, 400
+
+
 @api_files.route('/api/v1.1')
 class DBFileManyZipAPI(Resource):
     def __init__(self, *args, **kwargs):
@@ -394,70 +1035,222 @@ class DBFileManyZipAPI(Resource):
         self.files = ServeFiles()
 
     @api_files.expect(mFilesMany)
+    @api_files.doc(params=archive_format_params)
+    @bulk_download
     def post(self):
+        archive_format, level = parse_archive_format(api_files)
         data = request.get_json(force=True)
-        all_files = self.files.discover_file_paths(data)
-        selected_files = self.files.select_files(all_files)
+        report = self.files.select(self.files.discover_files(data))
 
-        response = Response(IterableStreamZipOfFiles(selected_files), mimetype='application/zip')
-        response.headers['Content-Disposition'] = 'attachment; filename={}'.format('files.zip')
+        response = archive_response(
+            IterableStreamZipOfFiles(report.selected, archive_format=archive_format, level=level), archive_format)
+        response.headers.extend(selection_headers(report))
         return response
 
 
-@api_experiment.route('/')
-class ExperimentExists(Resource):
-    def get(self):
-        experiment = request.args.get('experiment')
-        stage = request.args.get('stage')
-        component = request.args.get('component')
+@api_files.route('/api/v1.1/select')
+class DBFileSelectAPI(Resource):
+    """Dry-run of /files/api/v1.1: reports which files would be in the archive and which would be skipped (and why)"""
+    def __init__(self, *args, **kwargs):
+        super(DBFileSelectAPI, self).__init__(*args, **kwargs)
+        self.files = ServeFiles()
 
-        component = unquote(component)
-        experiment = unquote(experiment)
+    @api_files.expect(mFilesMany)
+    def post(self):
+        data = request.get_json(force=True)
+        report = self.files.select(self.files.discover_files(data))
 
-        if experiment[0] != '/':
-            experiment = '/' + experiment
+        ret = report.to_dict()
+        ret['files'] = report.selected
+        return ret
 
-        if registry_exps.has_experiment(experiment) is False:
-            rootLogger.info("Unknown experiment %s" % experiment)
-            return False
 
-        experiment = unquote(experiment)
-        _, instance = Experiment.split_instance_location(experiment)
+def locate_component(experiment, stage, component):
+    # type: (str, str, str) -> Optional[Tuple[str, str]]
+    """Returns (instance directory, component directory) or None if the experiment is not registered"""
+    component = unquote(component)
+    experiment = unquote(experiment)
 
-        location = os.path.join(instance, 'stages', 'stage%s' % stage, component)
+    if experiment[0] != '/':
+        experiment = '/' + experiment
 
-        return str(os.path.isdir(location))
+    if registry_exps.has_experiment(experiment) is False:
+        rootLogger.info("Unknown experiment %s" % experiment)
+        return None
 
+    experiment = unquote(experiment)
+    _, instance = Experiment.split_instance_location(experiment)
 
+    return instance, os.path.join(instance, 'stages', 'stage%s' % stage, component)
 
-@api_experiment.route('/download')
-class ExperimentDownload(Resource):
+
+def component_archive(instance, location, archive_format, level=None):
+    # type: (str, str, str, Optional[int]) -> Tuple[Optional[str], Optional[Iterable[bytes]]]
+    """Returns (path to cached archive, None) if the archive of @location is cached, (None, stream) otherwise
+
+    The stream populates the archive cache as it is consumed (if the directory is worth caching).
+    """
+    stream = IterableStreamZipOfDirectory(location, archive_format=archive_format, level=level)
+
+    if archive_cache is not None:
+        # VV: Fingerprint fresh stat() results of exactly the files that IterableStreamZipOfDirectory archives, the
+        # file manifest may be out of date and it does not look inside symbolic links to directories
+        fingerprint = ArchiveCache.fingerprint(
+            (full, FileInfo(st.st_size, st.st_mtime, st.st_mode)) for full, _, st in directory_walker.walk(location))
+        # VV: tar.zst archives with different compression levels are different cache entries
+        cache_format = archive_format
+        if archive_format == archive_formats.FORMAT_TAR_ZSTD and level is not None:
+            cache_format = '%s-%d' % (archive_format, level)
+        cached = archive_cache.lookup(location, fingerprint, cache_format)
+
+        if cached is not None:
+            return cached, None
+
+        if archive_cache.should_cache(fingerprint):
+            stream = archive_cache.store_while_streaming(location, fingerprint, cache_format, stream)
+
+    return None, stream
+
+
+@api_files.route('/api/v1.1/checksums')
+class DBFileChecksumsAPI(Resource):
+    """Returns the sha256 checksums, sizes and mtimes of files (e.g. {"file://...": {"glob": "**"}} for an entire
+    instance). Clients can feed the checksums back to /files/api/v1.1 to download just the files that changed.
+
+    Hashing is subject to the same limits as downloads, the X-Skipped-Files and X-Selection-Stop-Reason headers
+    report whether files were left out (use /files/api/v1.1/select for the full report)"""
+    def __init__(self, *args, **kwargs):
+        super(DBFileChecksumsAPI, self).__init__(*args, **kwargs)
+        self.files = ServeFiles()
+
+    @api_files.expect(mFilesMany)
+    @bulk_download
+    def post(self):
+        data = request.get_json(force=True)
+        ret, report = self.files.checksums(data)
+        return ret, 200, selection_headers(report)
+
+
+def list_changes(instance_uri, cursor=None, since=None):
+    # type: (str, Optional[str], Optional[float]) -> Optional[Dict[str, Any]]
+    """Returns the files of the instance @instance_uri that changed after @cursor (or were modified after the epoch
+    timestamp @since), None if the instance is not registered
+
+    The answer comes from the change and deletion records of the file manifest of this process, the instance
+    directory is not walked. New, replaced, and deleted files are noticed by the incremental refresh of the manifest,
+    files which are modified in place are noticed when the manifest is rebuilt (see DS_MANIFEST_MAX_AGE).
+    A cursor is an epoch timestamp, so any gateway process can use it. If the manifest cannot tell what changed
+    after the cursor (e.g. the manifest is younger than the cursor) the response has "reset": True and lists all
+    files. Requests with @since fall back to comparing the mtime of all files instead.
+
+    Returns:
+        {"cursor": str, "reset": bool, "changed": [{"path": str, "size": int, "mtime": float}], "deleted": [str]}
+        Pass "cursor" to the next call to receive just the changes that happen in the meantime.
+    """
+    if instance_uri.startswith('file://') is False:
+        raise ValueError("Expected a file:// URI but got \"%s\"" % instance_uri)
+
+    _, instance = Experiment.split_instance_location(instance_uri)
+    if registry_exps.has_experiment(instance) is False:
+        return None
+
+    if cursor is not None:
+        try:
+            since = float(cursor)
+        except ValueError:
+            since = None
+
+    next_cursor, reset, changed, deleted = manifests.get(instance).changes(since)
+    if reset and cursor is None and since is not None:
+        reset = False
+        changed = [(path, info) for path, info in changed if info.mtime >= since]
+
+    return {
+        'cursor': '%.6f' % next_cursor,
+        'reset': reset,
+        'changed': [{'path': path, 'size': info.size, 'mtime': info.mtime} for path, info in changed],
+        'deleted': [path for path in deleted if not os.path.lexists(path)],
+    }
+
+
+def parse_changes_args(args):
+    # type: (Mapping[str, str]) -> Tuple[str, Optional[str], Optional[float]]
+    """Returns the (instance, cursor, since) query arguments of a changes request, raises ValueError for invalid
+    values"""
+    instance = args.get('instance')
+    if not instance or unquote(instance).startswith('file://') is False:
+        raise ValueError("Expected a file:// URI in the \"instance\" argument, received %s" % instance)
+
+    since = args.get('since')
+    if since is not None:
+        try:
+            since = float(since)
+        except ValueError:
+            raise ValueError("Expected an epoch timestamp in the \"since\" argument, received %s" % since)
+
+    return unquote(instance), args.get('cursor'), since
+
+
+@api_files.route('/api/v1.1/changes')
+class DBFileChangesAPI(Resource):
+    """Lists the files of an instance which were created, modified, or deleted since a cursor or a timestamp"""
+    @api_files.doc(params={
+        'instance': 'The file:// URI of the instance',
+        'cursor': 'The "cursor" field of a previous response, omit it to list all files',
+        'since': 'Epoch timestamp, lists files modified after it (only used if there is no cursor)',
+    })
     def get(self):
-        experiment = request.args.get('experiment')
-        stage = request.args.get('stage')
-        component = request.args.get('component')
+        try:
+            instance, cursor, since = parse_changes_args(request.args)
+        except ValueError as e:
+            api_files.abort(400, str(e))
 
-        component = unquote(component)
-        experiment = unquote(experiment)
+        changes = list_changes(instance, cursor, since)
+
+        if changes is None:
+            api_files.abort(404, "Unknown instance %s" % instance)
 
-        if experiment[0] != '/':
-            experiment = '/' + experiment
+        return changes
 
-        if registry_exps.has_experiment(experiment) is False:
-            rootLogger.info("Unknown experiment %s" % experiment)
+
+@api_experiment.route('/')
+class ExperimentExists(Resource):
+    def get(self):
+        found = locate_component(
+            request.args.get('experiment'), request.args.get('stage'), request.args.get('component'))
+
+        if found is None:
             return False
 
-        experiment = unquote(experiment)
-        _, instance = Experiment.split_instance_location(experiment)
+        _, location = found
+        return str(os.path.isdir(location))
+
+
+
+@api_experiment.route('/download')
+class ExperimentDownload(Resource):
+    @api_experiment.doc(params=archive_format_params)
+    @bulk_download
+    def get(self):
+        archive_format, level = parse_archive_format(api_experiment)
+        found = locate_component(
+            request.args.get('experiment'), request.args.get('stage'), request.args.get('component'))
 
-        location = os.path.join(instance, 'stages', 'stage%s' % stage, component)
+        if found is None:
+            return False
 
+        instance, location = found
         if os.path.isdir(location) is False:
             return ""
 
-        response = Response(IterableStreamZipOfDirectory(location), mimetype='application/zip')
-        response.headers['Content-Disposition'] = 'attachment; filename={}'.format('files.zip')
-        return response
+        cached, stream = component_archive(instance, location, archive_format, level)
+
+        if cached is not None:
+            # VV: send_file() hands the file to the WSGI server's file_wrapper (i.e. sendfile)
+            return send_file(cached, mimetype=archive_formats.MIMETYPES[archive_format], as_attachment=True,
+                             download_name='files.%s' % archive_format, conditional=True)
+
+        return archive_response(stream, archive_format)
 
 
 api.add_namespace(api_files)
@@ -0,0 +1,350 @@
+#! /usr/bin/env python
+#
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+"""An asyncio (aiohttp) implementation of the file APIs of cluster_gateway.py
+
+A synchronous gateway ties up a server thread for the entire duration of each download. This one serves every
+request from an event loop and offloads the blocking filesystem operations (stat, read, zip/tar generation) to a
+thread pool, one batch of bytes at a time. A single process can therefore keep thousands of slow clients busy.
+
+The REST-API, the experiment registry, the file manifests and the archive cache are exactly the ones of
+cluster_gateway.py, this module only swaps the web framework. Run it with:
+
+    gunicorn cluster_gateway_async:app --worker-class aiohttp.GunicornWebWorker
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import json
+import os
+import sys
+import traceback
+
+from aiohttp import web
+
+import cluster_gateway as gateway
+from st4sd_datastore import archive_formats
+
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+rootLogger = gateway.rootLogger
+unquote = gateway.unquote
+
+# VV: Threads that run the blocking filesystem operations of all requests
+DS_ASYNC_IO_THREADS = gateway.int_from_env('DS_ASYNC_IO_THREADS', 32)
+# VV: Streams are read in batches of (at least) this many bytes, each batch is 1 hop to the thread pool
+DS_ASYNC_BATCH_BYTES = gateway.int_from_env('DS_ASYNC_BATCH_BYTES', 256 * 1024)
+
+# VV: Threads shared by all archive streams to stat() and read() files ahead of the one being archived, 0 disables
+# prefetching (the io_pool already reads the files of different streams in parallel). Streams never start their own
+# prefetch threads (see DS_PREFETCH_WORKERS of the threaded engine) so the number of threads stays bounded
+DS_ASYNC_PREFETCH_THREADS = gateway.int_from_env('DS_ASYNC_PREFETCH_THREADS', 0)
+
+io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=DS_ASYNC_IO_THREADS, thread_name_prefix='async-io')
+prefetch_pool = None  # type: Optional[concurrent.futures.ThreadPoolExecutor]
+if DS_ASYNC_PREFETCH_THREADS > 0:
+    prefetch_pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=DS_ASYNC_PREFETCH_THREADS, thread_name_prefix='async-prefetch')
+
+
+async def run_blocking(func, *args, **kwargs):
+    # type: (Callable, Any, Any) -> Any
+    """Runs func(*args, **kwargs) on the io_pool thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_pool, functools.partial(func, *args, **kwargs))
+
+
+def json_error(exception_class, message):
+    # type: (type, str) -> web.HTTPException
+    return exception_class(text=json.dumps({'message': message}), content_type='application/json')
+
+
+def next_batch(iterator, max_bytes):
+    # type: (Iterable[bytes], int) -> bytes
+    """Concatenates chunks of @iterator till there are at least @max_bytes, returns b'' once it is exhausted"""
+    chunks = []
+    size = 0
+    for chunk in iterator:
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= max_bytes:
+            break
+
+    return b''.join(chunks)
+
+
+async def stream_archive(request, stream, archive_format, headers=None):
+    # type: (web.Request, Iterable[bytes], str, Optional[Dict[str, str]]) -> web.StreamResponse
+    """Sends the bytes of @stream, which is generated on the io_pool, to the client"""
+    response = web.StreamResponse(headers={
+        'Content-Disposition': 'attachment; filename={}'.format('files.%s' % archive_format)})
+    response.headers.update(headers or {})
+    response.content_type = archive_formats.MIMETYPES[archive_format]
+    await response.prepare(request)
+
+    iterator = iter(stream)
+    try:
+        while True:
+            batch = await run_blocking(next_batch, iterator, DS_ASYNC_BATCH_BYTES)
+            if not batch:
+                break
+            await response.write(batch)
+    finally:
+        # VV: If the client disconnects this cleans up the prefetch threads, partial cached archives, etc
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await run_blocking(close)
+
+    await response.write_eof()
+    return response
+
+
+def parse_archive_format(request):
+    # type: (web.Request) -> Tuple[str, Optional[int]]
+    try:
+        return archive_formats.parse_format(request.query.get('format'), request.query.get('level'))
+    except ValueError as e:
+        raise json_error(web.HTTPBadRequest, str(e))
+
+
+@web.middleware
+async def error_middleware(request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPException:
+        raise
+    except gateway.InvalidSelection as e:
+        return web.json_response({'message': str(e)}, status=400)
+    except Exception:
+        rootLogger.critical("Exception while serving %s\nEXCEPTION:%s" % (request.path, traceback.format_exc()))
+        return web.json_response({'message': 'Internal Server Error'}, status=500)
+
+
+async def add_cors_headers(request, response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+
+
+async def preflight(request):
+    """Answers CORS preflight requests the same way flask_cors does for cluster_gateway.py"""
+    headers = {
+        'Access-Control-Allow-Methods': 'GET, HEAD, POST, OPTIONS',
+    }
+    requested_headers = request.headers.get('Access-Control-Request-Headers')
+    if requested_headers:
+        headers['Access-Control-Allow-Headers'] = requested_headers
+    return web.Response(headers=headers)
+
+
+async def hello(request):
+    return web.json_response("hello")
+
+
+async def experiment_location_get(request):
+    location = unquote(request.match_info['location'])
+
+    if location.startswith('file://') is False:
+        raise ValueError("Expected a file:// URI received \"%s\"" % location)
+
+    rootLogger.info("Check whether experiment exists in \"%s\"" % location)
+    return web.json_response(gateway.registry_exps.has_experiment(location))
+
+
+async def experiment_location_post(request):
+    location = unquote(request.match_info['location'])
+
+    if location.startswith('file://') is False:
+        raise ValueError("Expected a file:// URI received \"%s\"" % location)
+
+    validation = request.query.get('validation', gateway.VALIDATE_FULL)
+    if validation not in gateway.VALIDATION_MODES:
+        raise json_error(web.HTTPBadRequest, "Unknown validation mode \"%s\", expected one of %s" % (
+            validation, gateway.VALIDATION_MODES))
+
+    return web.json_response(await run_blocking(gateway.register_instance, location, validation))
+
+
+async def experiment_locations_post(request):
+    data = await request.json(loads=json.loads)
+    locations = data.get('locations') if isinstance(data, dict) else None
+    validation = data.get('validation', gateway.VALIDATE_DEFERRED) if isinstance(data, dict) else None
+
+    if not isinstance(locations, list) or any(not isinstance(x, str) for x in locations):
+        raise json_error(web.HTTPBadRequest, "Expected {\"locations\": [file:// URIs]}")
+
+    invalid = [x for x in locations if x.startswith('file://') is False]
+    if invalid:
+        raise json_error(web.HTTPBadRequest, "Expected file:// URIs received %s" % invalid)
+
+    if validation not in gateway.VALIDATION_MODES:
+        raise json_error(web.HTTPBadRequest, "Unknown validation mode \"%s\", expected one of %s" % (
+            validation, gateway.VALIDATION_MODES))
+
+    return web.json_response(await run_blocking(gateway.register_instances, locations, validation))
+
+
+async def file_get(request):
+    contents = await run_blocking(
+        gateway.read_single_file, unquote(request.match_info['location']), request.match_info['experiment'])
+    return web.json_response(contents)
+
+
+async def file_raw_get(request):
+    location = gateway.resolve_single_file(unquote(request.match_info['location']), request.match_info['experiment'])
+
+    if await run_blocking(os.path.isfile, location) is False:
+        raise json_error(web.HTTPNotFound, "File \"%s\" does not exist" % location)
+
+    # VV: FileResponse handles Range/If-Range/Last-Modified and uses sendfile()
+    return web.FileResponse(location, headers={
+        'Content-Type': 'application/octet-stream',
+        'Content-Disposition': 'attachment; filename={}'.format(os.path.basename(location)),
+    })
+
+
+async def file_tail_get(request):
+    location = gateway.resolve_single_file(unquote(request.match_info['location']), request.match_info['experiment'])
+
+    try:
+        offset, wait, max_bytes = gateway.parse_tail_args(request.query)
+    except ValueError as e:
+        raise json_error(web.HTTPBadRequest, str(e))
+
+    if await run_blocking(os.path.isfile, location) is False:
+        raise json_error(web.HTTPNotFound, "File \"%s\" does not exist" % location)
+
+    # VV: Long-poll without holding a thread while waiting
+    delays = gateway.tail_poll_delays(location, offset, wait)
+    while True:
+        delay = await run_blocking(next, delays, None)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+
+    return web.json_response(await run_blocking(gateway.read_tail, location, offset, max_bytes))
+
+
+async def files_post(request):
+    archive_format, level = parse_archive_format(request)
+    data = await request.json(loads=json.loads)
+
+    def select():
+        files = gateway.ServeFiles()
+        return files.select(files.discover_files(data))
+
+    report = await run_blocking(select)
+
+    return await stream_archive(
+        request, gateway.IterableStreamZipOfFiles(report.selected, archive_format=archive_format, level=level,
+                                                  prefetch_workers=0, prefetch_pool=prefetch_pool),
+        archive_format, gateway.selection_headers(report))
+
+
+async def files_select_post(request):
+    data = await request.json(loads=json.loads)
+
+    def select():
+        files = gateway.ServeFiles()
+        report = files.select(files.discover_files(data))
+        ret = report.to_dict()
+        ret['files'] = report.selected
+        return ret
+
+    return web.json_response(await run_blocking(select))
+
+
+async def files_checksums_post(request):
+    data = await request.json(loads=json.loads)
+    ret, report = await run_blocking(gateway.ServeFiles().checksums, data)
+    return web.json_response(ret, headers=gateway.selection_headers(report))
+
+
+async def files_changes_get(request):
+    try:
+        instance, cursor, since = gateway.parse_changes_args(request.query)
+    except ValueError as e:
+        raise json_error(web.HTTPBadRequest, str(e))
+
+    changes = await run_blocking(gateway.list_changes, instance, cursor, since)
+
+    if changes is None:
+        raise json_error(web.HTTPNotFound, "Unknown instance %s" % instance)
+
+    return web.json_response(changes)
+
+
+async def experiment_exists(request):
+    found = gateway.locate_component(
+        request.query.get('experiment'), request.query.get('stage'), request.query.get('component'))
+
+    if found is None:
+        return web.json_response(False)
+
+    _, location = found
+    return web.json_response(str(await run_blocking(os.path.isdir, location)))
+
+
+async def experiment_download(request):
+    archive_format, level = parse_archive_format(request)
+    found = gateway.locate_component(
+        request.query.get('experiment'), request.query.get('stage'), request.query.get('component'))
+
+    if found is None:
+        return web.json_response(False)
+
+    instance, location = found
+    if await run_blocking(os.path.isdir, location) is False:
+        return web.json_response("")
+
+    cached, stream = await run_blocking(gateway.component_archive, instance, location, archive_format, level)
+
+    if cached is not None:
+        return web.FileResponse(cached, headers={
+            'Content-Type': archive_formats.MIMETYPES[archive_format],
+            'Content-Disposition': 'attachment; filename={}'.format('files.%s' % archive_format),
+        })
+
+    return await stream_archive(request, stream, archive_format)
+
+
+def make_app(prefix=gateway.FLASK_URL_PREFIX):
+    # type: (str) -> web.Application
+    app = web.Application(middlewares=[error_middleware], client_max_size=64 * 1024 * 1024)
+    app.on_response_prepare.append(add_cors_headers)
+
+    # VV: The tail route must come before the generic /file/api/v1.0 one
+    app.add_routes([
+        web.get(prefix + '/hello', hello),
+        web.get(prefix + '/hello/', hello),
+        web.get(prefix + '/experiment/api/v1.0/location/{location:.+}', experiment_location_get),
+        web.post(prefix + '/experiment/api/v1.0/location/{location:.+}', experiment_location_post),
+        web.post(prefix + '/experiment/api/v1.0/locations', experiment_locations_post),
+        web.get(prefix + '/file/api/v1.0/tail/{experiment:.+?}/location/{location:.+}', file_tail_get),
+        web.get(prefix + '/file/api/v1.0/{experiment:.+?}/location/{location:.+}', file_get),
+        web.get(prefix + '/file/api/v1.1/{experiment:.+?}/location/{location:.+}', file_raw_get),
+        web.post(prefix + '/files/api/v1.1', files_post),
+        web.post(prefix + '/files/api/v1.1/select', files_select_post),
+        web.post(prefix + '/files/api/v1.1/checksums', files_checksums_post),
+        web.get(prefix + '/files/api/v1.1/changes', files_changes_get),
+        web.get(prefix + '/experiment/', experiment_exists),
+        web.get(prefix + '/experiment/download', experiment_download),
+        # VV: Routes are matched in order, this one only answers the OPTIONS requests that no route above handles
+        web.options(prefix + '/{path:.*}', preflight),
+    ])
+
+    return app
+
+
+app = make_app()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2:
+        port = int(sys.argv[1])
+    else:
+        port = 5002
+
+    web.run_app(app, port=port, host='0.0.0.0')
@@ -17,15 +17,20 @@ rootLogger.setLevel(20)
 from werkzeug.middleware.proxy_fix import ProxyFix
 from st4sd_datastore.middlelayer import PrefixMiddleware
 import urllib.parse
+import urllib3
 
 unquote = urllib.parse.unquote
-from flask import Flask, request, Blueprint
+from flask import Flask, request, Blueprint, Response
 from flask_restx import Api, Resource, Namespace, reqparse
 import sys
 import flask_restx.apidoc
+from typing import Any, Dict, Union
 from flask_cors import CORS
 
-from st4sd_datastore.gateway_registry import GatewayRegistry
+from st4sd_datastore.gateway_registry import GatewayRegistry, SQLiteGatewayRegistry
+from st4sd_datastore.gateway_health import GatewayProber
+from st4sd_datastore.federated_fetch import FederatedFetcher
+from st4sd_datastore import archive_formats
 
 FLASK_URL_PREFIX = os.environ.get("FLASK_URL_PREFIX", "")
 
@@ -35,7 +40,103 @@ if FLASK_URL_PREFIX:
     print(f"Prefixing SwaggerUI static url path ({old_static_url_path}) with {FLASK_URL_PREFIX}")
     flask_restx.apidoc.apidoc.static_url_path = f"{FLASK_URL_PREFIX}{old_static_url_path}"
 
-registry = GatewayRegistry()
+# VV: json (default) keeps the gateways in a JSON file, sqlite keeps them in an SQLite database in WAL mode which
+# multiple workers can share. WAL mode does not work on network filesystems (e.g. NFS-backed persistent volumes)
+# so DS_GATEWAY_REGISTRY_DB must be on a local disk. Before switching from sqlite back to json run
+# "gateway_registry.py export-json" (with DS_GATEWAY_REGISTRY_BACKEND=sqlite) so that no registrations are lost
+DS_GATEWAY_REGISTRY_BACKEND = os.environ.get('DS_GATEWAY_REGISTRY_BACKEND', 'json')
+DS_GATEWAY_REGISTRY_DB = os.environ.get('DS_GATEWAY_REGISTRY_DB', 'cache_gateway_registry.sqlite')
+
+if DS_GATEWAY_REGISTRY_BACKEND == 'json':
+    registry = GatewayRegistry()
+elif DS_GATEWAY_REGISTRY_BACKEND == 'sqlite':
+    registry = SQLiteGatewayRegistry(DS_GATEWAY_REGISTRY_DB)
+else:
+    raise ValueError("DS_GATEWAY_REGISTRY_BACKEND must be one of json, sqlite - not \"%s\"" %
+                     DS_GATEWAY_REGISTRY_BACKEND)
+
+def number_from_env(name, default):
+    # type: (str, Union[int, float]) -> Union[int, float]
+    """Reads a number of the same type as @default (int or float) from the environment variable @name, returns
+    @default if it is unset or invalid"""
+    value = os.environ.get(name)
+
+    if value is None:
+        rootLogger.warning("%s environment variable not set, will default to %s" % (name, default))
+        return default
+
+    try:
+        value = type(default)(value)
+    except Exception:
+        rootLogger.warning("Could not convert %s=\"%s\" to %s, will default to %s" % (
+            name, value, type(default).__name__, default))
+        return default
+
+    rootLogger.warning("%s is set to %s" % (name, value))
+    return value
+
+
+# VV: Every DS_GATEWAY_PROBE_INTERVAL seconds (0 disables probing) the /hello/ endpoint of every gateway is
+# probed with a timeout of DS_GATEWAY_PROBE_TIMEOUT seconds. A gateway is unhealthy after
+# DS_GATEWAY_PROBE_UNHEALTHY_AFTER consecutive failed probes
+DS_GATEWAY_PROBE_INTERVAL = number_from_env('DS_GATEWAY_PROBE_INTERVAL', 30.0)
+DS_GATEWAY_PROBE_TIMEOUT = number_from_env('DS_GATEWAY_PROBE_TIMEOUT', 5.0)
+DS_GATEWAY_PROBE_UNHEALTHY_AFTER = number_from_env('DS_GATEWAY_PROBE_UNHEALTHY_AFTER', 2)
+
+# VV: Set DS_GATEWAY_VERIFY_TLS to false to skip verifying the TLS certificates of gateways (e.g. self-signed ones)
+DS_GATEWAY_VERIFY_TLS = os.environ.get('DS_GATEWAY_VERIFY_TLS', 'true').lower() in ['true', 'yes', '1']
+
+if DS_GATEWAY_VERIFY_TLS is False:
+    rootLogger.warning("DS_GATEWAY_VERIFY_TLS is false, will not verify the TLS certificates of gateways")
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# VV: All workers share the health of gateways through the registry, just the one which holds the lock probes them
+prober = GatewayProber(
+    registry.get_all, interval=DS_GATEWAY_PROBE_INTERVAL, timeout=DS_GATEWAY_PROBE_TIMEOUT,
+    unhealthy_after=DS_GATEWAY_PROBE_UNHEALTHY_AFTER, verify_tls=DS_GATEWAY_VERIFY_TLS, store=registry,
+    lock_location='cache_gateway_prober.lock')
+
+if DS_GATEWAY_PROBE_INTERVAL > 0:
+    prober.start()
+else:
+    rootLogger.warning("DS_GATEWAY_PROBE_INTERVAL is %s, will not probe gateways" % DS_GATEWAY_PROBE_INTERVAL)
+
+
+# VV: Federated fetches download from at most DS_FEDERATED_WORKERS gateways at the same time and keep up to
+# DS_FEDERATED_SPOOL_MEMORY bytes of each gateway's archive in memory (the rest goes to a temporary file)
+DS_FEDERATED_WORKERS = number_from_env('DS_FEDERATED_WORKERS', 16)
+DS_FEDERATED_READ_TIMEOUT = number_from_env('DS_FEDERATED_READ_TIMEOUT', 300.0)
+DS_FEDERATED_SPOOL_MEMORY = number_from_env('DS_FEDERATED_SPOOL_MEMORY', 64 * 1024 * 1024)
+
+fetcher = FederatedFetcher(
+    registry.get_many, is_healthy=lambda uid: prober.health(uid)['healthy'] is not False,
+    workers=DS_FEDERATED_WORKERS, read_timeout=DS_FEDERATED_READ_TIMEOUT, spool_memory=DS_FEDERATED_SPOOL_MEMORY,
+    verify_tls=DS_GATEWAY_VERIFY_TLS)
+
+
+def with_health(gateways, healthy_only=False):
+    # type: (Dict[str, Dict[str, Any]], bool) -> Dict[str, Dict[str, Any]]
+    """Returns copies of the @gateways entries with an extra "health" field, see GatewayProber.health()
+
+    If @healthy_only is True the gateways which are known to be unhealthy are left out (gateways that have not
+    been probed yet are kept).
+    """
+    ret = {}
+    for uid, gateway in gateways.items():
+        health = prober.health(uid)
+        if healthy_only and health['healthy'] is False:
+            continue
+        ret[uid] = dict(gateway, health=health)
+    return ret
+
+
+def healthy_only_arg():
+    # type: () -> bool
+    return request.args.get('healthy', 'false').lower() in ['true', 'yes', '1']
+
+
+healthy_param = {'healthy': 'Set to true to leave out gateways which are known to be unhealthy'}
+
 
 app = Flask(__name__)
 app.wsgi_app = PrefixMiddleware(app.wsgi_app)
@@ -75,7 +176,7 @@ class DBGatewayAPI(Resource):
         super(DBGatewayAPI, self).__init__(*kargs, **kwargs)
 
     def get(self, unique_id):
-        return registry.get(unique_id)
+        return dict(registry.get(unique_id), health=prober.health(unique_id))
 
 
 @api_gateway.route('/api/v1.0/unique_id/<string:unique_id>/host/<path:host>/label/<string:label>')
@@ -101,17 +202,50 @@ class DBGatewayPostAPI(Resource):
         return ''
 
 
+@api_gateways.route('/api/v1.0/label/<string:label>')
+class DBGatewaysLabelAPI(Resource):
+    @api_gateways.doc(params=healthy_param)
+    def get(self, label):
+        return with_health(registry.get_by_label(label), healthy_only_arg())
+
+
 @api_gateways.route('/api/v1.0/unique_ids')
 class DBGatewaysAPI(Resource):
+    @api_gateways.doc(params=healthy_param)
     def post(self):
         unique_ids = request.get_json(force=True)
 
-        ret = {}
+        return with_health(registry.get_many(unique_ids), healthy_only_arg())
+
 
-        for uid in [d for d in unique_ids if registry.contains(d)]:
-            ret[uid] = registry.get(uid)
+@api_gateways.route('/api/v1.0/files')
+class DBGatewaysFilesAPI(Resource):
+    """Fetches files of instances on many gateways with a single request and returns them in one archive
+
+    The payload is the same as the one of the /files/api/v1.1 endpoint of cluster gateways (instanceURI -> files).
+    Files are stored under $GATEWAY_ID/ in the archive, which ends with a federation-report.json member that
+    contains the outcome of each gateway."""
+    @api_gateways.doc(params={
+        'format': 'Archive format, one of zip (default), tar, tar.zst (if the zstandard package is installed)',
+        'level': 'Compression level for tar.zst (default %d)' % archive_formats.DEFAULT_ZSTD_LEVEL,
+    })
+    def post(self):
+        data = request.get_json(force=True)
 
-        return ret
+        try:
+            archive_format, level = archive_formats.parse_format(request.args.get('format'),
+                                                                 request.args.get('level'))
+        except ValueError as e:
+            api_gateways.abort(400, str(e))
+
+        if not isinstance(data, dict) or any(not isinstance(k, str) or k.startswith('file://') is False
+                                             for k in data):
+            api_gateways.abort(400, "Expected a dictionary whose keys are file:// URIs of instances")
+
+        response = Response(fetcher.stream(data, archive_format, level),
+                            mimetype=archive_formats.MIMETYPES[archive_format])
+        response.headers['Content-Disposition'] = 'attachment; filename={}'.format('files.%s' % archive_format)
+        return response
 
 
 api.add_namespace(api_gateway)
@@ -136,6 +270,13 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 
 if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'export-json':
+        if isinstance(registry, SQLiteGatewayRegistry) is False:
+            rootLogger.critical("export-json requires DS_GATEWAY_REGISTRY_BACKEND=sqlite")
+            sys.exit(1)
+        registry.export_json()
+        sys.exit(0)
+
     if len(sys.argv) >= 2:
         port = int(sys.argv[1])
     else:
@@ -7,12 +7,14 @@
 from __future__ import annotations
 
 import argparse
+import collections
+import concurrent.futures
 import glob
 import json
 import logging
 import os
 import sys
-import time
+import threading
 import traceback
 
 import pymongo.errors
@@ -28,9 +30,90 @@ import experiment.model.conf
 import experiment.model.data
 import experiment.service.db
 import experiment.model.storage
-from st4sd_datastore.reporter import Reporter
+from st4sd_datastore.reporter import Reporter, DocumentBatch
+from st4sd_datastore.experiment_cache import ExperimentCache
+from st4sd_datastore.update_watcher import UpdateWatcher, WATCH_MODES, WATCH_AUTO
 
-from typing import Dict, List, Union, Any
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Any
+
+
+def path_to_int(path):
+    # type: (str) -> int
+    """Returns the step of the update file @path i.e. N for ${anything}-${N}.json and -1 for ${anything}-begin.json"""
+    file_name = os.path.splitext(path)[0]
+    number_or_begin = file_name.rsplit('-', 1)[-1]
+
+    try:
+        return int(number_or_begin)
+    except ValueError:
+        if number_or_begin == 'begin':
+            return -1
+
+        raise ValueError("Invalid file \"%s\" whose name doesn't end in \"-<number>.json\" or \"-begin.json\"" % path)
+
+
+def read_update_file(filepath):
+    # type: (str) -> Dict[str, Any]
+    """Reads and validates a trigger file
+
+    Returns
+        {"step": int, "update-file": str, "update": Dict[str, Any]} - see consume_file() for the format of "update"
+
+    Raises
+        ValueError - if the name of the file is invalid, it does not contain a JSON dictionary, or the dictionary
+            does not contain the "experiment-location" key
+        OSError - if the file cannot be read
+    """
+    step = path_to_int(filepath)
+
+    with open(filepath, 'r') as f:
+        update = json.load(f)
+
+    if not isinstance(update, dict):
+        raise ValueError("%s does not contain a dictionary" % filepath)
+
+    if not isinstance(update.get('experiment-location'), str):
+        raise ValueError("Key \"experiment-location\" not found in %s" % filepath)
+
+    return {'step': step, 'update-file': filepath, 'update': update}
+
+
+def read_updates(
+        pending: List[str]
+    ) -> Tuple[Dict[str, List[Dict[str, Any]]], List[str]]:
+    """Reads each trigger file once and groups the updates by the experiment instance they are for
+
+    Args:
+        pending(List[str]): paths to trigger files
+
+    Returns
+        A tuple with 2 items:
+        1. {experiment-location: [update]} where each update is the output of read_update_file() and the updates
+           of each experiment instance are sorted in ascending order of their step
+        2. The paths of the trigger files which are invalid
+    """
+    experiment_instances = dict()  # type: Dict[str, List[Dict[str, Any]]]
+    invalid_pending_updates = []  # type: List[str]
+
+    for filepath in pending:
+        try:
+            e = read_update_file(filepath)
+        except FileNotFoundError:
+            # VV: The file was consumed after it was listed
+            continue
+        except Exception as exc:
+            rootLogger.critical("Exception: %s. Failed to parse json %s\nEXCEPTION:%s" % (
+                exc, filepath, traceback.format_exc()
+            ))
+            rootLogger.critical("Did not read/decode %s add it to invalid_pending_updates" % filepath)
+            invalid_pending_updates.append(filepath)
+        else:
+            experiment_instances.setdefault(e['update']['experiment-location'], []).append(e)
+
+    for updates in experiment_instances.values():
+        updates.sort(key=lambda e: e['step'])
+
+    return experiment_instances, invalid_pending_updates
 
 
 def consume_file(
@@ -56,7 +139,9 @@ def consume_file(
 
     Raises
         pymongo.errors.PyMongoError - if the connection to MongoDB is interrupted may raise this exception,
-            in the background pymongo will try to re-establish connection. So you can re-execute this method
+            in the background pymongo will try to re-establish connection. So you can re-execute this method.
+            When the reporter has a spool, it spools writes that fail because MongoDB is unavailable instead
+            and this exception is raised only for errors that retrying would not fix
     """
     try:
         experiment_location = update['experiment-location']
@@ -87,6 +172,261 @@ def consume_file(
         return True
 
 
+def coalesce_updates(
+        updates: List[Dict[str, Any]]
+    ) -> Tuple[List[Tuple[Optional[DocumentBatch], List[Dict[str, Any]]]], List[str]]:
+    """Merges consecutive updates of an experiment instance into DocumentBatch objects
+
+    Updates that upsert the entire experiment instance (i.e. they contain neither "upsert-documents" nor
+    "finished-components", see consume_file()) are not merged with other updates. Within a batch, a later update
+    of a document supersedes earlier ones, see DocumentBatch.
+
+    Args:
+        updates(List[Dict[str, Any]]): updates of one instance sorted in ascending order of their step (see
+            read_updates())
+
+    Returns
+        A tuple with 2 items:
+        1. [(batch, [update])] in the order that they should be applied. The batch is None for updates that
+           upsert the entire experiment instance, the list then contains just that update
+        2. The paths of the trigger files whose updates are malformed
+    """
+    segments = []  # type: List[Tuple[Optional[DocumentBatch], List[Dict[str, Any]]]]
+    invalid_pending_updates = []  # type: List[str]
+
+    for e in updates:
+        update = e['update']
+
+        if len(update.get('upsert-documents', [])) == 0 and 'finished-components' not in update:
+            segments.append((None, [e]))
+            continue
+
+        try:
+            this = DocumentBatch()
+            if update.get('upsertExperimentDocument', False) is True:
+                this.add_experiment_document()
+
+            if len(update.get('upsert-documents', [])) > 0:
+                this.add_documents(update['upsert-documents'])
+            else:
+                this.add_components(update['finished-components'])
+        except Exception as exc:
+            rootLogger.warning("Malformed update-file %s (%s) add it to invalid_pending_updates" % (
+                e['update-file'], exc))
+            invalid_pending_updates.append(e['update-file'])
+            continue
+
+        if not segments or segments[-1][0] is None:
+            segments.append((DocumentBatch(), []))
+
+        batch, members = segments[-1]
+        batch.merge(this)
+        members.append(e)
+
+    return segments, invalid_pending_updates
+
+
+def ingest_instance(
+        instance: str,
+        updates: List[Dict[str, Any]],
+        experiments: ExperimentCache,
+        reporter: Reporter,
+        dir_processed: str,
+    ) -> List[str]:
+    """Consumes the updates of an experiment instance in the order of their steps
+
+    Args:
+        instance(str): location of the experiment instance
+        updates(List[Dict[str, Any]]): updates of @instance sorted in ascending order of their step (see
+            read_updates())
+        experiments(ExperimentCache): cache of loaded experiment instances
+        reporter(Reporter): the reporter to consume the updates with
+        dir_processed(str): directory to move consumed trigger files to
+
+    Returns
+        The paths of the trigger files which could not be consumed
+
+    Raises
+        pymongo.errors.PyMongoError - on MongoDB errors, trigger files whose updates were consumed have already been
+            moved to @dir_processed
+    """
+    invalid_pending_updates = []  # type: List[str]
+
+    try:
+        exp = experiments.get(instance, updates[0]['update'].get('platform'))
+    except Exception as exc:
+        rootLogger.warning(traceback.format_exc())
+        rootLogger.warning("Could not read experiment instance at %s, error: %s" % (instance, exc))
+
+        for e in updates:
+            invalid_pending_updates.append(e['update-file'])
+            rootLogger.critical("Did not consume %s add it to invalid_pending_updates" % e['update-file'])
+        return invalid_pending_updates
+
+    def consume_one(e):
+        filepath = e['update-file']
+        try:
+            rootLogger.info("Update step %s for %s" % (e['step'], filepath))
+
+            if consume_file(filepath, e['update'], exp, reporter):
+                os.rename(filepath, os.path.join(dir_processed, os.path.split(filepath)[1]))
+            else:
+                rootLogger.critical("Run into issue while handling %s "
+                                    "add it to invalid_pending_updates" % filepath)
+                invalid_pending_updates.append(filepath)
+        except pymongo.errors.PyMongoError:
+            # VV: Panic when dealing with MongoDB errors ...
+            raise
+        except Exception as exc:
+            rootLogger.warning("Failed to process update-file %s.EXCEPTION:%s\n" % (
+                exc, traceback.format_exc()))
+            rootLogger.warning("Did not process %s add it to invalid_pending_updates" % filepath)
+            invalid_pending_updates.append(filepath)
+
+    segments, invalid = coalesce_updates(updates)
+    invalid_pending_updates.extend(invalid)
+
+    for batch, members in segments:
+        if batch is None:
+            consume_one(members[0])
+            continue
+
+        rootLogger.info("Update steps %s for %s" % ([e['step'] for e in members], instance))
+        try:
+            reporter.upsert_batch(exp, batch)
+        except pymongo.errors.PyMongoError:
+            raise
+        except Exception as exc:
+            # VV: Find out which update files are problematic by consuming them one at a time
+            rootLogger.warning("Failed to upsert the coalesced updates of %s (%s) - will consume them one by one."
+                               "EXCEPTION:%s\n" % (instance, exc, traceback.format_exc()))
+            for e in members:
+                consume_one(e)
+        else:
+            # VV: Move the trigger files only after their updates are in the database
+            for e in members:
+                filepath = e['update-file']
+                try:
+                    os.rename(filepath, os.path.join(dir_processed, os.path.split(filepath)[1]))
+                except Exception as exc:
+                    rootLogger.warning("Could not move consumed update-file %s to %s: %s" % (
+                        filepath, dir_processed, exc))
+
+    # VV: The runtime emits one last update after the final stage, there will be no more updates for this
+    # instance so there's no reason to keep it in the cache
+    if updates[-1]['step'] >= exp.numStages():
+        experiments.evict(instance)
+
+    return invalid_pending_updates
+
+
+class InstanceIngestor(object):
+    """Consumes the updates of different experiment instances in parallel
+
+    Each experiment instance has a queue of batches of updates (see read_updates()). At most one worker consumes
+    the updates of an instance at any point in time, in the order in which they were submitted, so the updates of
+    an instance are applied in the order of their steps while a slow instance does not hold back the others.
+    There are at most @workers instances in flight which also bounds the number of concurrent requests to MongoDB.
+
+    After a MongoDB exception the ingestor stops starting new batches (so that it does not keep hitting a failing
+    database), the trigger files of the batches it dropped remain in the monitor directory.
+
+    Arguments:
+        consume: Callable which receives (instance, updates), consumes the updates, and returns the paths of the
+            trigger files which could not be consumed
+        workers: Maximum number of experiment instances to consume updates of at the same time
+        on_attention: Optional callable which is invoked (from a worker thread) when there are invalid trigger files
+            or an exception for collect_invalid() to report
+    """
+    def __init__(
+            self,
+            consume: Callable[[str, List[Dict[str, Any]]], List[str]],
+            workers: int = 4,
+            on_attention: Optional[Callable[[], None]] = None,
+        ):
+        self._consume = consume
+        self._on_attention = on_attention
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='ingest')
+
+        self._lock = threading.Lock()
+        self._queues = {}  # type: Dict[str, collections.deque]
+        # VV: Paths of trigger files that have been submitted but not consumed yet
+        self._claimed = set()  # type: Set[str]
+        self._invalid = []  # type: List[str]
+        self._exception = None  # type: Optional[BaseException]
+
+    def is_claimed(self, path: str) -> bool:
+        with self._lock:
+            return path in self._claimed
+
+    def submit(self, instance: str, updates: List[Dict[str, Any]]):
+        """Queues the @updates of @instance (sorted in ascending order of their step)"""
+        with self._lock:
+            self._claimed.update(e['update-file'] for e in updates)
+
+            queue = self._queues.get(instance)
+            if queue is not None:
+                # VV: A worker is already consuming the updates of this instance, it will get to these next
+                queue.append(updates)
+                return
+
+            self._queues[instance] = collections.deque([updates])
+
+        self._pool.submit(self._drain, instance)
+
+    def _drain(self, instance: str):
+        while True:
+            with self._lock:
+                queue = self._queues[instance]
+                if not queue or self._exception is not None:
+                    for updates in queue:
+                        self._claimed.difference_update(e['update-file'] for e in updates)
+                    del self._queues[instance]
+                    return
+                updates = queue.popleft()
+
+            invalid = []
+            try:
+                invalid = self._consume(instance, updates)
+            except BaseException as e:
+                rootLogger.warning("Stopping ingestion because of exception while consuming updates of %s: %s" % (
+                    instance, e))
+                with self._lock:
+                    if self._exception is None:
+                        self._exception = e
+            finally:
+                with self._lock:
+                    # VV: Invalid trigger files stay claimed till release() so that they are not read again while
+                    # they are still in the monitor directory
+                    invalid_set = set(invalid)
+                    self._claimed.difference_update(
+                        e['update-file'] for e in updates if e['update-file'] not in invalid_set)
+                    self._invalid.extend(invalid)
+                    attention = bool(invalid) or self._exception is not None
+
+            if attention and self._on_attention is not None:
+                self._on_attention()
+
+    def collect_invalid(self) -> List[str]:
+        """Returns (and forgets) the trigger files which the workers could not consume
+
+        The trigger files remain claimed till they are passed to release().
+
+        Raises
+            The exception which stopped the ingestor (if any)
+        """
+        with self._lock:
+            if self._exception is not None:
+                raise self._exception
+            invalid, self._invalid = self._invalid, []
+        return invalid
+
+    def release(self, paths: Iterable[str]):
+        """Stops claiming the invalid trigger files @paths, e.g. after they are moved out of the monitor directory"""
+        with self._lock:
+            self._claimed.difference_update(paths)
+
+
 def main():
     os.umask(0o002)
 
@@ -146,6 +486,32 @@ def main():
         required=True,
     )
 
+    parser.add_argument(
+        '--watch-mode',
+        help='How to detect new update files in @--monitor-dir: inotify, poll (check the modification time of '
+             '@--monitor-dir every @--poll-interval seconds), or auto (inotify if available, poll otherwise). '
+             'inotify does not see files that other nodes create on shared filesystems, so the directory is '
+             'also polled in inotify mode',
+        choices=WATCH_MODES,
+        default=WATCH_AUTO,
+        required=False,
+    )
+
+    parser.add_argument(
+        '--poll-interval', type=float,
+        help='Seconds between consecutive checks of the modification time of @--monitor-dir',
+        default=1.0,
+        required=False,
+    )
+
+    parser.add_argument(
+        '--debounce', type=float,
+        help='After a new update file appears, wait till no new ones appear for this many seconds (but no longer '
+             'than 1 second) so that bursts of update files are processed together',
+        default=0.1,
+        required=False,
+    )
+
     parser.add_argument(
         '--gateway-id',
         help='Gateway id, leave blank to generate one based on mac-address',
@@ -171,11 +537,58 @@ def main():
         dest="auth_source", default=None, required=False
     )
 
+    parser.add_argument(
+        '--experiment-cache-size', type=int,
+        help='Maximum number of loaded experiment instances to keep in memory between updates, 0 disables the cache',
+        default=32,
+        required=False,
+    )
+
+    parser.add_argument(
+        '--ingest-workers', type=int,
+        help='Maximum number of experiment instances whose updates are consumed in parallel (the updates of each '
+             'instance are always consumed one at a time, in order)',
+        default=4,
+        required=False,
+    )
+
+    parser.add_argument(
+        '--spool-dir',
+        help='Directory to spool document writes in while the database is unavailable, defaults to spool/ in '
+             'the working directory of the reporter. Do not place it in a directory that other processes can '
+             'write to (e.g. @--monitor-dir)',
+        default='',
+        required=False,
+    )
+
+    parser.add_argument(
+        '--disable-spool', action='store_true',
+        help='Do not spool document writes while the database is unavailable, exit instead',
+        default=False,
+        required=False,
+    )
+
+    parser.add_argument(
+        '--spool-initial-backoff', type=float,
+        help='Seconds to wait before retrying the spooled writes for the first time, the delay doubles after '
+             'every failed retry',
+        default=1.0,
+        required=False,
+    )
+
+    parser.add_argument(
+        '--spool-max-backoff', type=float,
+        help='Maximum seconds between retries of spooled writes',
+        default=60.0,
+        required=False,
+    )
+
     args = parser.parse_args()
 
     dir_monitor = args.monitor_dir
     dir_processed = os.path.join(dir_monitor, 'processed')
     dir_invalid = os.path.join(dir_monitor, 'invalid')
+    dir_spool = None if args.disable_spool else (args.spool_dir or os.path.join(os.getcwd(), 'spool'))
 
     for f in [dir_monitor, dir_processed, dir_invalid]:
         if not os.path.exists(f):
@@ -195,6 +608,9 @@ def main():
             mongo_username=args.username,
             mongo_password=args.password,
             mongo_authSource=args.auth_source,
+            spool_dir=dir_spool,
+            spool_initial_backoff=args.spool_initial_backoff,
+            spool_max_backoff=args.spool_max_backoff,
         )
     except Exception as e:
         import pprint
@@ -204,20 +620,10 @@ def main():
 
     rootLogger.critical("Reporter spawned")
 
-    def path_to_int(path):
-        file_name = os.path.splitext(path)[0]
-        number_or_begin = file_name.rsplit('-', 1)[1]
-
-        try:
-            return int(number_or_begin)
-        except ValueError:
-            if number_or_begin == 'begin':
-                return -1
-
-            raise ValueError("Invalid file \"%s\" whose name doesn't end in \"-<number>.json\" or \"-begin.json\"")
-
     def dump_invalid_updates(dir_monitor, dir_invalid, invalid_pending_updates):
+        """Moves the invalid update files to dir_invalid and returns the paths of those that it moved"""
         fpath = os.path.join(dir_monitor, 'invalid_update_file_paths.txt')
+        moved = []
 
         if invalid_pending_updates:
             rootLogger.critical("I discovered some invalid update files: %s" % (
@@ -238,8 +644,10 @@ def main():
 
                 try:
                     os.rename(k, new_path)
+                    moved.append(k)
                 except Exception as e:
-                    pass
+                    rootLogger.critical("Failed to move invalid update file %s to %s. EXCEPTION: %s" % (
+                        k, new_path, e))
 
         else:
             try:
@@ -250,133 +658,54 @@ def main():
                     fpath, traceback.format_exc()
                 ))
 
-    try:
-        while True:
-            # VV: Wait 10 secs between consecutive checks of the FS, also wait 10 secs for the very first time
-            #     so that the gateway has enough time to spawn
-
-            time.sleep(10)
-
-            pending = glob.glob(os.path.join(dir_monitor, '*.json'))
+        return moved
 
-            if not pending:
-                continue
+    experiments = ExperimentCache(max_size=args.experiment_cache_size)
 
-            valid_pending = []
-            invalid_pending_updates = []
+    def ingest_pending():
+        """Hands the update files which are currently in dir_monitor over to the ingestor"""
+        # VV: Raises the MongoDB exception that stopped the ingestor (if any)
+        invalid_pending_updates = ingestor.collect_invalid()
 
-            for p in pending:
-                try:
-                    path_to_int(p)
-                except Exception:
-                    invalid_pending_updates.append(p)
-                else:
-                    valid_pending.append(p)
-
-            if invalid_pending_updates:
-                dump_invalid_updates(dir_monitor, dir_invalid, invalid_pending_updates)
-
-            if not valid_pending:
-                continue
-
-            rootLogger.info("Will process updates from %s" % valid_pending)
+        pending = [p for p in glob.glob(os.path.join(dir_monitor, '*.json')) if not ingestor.is_claimed(p)]
 
-            pending_annotated = [{'step': path_to_int(e), 'update-file': e} for e in valid_pending]
-            pending_sorted = sorted(pending_annotated, key=lambda e: e['step'])
-
-            experiment_instances = dict()  # type: Dict[str, List[Dict[str, Union[int, str]]]]
-
-            # VV: Group experiment updates based on their experiment instance
-
-            for e in pending_sorted:
-                filepath = e['update-file']
+        experiment_instances, invalid_read = read_updates(pending)
+        invalid_pending_updates.extend(invalid_read)
 
-                try:
-                    with open(filepath, 'r') as f:
-                        update = json.load(f)
+        if invalid_pending_updates:
+            # VV: Files which could not be moved stay claimed so that their updates are not applied again
+            ingestor.release(dump_invalid_updates(dir_monitor, dir_invalid, invalid_pending_updates))
 
-                    try:
-                        experiment_location = update['experiment-location']
-                    except KeyError:
-                        raise ValueError("Key \"experiment-location\" not found in %s" % filepath)
+        if not experiment_instances:
+            return
 
-                    if experiment_location not in experiment_instances:
-                        experiment_instances[experiment_location] = [e]
-                    else:
-                        experiment_instances[experiment_location].append(e)
+        rootLogger.info("Will process updates %s" % {
+            instance: [e['update-file'] for e in updates] for instance, updates in experiment_instances.items()})
 
-                except Exception as e:
-                    rootLogger.critical("Exception: %s. Failed to parse json %s\nEXCEPTION:%s" % (
-                        e, filepath, traceback.format_exc()
-                    ))
-                    rootLogger.critical("Did not read/decode %s add it to invalid_pending_updates" % filepath)
-                    invalid_pending_updates.append(filepath)
+        for instance, updates in experiment_instances.items():
+            ingestor.submit(instance, updates)
 
-            if invalid_pending_updates:
-                dump_invalid_updates(dir_monitor, dir_invalid, invalid_pending_updates)
+    watcher = UpdateWatcher(dir_monitor, mode=args.watch_mode, poll_interval=args.poll_interval,
+                            debounce=args.debounce)
+    rootLogger.info("Watching %s for update files using %s" % (dir_monitor, watcher.mode))
 
-            rootLogger.info("Converted %s into %s" % (
-                pending_sorted, experiment_instances
-            ))
+    ingestor = InstanceIngestor(
+        lambda instance, updates: ingest_instance(instance, updates, experiments, reporter, dir_processed),
+        workers=args.ingest_workers, on_attention=watcher.wake)
 
-            for instance in experiment_instances:
-                # VV: Prioritize reading the FlowIR flavour of the experiment - other flavours e.g. DOSINI may
-                # not contain the name of the platform. This will cause experiment.model.data.Experiment()
-                # to consider that the experiment instance is invalid (as it does not contain the requested platform).
-                other_formats = [x for x in experiment.model.conf.ExperimentConfigurationFactory.default_priority
-                                 if x != 'flowir']
-                try:
-                    expDir = experiment.model.storage.ExperimentInstanceDirectory(instance,
-                                                                            attempt_shadowdir_repair=False)
-                    exp = experiment.model.data.Experiment(
-                        expDir, platform=update.get('platform'), updateInstanceConfiguration=False, is_instance=True,
-                        format_priority=['flowir'] + other_formats)
-                except Exception as exc:
-                    rootLogger.warning(traceback.format_exc())
-                    rootLogger.warning("Could not read experiment instance at %s, error: %s" % (instance, exc))
-
-                    for e in experiment_instances[instance]:
-                        filepath = dict(e).get('update-file')
-                        if filepath:
-                            invalid_pending_updates.append(filepath)
-                            filename = os.path.split(filepath)[1]
-                            rootLogger.critical("Did not consume %s add it to invalid_pending_updates" % filepath)
-                    continue
-
-                for e in experiment_instances[instance]:
-                    filepath = None
-                    try:
-                        e = dict(e)
-                        filepath = e['update-file']
-                        with open(filepath, 'r') as f:
-                            update = json.load(f)
-
-                        rootLogger.info("Update step %s for %s" % (
-                            e['step'], filepath))
-
-                        filename = os.path.split(filepath)[1]
-
-                        if consume_file(filepath, update, exp, reporter):
-                            os.rename(e['update-file'], os.path.join(dir_processed, filename))
-                        else:
-                            rootLogger.critical("Run into issue while handling %s "
-                                                "add it to invalid_pending_updates" % filepath)
-                            invalid_pending_updates.append(filepath)
-                    except pymongo.errors.PyMongoError:
-                        # VV: Panic when dealing with MongoDB errors ...
-                        raise
-                    except Exception as e:
-                        rootLogger.warning("Failed to process update-file %s.EXCEPTION:%s\n" % (
-                            e, traceback.format_exc()))
-                        rootLogger.warning("Did not process %s add it to invalid_pending_updates" % filepath)
-                        invalid_pending_updates.append(filepath)
-            if invalid_pending_updates:
-                dump_invalid_updates(dir_monitor, dir_invalid, invalid_pending_updates)
+    try:
+        # VV: The Reporter has already waited for the gateway to reply to /hello/ so there is no need to wait before
+        # the very first check of the FS. Afterwards, check the FS again as soon as new update files appear
+        # (or once a minute in case the watcher missed something)
+        while True:
+            ingest_pending()
+            watcher.wait()
 
         rootLogger.critical("Gateway is dead!")
     except KeyboardInterrupt:
         rootLogger.info("Received KeyboardInterrupt - exiting")
     except pymongo.errors.PyMongoError as e:
+        # VV: Unless the spool is disabled, errors due to MongoDB being unavailable never make it here
         rootLogger.warning(traceback.format_exc())
         rootLogger.warning("PyMongo Exception %s - will terminate" % e)
         sys.exit(1)
@@ -11,7 +11,14 @@ cd ${my_dir}
 export EXTERNAL_PORT=${EXTERNAL_PORT:-"5002"}
 export WORKER_TIMEOUT=${WORKER_TIMEOUT:-"120"}
 export GUNICORN_PID_PATH=${GUNICORN_PID_PATH:-"/gunicorn/webserver.pid"}
-export WORKER_THREADS=${WORKER_THREADS:-"2"}
+export WORKER_THREADS=${WORKER_THREADS:-"4"}
+# VV: Set to "async" to serve files from an asyncio event loop (cluster_gateway_async.py)
+export GATEWAY_ENGINE=${GATEWAY_ENGINE:-"sync"}
 
-gunicorn --bind "0.0.0.0:${EXTERNAL_PORT}" cluster_gateway:app -p /gunicorn/webserver.pid --timeout "${WORKER_TIMEOUT}" \
+if [ "${GATEWAY_ENGINE}" == "async" ]; then
+  gunicorn --bind "0.0.0.0:${EXTERNAL_PORT}" cluster_gateway_async:app -p /gunicorn/webserver.pid \
+      --timeout "${WORKER_TIMEOUT}" --worker-class aiohttp.GunicornWebWorker
+else
+  gunicorn --bind "0.0.0.0:${EXTERNAL_PORT}" cluster_gateway:app -p /gunicorn/webserver.pid --timeout "${WORKER_TIMEOUT}" \
       --threads "${WORKER_THREADS}"
+fi
@@ -10,9 +10,14 @@ mkdir -p ${my_dir}
 cd ${my_dir}
 export EXTERNAL_PORT=${EXTERNAL_PORT:-"5001"}
 export WORKER_TIMEOUT=${WORKER_TIMEOUT:-"120"}
-export WORKER_THREADS=${WORKER_THREADS:-"1"}
+# VV: Federated fetches (/gateways/api/v1.0/files) keep a thread busy till the slowest gateway replies, use enough
+# threads so that they do not block lookups
+export WORKER_THREADS=${WORKER_THREADS:-"8"}
+# VV: Multiple workers should use DS_GATEWAY_REGISTRY_BACKEND=sqlite with DS_GATEWAY_REGISTRY_DB on a local disk
+# (SQLite WAL mode does not work on network filesystems)
+export WORKERS=${WORKERS:-"1"}
 
 export GUNICORN_PID_PATH=${GUNICORN_PID_PATH:-"/gunicorn/webserver.pid"}
 
 gunicorn --bind "0.0.0.0:${EXTERNAL_PORT}" gateway_registry:app -p /gunicorn/webserver.pid --timeout "${WORKER_TIMEOUT}" \
-      --threads "${WORKER_THREADS}"
+      --threads "${WORKER_THREADS}" --workers "${WORKERS}"
@@ -80,6 +80,7 @@ setup(
 
     scripts=[
         os.path.join('drivers', 'cluster_gateway.py'),
+        os.path.join('drivers', 'cluster_gateway_async.py'),
         os.path.join('drivers', 'reporter.py'),
         os.path.join('drivers', 'gateway_registry.py'),
         os.path.join('drivers', 'mongo_proxy.py'),
@@ -90,4 +91,11 @@ setup(
         'pymongo',
         'flask', 'flask-restx', 'stream_zip', "six", "flask-cors", "werkzeug",
     ],
+
+    extras_require={
+        # VV: Enables the tar.zst archive format of cluster_gateway
+        'zstd': ['zstandard'],
+        # VV: Required by drivers/cluster_gateway_async.py
+        'async': ['aiohttp'],
+    },
 )
@@ -6,3 +6,15 @@
 from . import reporter
 from . import gateway_registry
 from . import experiment_registry
+from . import file_manifest
+from . import archive_cache
+from . import archive_formats
+from . import download_scheduler
+from . import checksums
+from . import file_selection
+from . import directory_walker
+from . import gateway_health
+from . import federated_fetch
+from . import update_watcher
+from . import experiment_cache
+from . import document_spool
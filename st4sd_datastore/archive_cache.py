@@ -0,0 +1,148 @@
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from typing import Iterable, Iterator, Optional, Tuple
+
+from .file_manifest import FileInfo
+
+Fingerprint = collections.namedtuple('Fingerprint', ['max_mtime', 'file_count', 'total_size'])
+
+
+class ArchiveCache(object):
+    """An on-disk cache of archives of directories, bounded by a disk quota with least-recently-used eviction
+
+    Archives are keyed by the path of the directory, a Fingerprint of its contents (newest mtime, number of files,
+    total size) and the archive format. A change to the directory therefore results in a cache miss instead of a
+    stale archive. The mtime of a cached archive doubles as its "last used" timestamp so that multiple processes
+    (e.g. gunicorn workers) can share the same cache directory.
+    """
+    partial_prefix = '.partial-'
+
+    def __init__(self, root, quota_bytes, min_age=60.0):
+        # type: (str, int, float) -> None
+        """
+        Args:
+            root: directory to store archives in, will be created if it does not exist
+            quota_bytes: maximum number of bytes that cached archives may occupy
+            min_age: only directories whose newest file is older than this many seconds are cached, so that
+                directories of components which are still running do not churn the cache
+        """
+        self.root = os.path.abspath(root)
+        self.quota_bytes = quota_bytes
+        self.min_age = min_age
+        self._lock = threading.RLock()
+        self.log = logging.getLogger('ArchiveCache')
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    @classmethod
+    def fingerprint(cls, files):
+        # type: (Iterable[Tuple[str, FileInfo]]) -> Fingerprint
+        """Computes the Fingerprint of a directory out of the (path, FileInfo) of its files"""
+        max_mtime = 0.
+        file_count = 0
+        total_size = 0
+
+        for _, info in files:
+            max_mtime = max(max_mtime, info.mtime)
+            file_count += 1
+            total_size += info.size
+
+        return Fingerprint(max_mtime, file_count, total_size)
+
+    def archive_path(self, location, fingerprint, archive_format):
+        # type: (str, Fingerprint, str) -> str
+        key = '\0'.join((os.path.abspath(location), repr(tuple(fingerprint)), archive_format))
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, '%s.%s' % (digest, archive_format))
+
+    def should_cache(self, fingerprint):
+        # type: (Fingerprint) -> bool
+        """Returns whether an archive of a directory with this @fingerprint is worth caching"""
+        return time.time() - fingerprint.max_mtime >= self.min_age and fingerprint.total_size <= self.quota_bytes
+
+    def lookup(self, location, fingerprint, archive_format):
+        # type: (str, Fingerprint, str) -> Optional[str]
+        """Returns the path to the cached archive or None if there is no such archive"""
+        path = self.archive_path(location, fingerprint, archive_format)
+
+        try:
+            # VV: Mark the archive as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    def store_while_streaming(self, location, fingerprint, archive_format, chunks):
+        # type: (str, Fingerprint, str, Iterable[bytes]) -> Iterator[bytes]
+        """Yields @chunks and at the same time writes them to the cache
+
+        The archive is added to the cache only after the last chunk is generated. If the consumer stops early
+        (e.g. the client disconnected) or @chunks raises an exception the partial archive is deleted.
+        """
+        path = self.archive_path(location, fingerprint, archive_format)
+        fd, partial = tempfile.mkstemp(dir=self.root, prefix=self.partial_prefix)
+        completed = False
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            completed = True
+        finally:
+            if completed:
+                os.replace(partial, path)
+                self.log.info("Cached archive of %s in %s" % (location, path))
+                self.enforce_quota()
+            else:
+                try:
+                    os.remove(partial)
+                except OSError:
+                    pass
+
+    def enforce_quota(self):
+        """Deletes the least recently used archives till the cache fits in its quota"""
+        with self._lock:
+            archives = []
+            for entry in os.scandir(self.root):
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                if entry.name.startswith(self.partial_prefix):
+                    # VV: Leftovers of a process that died while streaming an archive
+                    if time.time() - st.st_mtime > 24 * 60 * 60:
+                        self._remove(entry.path)
+                    continue
+
+                archives.append((st.st_mtime, st.st_size, entry.path))
+
+            total = sum(x[1] for x in archives)
+
+            for _, size, path in sorted(archives):
+                if total <= self.quota_bytes:
+                    break
+                self._remove(path)
+                total -= size
+
+    def _remove(self, path):
+        # type: (str) -> None
+        try:
+            os.remove(path)
+        except OSError as e:
+            self.log.warning("Could not remove %s: %s" % (path, e))
+        else:
+            self.log.info("Evicted %s" % path)
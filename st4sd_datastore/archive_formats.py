@@ -0,0 +1,157 @@
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+"""Incremental encoders which turn a stream of archive members into zip, tar, or zstd-compressed tar bytes
+
+A member is a tuple (name, mod_time, file_mode, size, chunks) where mod_time is a datetime.datetime, size is
+the number of bytes that @chunks is expected to yield and chunks is an iterable of bytes.
+"""
+
+import datetime
+import stat
+import tarfile
+
+import stream_zip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from typing import Iterable, Iterator, Optional, Tuple
+
+Member = Tuple[str, datetime.datetime, int, int, Iterable[bytes]]
+
+FORMAT_ZIP = 'zip'
+FORMAT_TAR = 'tar'
+FORMAT_TAR_ZSTD = 'tar.zst'
+
+MIMETYPES = {
+    FORMAT_ZIP: 'application/zip',
+    FORMAT_TAR: 'application/x-tar',
+    FORMAT_TAR_ZSTD: 'application/zstd',
+}
+
+DEFAULT_ZSTD_LEVEL = 3
+
+
+def supported_formats():
+    """Returns the archive formats that this installation can produce (tar.zst requires the zstandard package)"""
+    formats = [FORMAT_ZIP, FORMAT_TAR]
+    if zstandard is not None:
+        formats.append(FORMAT_TAR_ZSTD)
+    return formats
+
+
+def parse_format(archive_format=None, level=None):
+    # type: (Optional[str], Optional[str]) -> Tuple[str, Optional[int]]
+    """Validates the archive format and compression level that a client asked for (e.g. in query arguments)
+
+    Arguments:
+        archive_format: One of supported_formats(), None for zip
+        level: The compression level as a string (or None), tar.zst supports levels 1 to
+            zstandard.MAX_COMPRESSION_LEVEL, the other formats ignore it
+
+    Returns:
+        A tuple (archive_format, level)
+
+    Raises:
+        ValueError: If the format is not supported or the level is invalid
+    """
+    archive_format = archive_format or FORMAT_ZIP
+
+    if archive_format not in supported_formats():
+        raise ValueError("Unsupported archive format \"%s\", supported formats are %s" % (
+            archive_format, supported_formats()))
+
+    if level is not None:
+        try:
+            level = int(level)
+        except ValueError:
+            raise ValueError("Compression level must be an integer, not \"%s\"" % level)
+
+        if archive_format == FORMAT_TAR_ZSTD and not 1 <= level <= zstandard.MAX_COMPRESSION_LEVEL:
+            raise ValueError("Compression level of %s must be between 1 and %d, not %d" % (
+                FORMAT_TAR_ZSTD, zstandard.MAX_COMPRESSION_LEVEL, level))
+
+    return archive_format, level
+
+
+def stream_zip_members(members):
+    # type: (Iterable[Member]) -> Iterator[bytes]
+    def convert():
+        for name, mod_time, file_mode, _size, chunks in members:
+            yield name, mod_time, file_mode, stream_zip.ZIP_64, chunks
+
+    for chunk in stream_zip.stream_zip(convert()):
+        yield chunk
+
+
+def stream_tar_members(members):
+    # type: (Iterable[Member]) -> Iterator[bytes]
+    """Generates a POSIX (pax) tar archive
+
+    The size that goes in the header of a member is fixed before its contents are read. If the file grows in the
+    meantime its contents are truncated to @size, if it shrinks they are padded with zeros.
+    """
+    for name, mod_time, file_mode, size, chunks in members:
+        info = tarfile.TarInfo(name.lstrip('/'))
+        info.size = size
+        info.mtime = int(mod_time.timestamp())
+        info.mode = stat.S_IMODE(file_mode)
+        info.type = tarfile.REGTYPE
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+
+        remaining = size
+        for chunk in chunks:
+            if remaining <= 0:
+                break
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+            yield chunk
+
+        if remaining > 0:
+            yield tarfile.NUL * remaining
+
+        padding = size % tarfile.BLOCKSIZE
+        if padding:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - padding)
+
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def stream_tar_zstd_members(members, level=None):
+    # type: (Iterable[Member], Optional[int]) -> Iterator[bytes]
+    if zstandard is None:
+        raise ValueError("Archive format %s requires the zstandard python package" % FORMAT_TAR_ZSTD)
+
+    compressor = zstandard.ZstdCompressor(level=level if level is not None else DEFAULT_ZSTD_LEVEL)
+    compressobj = compressor.compressobj()
+
+    for chunk in stream_tar_members(members):
+        out = compressobj.compress(chunk)
+        if out:
+            yield out
+
+    yield compressobj.flush()
+
+
+def stream_archive(members, archive_format=FORMAT_ZIP, level=None):
+    # type: (Iterable[Member], str, Optional[int]) -> Iterator[bytes]
+    """Generates the bytes of an archive in @archive_format (see supported_formats()) containing @members
+
+    Arguments:
+        members: The members of the archive
+        archive_format: One of zip, tar, tar.zst
+        level: Compression level, only used by tar.zst
+    """
+    if archive_format == FORMAT_ZIP:
+        return stream_zip_members(members)
+    elif archive_format == FORMAT_TAR:
+        return stream_tar_members(members)
+    elif archive_format == FORMAT_TAR_ZSTD:
+        return stream_tar_zstd_members(members, level)
+
+    raise ValueError("Unknown archive format \"%s\", supported formats are %s" % (
+        archive_format, supported_formats()))
@@ -0,0 +1,125 @@
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import threading
+
+from typing import Dict, Iterable, Optional, Tuple
+
+FileChecksum = collections.namedtuple('FileChecksum', ['size', 'mtime', 'digest'])
+
+
+class ChecksumCache(object):
+    """Computes checksums of files on a thread pool and remembers them until the size or mtime of the file changes
+
+    The cache holds at most @max_entries checksums and evicts the least recently used ones.
+    """
+    def __init__(self, max_entries=100000, workers=4, algorithm='sha256', block_size=1024 * 1024):
+        # type: (int, int, str, int) -> None
+        self.max_entries = max_entries
+        self.algorithm = algorithm
+        self.block_size = block_size
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # type: Dict[str, FileChecksum]
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='checksum')
+
+        self.log = logging.getLogger('ChecksumCache')
+
+    def _lookup(self, path, st):
+        # type: (str, os.stat_result) -> Optional[FileChecksum]
+        """Returns the cached FileChecksum of @path if the file still has the size and mtime in @st, else None"""
+        with self._lock:
+            cached = self._entries.get(path)
+            if cached is not None and cached.size == st.st_size and cached.mtime == st.st_mtime:
+                self._entries.move_to_end(path)
+                return cached
+        return None
+
+    def _hash(self, path, st):
+        # type: (str, os.stat_result) -> FileChecksum
+        digest = hashlib.new(self.algorithm)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(self.block_size), b''):
+                digest.update(block)
+
+        # VV: Record the size/mtime from *before* hashing, if the file changed while we were reading it the next
+        # call will notice the difference and hash it again
+        entry = FileChecksum(st.st_size, st.st_mtime, digest.hexdigest())
+
+        with self._lock:
+            self._entries[path] = entry
+            self._entries.move_to_end(path)
+            while len(self._entries) > max(1, self.max_entries):
+                self._entries.popitem(last=False)
+
+        return entry
+
+    def checksum(self, path):
+        # type: (str) -> FileChecksum
+        """Returns the FileChecksum of @path, hashes the file only if it changed since the last time"""
+        st = os.stat(path)
+        cached = self._lookup(path, st)
+        if cached is not None:
+            return cached
+        return self._hash(path, st)
+
+    def checksums(self, paths, max_bytes=None):
+        # type: (Iterable[str], Optional[int]) -> Dict[str, FileChecksum]
+        """Returns {path: FileChecksum} for @paths, files which cannot be read are left out
+
+        If @max_bytes is not None, files whose checksum is not cached (or is out of date) are hashed only while
+        the sum of their sizes fits in @max_bytes, the ones that do not fit are left out too. Cached checksums
+        do not count towards @max_bytes.
+        """
+        paths = list(paths)
+        ret = {}
+
+        def try_lookup(path):
+            # type: (str) -> Tuple[Optional[os.stat_result], Optional[FileChecksum]]
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                self.log.warning("Cannot compute checksum of %s: %s" % (path, e))
+                return None, None
+            return st, self._lookup(path, st)
+
+        def try_hash(args):
+            # type: (Tuple[str, os.stat_result]) -> Optional[FileChecksum]
+            path, st = args
+            try:
+                return self._hash(path, st)
+            except OSError as e:
+                self.log.warning("Cannot compute checksum of %s: %s" % (path, e))
+                return None
+
+        uncached = []
+        remaining = max_bytes
+        over_budget = 0
+        for path, (st, cached) in zip(paths, self._pool.map(try_lookup, paths)):
+            if st is None:
+                continue
+            if cached is not None:
+                ret[path] = cached
+                continue
+            if remaining is not None:
+                if st.st_size > remaining:
+                    over_budget += 1
+                    continue
+                remaining -= st.st_size
+            uncached.append((path, st))
+
+        if over_budget:
+            self.log.info("Did not hash %d files which do not fit in the budget of %s bytes" % (
+                over_budget, max_bytes))
+
+        for (path, _), entry in zip(uncached, self._pool.map(try_hash, uncached)):
+            if entry is not None:
+                ret[path] = entry
+
+        return ret
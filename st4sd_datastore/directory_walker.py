@@ -0,0 +1,201 @@
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+import collections
+import concurrent.futures
+import itertools
+import logging
+import os
+
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+# VV: How to treat symbolic links:
+#   follow: follow links to files and directories (each directory is visited at most once, so loops are harmless)
+#   files: follow links to files, links to directories are reported as entries but never walked into
+#   skip: ignore symbolic links
+SYMLINKS_FOLLOW = 'follow'
+SYMLINKS_FILES = 'files'
+SYMLINKS_SKIP = 'skip'
+SYMLINK_MODES = [SYMLINKS_FOLLOW, SYMLINKS_FILES, SYMLINKS_SKIP]
+
+
+class DirectoryWalker(object):
+    """Walks directory trees with os.scandir() so that listing a directory and telling files from directories
+    costs just the readdir() calls, files are stat()ed exactly once
+
+    Entries are produced in a deterministic order: the entries of a directory are sorted by name, and directories
+    are visited in pre-order (a directory, then each of its sub-directories in turn). When there is a thread @pool
+    the sub-directories of a directory are scanned ahead of time (at most @max_pending at a time) and walk() stat()s
+    up to @window files ahead of the one it returns. The order of the results is the same either way.
+
+    Arguments:
+        symlinks: One of SYMLINK_MODES
+        pool: Optional thread pool which scans directories and stat()s files in parallel
+        max_pending: Maximum number of directories that are scanned ahead of time
+        window: Maximum number of files that walk() stat()s ahead of time
+    """
+    def __init__(self, symlinks=SYMLINKS_FILES, pool=None, max_pending=64, window=256):
+        # type: (str, Optional[concurrent.futures.Executor], int, int) -> None
+        if symlinks not in SYMLINK_MODES:
+            raise ValueError("Unknown symlink mode \"%s\", expected one of %s" % (symlinks, SYMLINK_MODES))
+
+        self.symlinks = symlinks
+        self.pool = pool
+        self.max_pending = max(1, max_pending)
+        self.window = max(1, window)
+        self.log = logging.getLogger('DirectoryWalker')
+
+    def _is_dir(self, entry):
+        # type: (os.DirEntry) -> bool
+        """Returns True if the walk should descend into @entry"""
+        try:
+            if self.symlinks == SYMLINKS_FOLLOW:
+                return entry.is_dir()
+            return entry.is_dir(follow_symlinks=False)
+        except OSError:
+            return False
+
+    def scan(self, path, with_stats=False):
+        # type: (str, bool) -> Optional[List[Tuple[os.DirEntry, Optional[os.stat_result]]]]
+        """Returns the sorted [(DirEntry, stat or None)] of directory @path, None if @path cannot be listed
+
+        With @with_stats the entries are stat()ed (following symbolic links) and the ones which cannot be stat()ed
+        (e.g. broken links) are left out.
+        """
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            self.log.warning("Cannot list %s: %s" % (path, e))
+            return None
+
+        if self.symlinks == SYMLINKS_SKIP:
+            entries = [e for e in entries if not e.is_symlink()]
+
+        if with_stats is False:
+            return [(e, None) for e in entries]
+
+        ret = []
+        for e in entries:
+            try:
+                ret.append((e, e.stat()))
+            except OSError:
+                continue
+        return ret
+
+    def iter_dirs(self, root, with_stats=False):
+        # type: (str, bool) -> Iterator[Tuple[str, str, Optional[List[Tuple[os.DirEntry, Optional[os.stat_result]]]]]]
+        """Yields (path, path relative to @root, scan(path)) for @root and every directory under it
+
+        The relative path of @root is ''. Directories which cannot be listed are yielded with None in place of
+        their entries.
+        """
+        root = os.path.abspath(root)
+        pending = {}  # type: Dict[str, concurrent.futures.Future]
+        visited = set()  # type: Set[Tuple[int, int]]
+
+        if self.symlinks == SYMLINKS_FOLLOW:
+            try:
+                st = os.stat(root)
+                visited.add((st.st_dev, st.st_ino))
+            except OSError:
+                pass
+
+        def get(path):
+            future = pending.pop(path, None)
+            if future is not None:
+                return future.result()
+            return self.scan(path, with_stats)
+
+        stack = [(root, '')]
+
+        try:
+            while stack:
+                path, rel_path = stack.pop()
+                entries = get(path)
+                yield path, rel_path, entries
+
+                if not entries:
+                    continue
+
+                sub_dirs = []
+                for entry, _ in entries:
+                    if not self._is_dir(entry):
+                        continue
+
+                    if self.symlinks == SYMLINKS_FOLLOW:
+                        # VV: Links may point to a directory we have already walked (or to one of its parents)
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        key = (st.st_dev, st.st_ino)
+                        if key in visited:
+                            continue
+                        visited.add(key)
+
+                    sub_dirs.append((entry.path, os.path.join(rel_path, entry.name) if rel_path else entry.name))
+
+                if self.pool is not None:
+                    for sub, _ in sub_dirs:
+                        if len(pending) >= self.max_pending:
+                            break
+                        pending[sub] = self.pool.submit(self.scan, sub, with_stats)
+
+                stack.extend(reversed(sub_dirs))
+        finally:
+            for future in pending.values():
+                future.cancel()
+
+    def walk(self, root):
+        # type: (str) -> Iterator[Tuple[str, str, os.stat_result]]
+        """Yields (path, path relative to @root, stat) for every file under @root (i.e. everything but the
+        directories that the walk descends into and, unless symlinks is "follow", links to directories)"""
+        def iter_files():
+            for _, rel_path, entries in self.iter_dirs(root):
+                for entry, _ in entries or []:
+                    try:
+                        if entry.is_dir():
+                            continue
+                    except OSError:
+                        continue
+                    yield entry, os.path.join(rel_path, entry.name) if rel_path else entry.name
+
+        def stat(entries):
+            ret = []
+            for entry, rel_path in entries:
+                try:
+                    ret.append((entry.path, rel_path, entry.stat()))
+                except OSError:
+                    continue
+            return ret
+
+        if self.pool is None:
+            for entry in iter_files():
+                for ret in stat([entry]):
+                    yield ret
+            return
+
+        # VV: Each task stat()s a batch of files, a future per file costs more than a stat() on a local disk
+        batch_size = max(1, min(64, self.window // 4))
+        files = iter_files()
+        pending = collections.deque()
+
+        try:
+            while True:
+                while len(pending) * batch_size < self.window:
+                    batch = list(itertools.islice(files, batch_size))
+                    if not batch:
+                        break
+                    pending.append(self.pool.submit(stat, batch))
+
+                if not pending:
+                    break
+
+                for ret in pending.popleft().result():
+                    yield ret
+        finally:
+            for future in pending:
+                future.cancel()
+            files.close()
@@ -0,0 +1,226 @@
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+"""A durable, on-disk queue of document writes which are retried while the database is unavailable"""
+
+import logging
+import os
+import random
+import re
+import threading
+
+import bson.json_util
+import experiment.service.errors
+import pymongo.errors
+import requests.exceptions
+
+from typing import Any, Callable, Dict, List, Optional
+
+_pattern_entry = re.compile(r'^([0-9]+)\.json$')
+
+
+def is_transient_error(exc):
+    # type: (BaseException) -> bool
+    """Returns True if @exc means that the database (or the MongoDB proxy) is unavailable right now"""
+    if isinstance(exc, (pymongo.errors.ConnectionFailure, pymongo.errors.ExecutionTimeout,
+                        pymongo.errors.WTimeoutError)):
+        return True
+
+    if isinstance(exc, pymongo.errors.PyMongoError) and exc.has_error_label('RetryableWriteError'):
+        return True
+
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+
+    if isinstance(exc, experiment.service.errors.InvalidHTTPRequest) and exc.response is not None:
+        return exc.response.status_code in [429, 502, 503, 504]
+
+    return False
+
+
+class DocumentSpool(object):
+    """Writes documents to the database and spools them to disk when the database is unavailable
+
+    submit() calls @write right away while the spool is empty. If @write raises an exception for which
+    @is_transient returns True, the write is stored in @directory as MongoDB Extended JSON (and fsync()ed) instead. From then on
+    every write goes to the spool, so that writes are applied in the order they were submitted, till a background
+    thread drains the spool. The thread retries the oldest write with exponential backoff (starting at
+    @initial_backoff seconds and doubling up to @max_backoff seconds). After the database returns, it writes the
+    spooled documents back to back. Writes which fail with errors that are not transient are moved to
+    ${directory}/failed.
+
+    Spooled writes survive restarts, the spool picks them up when it is created and deletes the temporary files
+    of writes that were interrupted.
+
+    Arguments:
+        directory: Where to store spooled writes
+        write: Callable which receives (documents, instance URI to register with the gateway or None)
+        initial_backoff: Seconds to wait before the first retry
+        max_backoff: Maximum seconds between retries
+        is_transient: Callable which returns True for exceptions that mean the database is unavailable
+    """
+    def __init__(self, directory, write, initial_backoff=1.0, max_backoff=60.0, is_transient=is_transient_error):
+        # type: (str, Callable[[List[Dict[str, Any]], Optional[str]], None], float, float, Callable[[BaseException], bool]) -> None
+        self.directory = directory
+        self.dir_failed = os.path.join(directory, 'failed')
+        self.write = write
+        self.initial_backoff = max(0.01, initial_backoff)
+        self.max_backoff = max(self.initial_backoff, max_backoff)
+        self.is_transient = is_transient
+
+        self.log = logging.getLogger('DocumentSpool')
+
+        for d in [self.directory, self.dir_failed]:
+            if not os.path.exists(d):
+                os.makedirs(d)
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+        names = os.listdir(directory)
+        for name in names:
+            if name.endswith('.tmp'):
+                self.log.warning("Removing incomplete spooled write %s" % os.path.join(directory, name))
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError as e:
+                    self.log.warning("Could not remove %s: %s" % (os.path.join(directory, name), e))
+
+        # VV: Sequence numbers of spooled writes, in ascending order
+        self._entries = sorted(int(m.group(1)) for m in map(_pattern_entry.match, names) if m)
+        self._next = self._entries[-1] + 1 if self._entries else 0
+
+        if self._entries:
+            self.log.warning("Found %d spooled writes in %s" % (len(self._entries), directory))
+
+    def _entry_path(self, seq):
+        # type: (int) -> str
+        return os.path.join(self.directory, '%020d.json' % seq)
+
+    def _append(self, documents, register):
+        # type: (List[Dict[str, Any]], Optional[str]) -> None
+        """Durably stores a write at the end of the spool, expects the caller to hold the lock"""
+        seq = self._next
+        path = self._entry_path(seq)
+        tmp_path = path + '.tmp'
+
+        with open(tmp_path, 'w') as f:
+            f.write(bson.json_util.dumps({'documents': documents, 'register': register}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        self._next += 1
+        self._entries.append(seq)
+        self._wake.set()
+
+    def submit(self, documents, register=None):
+        # type: (List[Dict[str, Any]], Optional[str]) -> bool
+        """Writes @documents (and then registers the instance URI @register with the gateway, if not None)
+
+        Returns:
+            True if the documents were written to the database, False if they were spooled
+
+        Raises:
+            The exceptions of @write that are not transient (if the spool is empty)
+        """
+        with self._lock:
+            spooling = len(self._entries) > 0
+
+        if spooling is False:
+            try:
+                self.write(documents, register)
+                return True
+            except Exception as e:
+                if not self.is_transient(e):
+                    raise
+                self.log.warning("Database is unavailable (%s: %s) - will spool %d documents" % (
+                    type(e).__name__, e, len(documents)))
+
+        with self._lock:
+            self._append(documents, register)
+        return False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def drain_one(self):
+        # type: () -> Optional[bool]
+        """Writes the oldest spooled write to the database
+
+        Returns:
+            None if the spool is empty, True if the write is no longer spooled (it either succeeded or failed
+            with a non-transient error), False if the database is still unavailable
+        """
+        with self._lock:
+            if not self._entries:
+                return None
+            seq = self._entries[0]
+
+        path = self._entry_path(seq)
+        try:
+            with open(path, 'r') as f:
+                entry = bson.json_util.loads(f.read())
+            self.write(entry['documents'], entry['register'])
+        except Exception as e:
+            if self.is_transient(e):
+                self.log.info("Database is still unavailable (%s: %s)" % (type(e).__name__, e))
+                return False
+
+            self.log.critical("Could not write spooled entry %s, will move it to %s. EXCEPTION: %s" % (
+                path, self.dir_failed, e))
+            try:
+                os.replace(path, os.path.join(self.dir_failed, os.path.basename(path)))
+            except OSError:
+                pass
+        else:
+            os.remove(path)
+
+        with self._lock:
+            self._entries.remove(seq)
+        return True
+
+    def _loop(self):
+        backoff = self.initial_backoff
+
+        while self._stop.is_set() is False:
+            outcome = self.drain_one()
+
+            if outcome is None:
+                backoff = self.initial_backoff
+                self._wake.wait()
+                self._wake.clear()
+            elif outcome is False:
+                # VV: Add some jitter so that many reporters do not hit a recovering database all at once
+                delay = backoff * random.uniform(0.8, 1.2)
+                self.log.info("%d writes are spooled, will retry in %.1f seconds" % (len(self), delay))
+                self._stop.wait(delay)
+                backoff = min(backoff * 2, self.max_backoff)
+            else:
+                backoff = self.initial_backoff
+                if not len(self):
+                    self.log.warning("Drained the spool, writing to the database directly")
+
+    def start(self):
+        """Starts draining the spool in a background (daemon) thread"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='document-spool', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,121 @@
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+import logging
+import threading
+import time
+
+from typing import Dict, Iterable, Iterator, Optional
+
+
+class DownloadScheduler(object):
+    """Admission control for bulk downloads (archives, whole files)
+
+    At most @max_total bulk downloads run at the same time and each client may run at most @max_per_client of them.
+    Requests which do not fit are rejected right away instead of queueing, queueing would tie up a server thread
+    and the whole point is to keep threads free for small requests (single files, existence checks, /hello).
+    """
+    def __init__(self, max_total, max_per_client):
+        # type: (int, int) -> None
+        self.max_total = max_total
+        self.max_per_client = max_per_client
+
+        self._lock = threading.Lock()
+        self._active = {}  # type: Dict[str, int]
+        self._total = 0
+
+        self.log = logging.getLogger('DownloadScheduler')
+
+    def acquire(self, client):
+        # type: (str) -> bool
+        """Reserves a slot for @client, returns False if the global or the per-client limit is reached"""
+        with self._lock:
+            if self._total >= self.max_total:
+                self.log.info("Rejecting download of %s - %d downloads in flight" % (client, self._total))
+                return False
+
+            if self._active.get(client, 0) >= self.max_per_client:
+                self.log.info("Rejecting download of %s - client has %d downloads in flight" % (
+                    client, self._active[client]))
+                return False
+
+            self._active[client] = self._active.get(client, 0) + 1
+            self._total += 1
+            return True
+
+    def release(self, client):
+        # type: (str) -> None
+        with self._lock:
+            count = self._active.get(client, 0)
+            if count <= 0:
+                self.log.warning("Client %s released a slot it did not hold" % client)
+                return
+
+            if count == 1:
+                del self._active[client]
+            else:
+                self._active[client] = count - 1
+            self._total -= 1
+
+    def in_flight(self, client=None):
+        # type: (Optional[str]) -> int
+        with self._lock:
+            if client is None:
+                return self._total
+            return self._active.get(client, 0)
+
+
+class TokenBucket(object):
+    """A token bucket which refills at @rate tokens (bytes) per second and holds at most @burst tokens"""
+    def __init__(self, rate, burst=None):
+        # type: (float, Optional[float]) -> None
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def consume(self, amount):
+        # type: (int) -> None
+        """Blocks until @amount tokens are available and then removes them from the bucket
+
+        Amounts larger than @burst are allowed, the bucket just goes into debt and the next calls wait longer.
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+        self._tokens -= amount
+        if self._tokens < 0:
+            time.sleep(-self._tokens / self.rate)
+
+
+class Throttled(object):
+    """Yields the bytes of @chunks at no more than @rate bytes per second on average
+
+    close() closes @chunks even if the iteration never started (e.g. responses to HEAD requests).
+    """
+    def __init__(self, chunks, rate, burst=None):
+        # type: (Iterable[bytes], float, Optional[float]) -> None
+        self.chunks = chunks
+        self.rate = rate
+        self.burst = burst
+
+    def __iter__(self):
+        # type: () -> Iterator[bytes]
+        bucket = TokenBucket(self.rate, self.burst)
+
+        for chunk in self.chunks:
+            bucket.consume(len(chunk))
+            yield chunk
+
+    def close(self):
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def throttle(chunks, rate, burst=None):
+    # type: (Iterable[bytes], float, Optional[float]) -> Throttled
+    """Yields @chunks at no more than @rate bytes per second on average"""
+    return Throttled(chunks, rate, burst)
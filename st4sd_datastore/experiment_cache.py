@@ -0,0 +1,155 @@
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+"""An LRU cache of loaded experiment instances"""
+
+import collections
+import logging
+import os
+import threading
+
+import experiment.model.conf
+import experiment.model.data
+import experiment.model.storage
+
+from typing import Callable, Dict, Optional, Tuple
+
+Signature = Tuple[Tuple[str, int, int], ...]
+
+
+def load_experiment(location, platform):
+    # type: (str, Optional[str]) -> experiment.model.data.Experiment
+    """Loads the experiment instance at @location without modifying it"""
+    # VV: Prioritize reading the FlowIR flavour of the experiment - other flavours e.g. DOSINI may
+    # not contain the name of the platform. This will cause experiment.model.data.Experiment()
+    # to consider that the experiment instance is invalid (as it does not contain the requested platform).
+    other_formats = [x for x in experiment.model.conf.ExperimentConfigurationFactory.default_priority
+                     if x != 'flowir']
+    expDir = experiment.model.storage.ExperimentInstanceDirectory(location, attempt_shadowdir_repair=False)
+    return experiment.model.data.Experiment(
+        expDir, platform=platform, updateInstanceConfiguration=False, is_instance=True,
+        format_priority=['flowir'] + other_formats)
+
+
+def configuration_signature(location):
+    # type: (str) -> Signature
+    """Returns the sorted ((path, st_mtime_ns, st_size), ...) of the files under ${location}/conf"""
+    conf_dir = os.path.join(location, 'conf')
+    ret = []
+
+    for root, dirs, files in os.walk(conf_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            ret.append((os.path.relpath(path, conf_dir), st.st_mtime_ns, st.st_size))
+
+    return tuple(sorted(ret))
+
+
+class ExperimentCache(object):
+    """Keeps up to @max_size loaded experiment instances so that they are not parsed again for every update
+
+    Entries are keyed on (location, platform). An entry is used only if the files in the conf directory of the
+    instance have the same modification times and sizes as when the instance was loaded, otherwise the instance
+    is loaded again. The runtime keeps updating output/status.txt while the experiment runs, instead of
+    reloading the experiment the cache just re-reads its status file when the file changes.
+
+    Arguments:
+        max_size: Maximum number of experiment instances to keep, 0 disables caching
+        loader: Callable which receives (location, platform) and returns the experiment.model.data.Experiment
+    """
+    def __init__(self, max_size=32, loader=load_experiment):
+        # type: (int, Callable[[str, Optional[str]], experiment.model.data.Experiment]) -> None
+        self.max_size = max(0, max_size)
+        self.loader = loader
+
+        self._lock = threading.Lock()
+        # VV: (location, platform) -> (experiment, signature of configuration, (st_mtime_ns, st_size) of status.txt)
+        self._entries = collections.OrderedDict()  # type: Dict[Tuple[str, Optional[str]], Tuple[experiment.model.data.Experiment, Signature, Optional[Tuple[int, int]]]]
+
+        self.hits = 0
+        self.misses = 0
+        self.log = logging.getLogger('ExperimentCache')
+
+    @classmethod
+    def _status_signature(cls, exp):
+        # type: (experiment.model.data.Experiment) -> Optional[Tuple[int, int]]
+        try:
+            st = os.stat(os.path.join(exp.instanceDirectory.absoluteOutputDirectory, 'status.txt'))
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _refresh_status(self, exp, status_signature):
+        # type: (experiment.model.data.Experiment, Optional[Tuple[int, int]]) -> Optional[Tuple[int, int]]
+        """Re-reads the status file of @exp if it changed since @status_signature, returns its new signature
+
+        Expects the caller to not hold the lock.
+        """
+        current = self._status_signature(exp)
+        if current is None or current == status_signature:
+            return current
+
+        path = os.path.join(exp.instanceDirectory.absoluteOutputDirectory, 'status.txt')
+        try:
+            if exp.statusFile is None:
+                raise ValueError("the experiment has no status object")
+            # VV: Experiment reads the status file just once, when it is constructed - update its Status in place
+            exp.statusFile.data = experiment.model.data.Status.statusFromFile(path).data
+        except Exception as e:
+            self.log.warning("Could not re-read %s: %s - will keep using the old status" % (path, e))
+            return status_signature
+
+        return current
+
+    def get(self, location, platform):
+        # type: (str, Optional[str]) -> experiment.model.data.Experiment
+        """Returns the experiment instance at @location, raises the exceptions of the loader"""
+        key = (location, platform)
+        signature = configuration_signature(location)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                entry = None
+                self._entries.pop(key, None)
+                self.misses += 1
+
+        if entry is not None:
+            # VV: Read the status file without holding the lock so that other threads are not blocked on the I/O
+            exp, _, status_signature = entry
+            new_status_signature = self._refresh_status(exp, status_signature)
+            if new_status_signature != status_signature:
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        self._entries[key] = (exp, signature, new_status_signature)
+            return exp
+
+        exp = self.loader(location, platform)
+
+        if self.max_size > 0:
+            with self._lock:
+                self._entries[key] = (exp, signature, self._status_signature(exp))
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+        return exp
+
+    def evict(self, location):
+        # type: (str) -> None
+        """Forgets all entries for the experiment instance at @location"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == location]:
+                del self._entries[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -4,37 +4,329 @@
 # Author: Vassilis Vassiliadis
 
 import os
+import struct
+import sys
 import threading
 import json
 import logging
 from six import string_types
 
 try:
-    from typing import Dict, List, Set
+    from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 except ImportError:
     pass
 
 
+class PathSet(object):
+    """A set of normalized absolute paths stored as a trie of interned path components
+
+    Experiment instances share a handful of long parent directories (e.g. /tmp/workdir/<namespace>) and every
+    component of those directories is kept in memory just once, no matter how many instances live under them.
+    Each node of the trie is a dictionary {component: child}. A child is None if the path that ends at it is in
+    the set and there are no paths under it, otherwise it is a node whose _terminal key marks whether the path
+    that ends at the node is in the set.
+    """
+    _magic = b'ST4SDREG'
+    _version = 2
+    _header = struct.Struct('<8sI')
+    _uint = struct.Struct('<I')
+
+    # VV: Normalized paths never contain empty components, so the empty string can mark paths which are in the set
+    _terminal = ''
+
+    def __init__(self, paths=None):
+        # type: (Iterable[str]) -> None
+        self._root = {}  # type: Dict[str, Optional[Dict]]
+        self._len = 0
+
+        for p in paths or []:
+            self.add(p)
+
+    @classmethod
+    def _split(cls, path):
+        # type: (str) -> List[str]
+        return [x for x in path.split('/') if x]
+
+    def _find(self, path):
+        # type: (str) -> Tuple[bool, Optional[Dict]]
+        """Returns (whether @path is in the trie, the node of @path or None if it has no node)"""
+        node = self._root
+        components = self._split(path)
+
+        for name in components[:-1]:
+            node = node.get(name)
+            if node is None:
+                return False, None
+
+        if not components:
+            return self._terminal in node, node
+
+        if components[-1] not in node:
+            return False, None
+
+        child = node[components[-1]]
+        return child is None or self._terminal in child, child
+
+    def add(self, path):
+        # type: (str) -> bool
+        """Adds the normalized absolute @path, returns False if it was already in the set"""
+        node = self._root
+        components = self._split(path)
+
+        for name in components[:-1]:
+            child = node.get(name)
+            if child is None:
+                # VV: Either a new directory, or a path in the set (a leaf) which now gets paths under it
+                child = {self._terminal: True} if name in node else {}
+                node[sys.intern(name)] = child
+            node = child
+
+        if components:
+            name = components[-1]
+            if name not in node:
+                node[sys.intern(name)] = None
+                self._len += 1
+                return True
+            node = node[name]
+            if node is None:
+                return False
+
+        if self._terminal in node:
+            return False
+
+        node[self._terminal] = True
+        self._len += 1
+        return True
+
+    def remove(self, path):
+        # type: (str) -> None
+        """Removes @path, raises KeyError if it is not in the set"""
+        components = self._split(path)
+        parents = []
+        node = self._root
+
+        for name in components[:-1]:
+            parents.append((node, name))
+            node = node.get(name)
+            if node is None:
+                raise KeyError(path)
+
+        if components:
+            name = components[-1]
+            if name not in node:
+                raise KeyError(path)
+            if node[name] is None:
+                # VV: A leaf, there are no paths under it
+                del node[name]
+                node = None
+            else:
+                parents.append((node, name))
+                node = node[name]
+
+        if node is not None:
+            if self._terminal not in node:
+                raise KeyError(path)
+            del node[self._terminal]
+
+        self._len -= 1
+
+        # VV: Drop the nodes which no longer lead to any path
+        for parent, name in reversed(parents):
+            if parent[name] == {}:
+                del parent[name]
+            else:
+                break
+
+    def __contains__(self, path):
+        # type: (str) -> bool
+        return self._find(path)[0]
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        # type: () -> Iterator[str]
+        stack = [('', self._root)]
+
+        while stack:
+            prefix, node = stack.pop()
+            if node is None:
+                yield prefix
+                continue
+
+            if self._terminal in node:
+                yield prefix or '/'
+
+            for name, child in node.items():
+                if name != self._terminal:
+                    stack.append(('/'.join((prefix, name)), child))
+
+    def to_bytes(self):
+        # type: () -> bytes
+        """Serializes the set into: header, then the nodes of the trie in pre-order. A node is the number of its
+        entries followed by each entry: the utf-8 encoded component (prefixed by its length), and a flag byte which
+        is 1 if the entry is a node (which follows right after) or 0 if it is a leaf. The _terminal key of a node is
+        a leaf entry with an empty component"""
+        parts = [self._header.pack(self._magic, self._version)]
+        stack = [self._root]
+
+        while stack:
+            node = stack.pop()
+            parts.append(self._uint.pack(len(node)))
+            children = []
+
+            for name, child in node.items():
+                name = name.encode('utf-8')
+                is_node = isinstance(child, dict)
+                parts.extend((self._uint.pack(len(name)), name, b'\x01' if is_node else b'\x00'))
+                if is_node:
+                    children.append(child)
+
+            # VV: Children are serialized in the order of their entries
+            stack.extend(reversed(children))
+
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, buf):
+        # type: (bytes) -> PathSet
+        """The inverse of to_bytes(), raises ValueError if @buf is not a valid snapshot
+
+        Also reads version 1 snapshots: the number of parent directories, then for each parent its path, the
+        number of its names and the names joined with NUL (each variable length field is prefixed by its length).
+        """
+        try:
+            magic, version = cls._header.unpack_from(buf, 0)
+        except struct.error:
+            raise ValueError("Snapshot is too short")
+
+        if magic != cls._magic or version not in (1, cls._version):
+            raise ValueError("Unknown snapshot format %s version %s" % (magic, version))
+
+        ret = cls()
+        offset = cls._header.size
+        view = memoryview(buf)
+
+        def read_string():
+            nonlocal offset
+            size, = cls._uint.unpack_from(buf, offset)
+            offset += cls._uint.size
+            if offset + size > len(buf):
+                raise ValueError("Corrupted snapshot: string is past the end of the snapshot")
+            value = bytes(view[offset:offset + size]).decode('utf-8')
+            offset += size
+            return value
+
+        try:
+            if version == 1:
+                num_parents, = cls._uint.unpack_from(buf, offset)
+                offset += cls._uint.size
+
+                for _ in range(num_parents):
+                    parent = read_string()
+                    for name in read_string().split('\0'):
+                        ret.add('/'.join((parent, name)))
+            else:
+                # VV: Nodes whose entries have not been read yet
+                pending = [ret._root]
+                while pending:
+                    node = pending.pop()
+                    num_entries, = cls._uint.unpack_from(buf, offset)
+                    offset += cls._uint.size
+                    children = []
+
+                    for _ in range(num_entries):
+                        name = read_string()
+                        is_node = buf[offset]
+                        offset += 1
+
+                        if not name:
+                            node[cls._terminal] = True
+                            ret._len += 1
+                        elif is_node:
+                            child = node[sys.intern(name)] = {}
+                            children.append(child)
+                        else:
+                            node[name] = None
+                            ret._len += 1
+
+                    pending.extend(reversed(children))
+        except (struct.error, UnicodeDecodeError, IndexError) as e:
+            raise ValueError("Corrupted snapshot: %s" % e)
+
+        if offset != len(buf):
+            raise ValueError("Corrupted snapshot: %d trailing bytes" % (len(buf) - offset))
+
+        return ret
+
+
 class ExperimentRegistry(object):
-    def __init__(self):
+    """The experiment instances that a gateway serves, persisted in a binary snapshot (see PathSet)
+
+    Older versions stored the registry as a JSON list of paths. load() reads that list if there is no snapshot (or
+    the list is newer than the snapshot, i.e. an older version updated it). store() writes the list only if
+    @legacy_json is True, otherwise call export_json() before rolling back to an older version.
+    """
+    def __init__(self, legacy_json=False):
+        # type: (bool) -> None
         self._lock = threading.RLock()
-        self._experiments = set()  # type: Set[str]
+        self._experiments = PathSet()  # type: PathSet
         self.log = logging.getLogger('ExperimentRegistry')
+        self.legacy_json = legacy_json
 
         self._cache_location = 'cache_gateway.json'
+        self._snapshot_location = 'cache_gateway.bin'
 
         self.load()
 
-    def store(self):
+    @classmethod
+    def _write_durably(cls, location, buf):
+        # type: (str, bytes) -> None
+        """Replaces the contents of @location with @buf, readers see either the old or the new contents"""
+        tmp_location = '%s.tmp' % location
+        with open(tmp_location, 'wb') as f:
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_location, location)
+
+        fd = os.open(os.path.dirname(os.path.abspath(location)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def export_json(self):
+        """Writes the registry to the JSON list that older versions read"""
         with self._lock:
-            store_dict = list(self._experiments)
-            with open(self._cache_location, 'w') as f:
-                json.dump(store_dict, f, indent=2)
+            self._write_durably(self._cache_location,
+                                json.dumps(list(self._experiments), indent=2).encode('utf-8'))
 
-        del store_dict
+    def store(self):
+        with self._lock:
+            if self.legacy_json:
+                self.export_json()
+            # VV: The snapshot goes last so that it is never older than the JSON list, see load()
+            self._write_durably(self._snapshot_location, self._experiments.to_bytes())
 
     def load(self):
         with self._lock:
+            # VV: An older version of the gateway may have updated just the JSON list after the last snapshot
+            if os.path.exists(self._snapshot_location) and not (
+                    os.path.exists(self._cache_location) and
+                    os.path.getmtime(self._cache_location) > os.path.getmtime(self._snapshot_location)):
+                try:
+                    with open(self._snapshot_location, 'rb') as f:
+                        self._experiments = PathSet.from_bytes(f.read())
+                except ValueError as e:
+                    self.log.critical("Could not load snapshot %s: %s - will try %s instead" % (
+                        self._snapshot_location, e, self._cache_location))
+                else:
+                    self.log.critical("Loaded %s experiments" % (
+                        len(self._experiments)
+                    ))
+                    return
+
             if os.path.exists(self._cache_location):
                 with open(self._cache_location, 'r') as f:
                     load_dict = json.load(f)
@@ -44,10 +336,12 @@ class ExperimentRegistry(object):
                     invalid_entries = [d for d in load_dict if not isinstance(d, string_types)]
 
                     if is_valid_cache and not invalid_entries:
-                        self._experiments = set(map(os.path.abspath, load_dict))
+                        self._experiments = PathSet(map(os.path.abspath, load_dict))
                         self.log.critical("Loaded %s experiments" % (
                             len(self._experiments)
                         ))
+                        # VV: Convert the JSON cache into a snapshot so that the next start is fast
+                        self.store()
                     else:
                         self.log.critical("%s does not contain list of strings (paths to experiment locations), "
                                           "will not load cached information. "
@@ -66,6 +360,24 @@ class ExperimentRegistry(object):
             self._experiments.add(experiment_root)
             self.store()
 
+    def register_many(self, experiment_roots):
+        # type: (Iterable[str]) -> List[str]
+        """Registers multiple experiment instances and stores the registry just once, returns the (absolute) paths
+        of the instances which were not registered before"""
+        experiment_roots = list(experiment_roots)
+
+        for experiment_root in experiment_roots:
+            if experiment_root.startswith('file://') is True:
+                raise ValueError("Experiment root is expected to be an absolute path to an "
+                                 "experiment instance, received \"%s\"" % experiment_root)
+
+        with self._lock:
+            added = [x for x in map(os.path.abspath, experiment_roots) if self._experiments.add(x)]
+            if added:
+                self.store()
+
+        return added
+
     def delete(self, experiment_root):
         if experiment_root.startswith('file://') is True:
             raise ValueError("Experiment root is expected to be an absolute path to an "
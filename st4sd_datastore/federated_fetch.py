@@ -0,0 +1,211 @@
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+"""Fetches files from many cluster gateways at the same time and merges them into a single archive"""
+
+import concurrent.futures
+import datetime
+import json
+import logging
+import stat
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+
+import requests
+import requests.adapters
+
+from st4sd_datastore import archive_formats
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+REPORT_NAME = 'federation-report.json'
+
+
+def gateway_of_instance(instance_uri):
+    # type: (str) -> str
+    """Returns the $GATEWAY_ID of file://$GATEWAY_ID/$INSTANCE_LOCATION ('' if there is none)"""
+    if instance_uri.startswith('file://') is False:
+        raise ValueError("Expected a file:// URI but got \"%s\"" % instance_uri)
+    return urllib.parse.urlsplit(instance_uri).netloc
+
+
+class FederatedFetcher(object):
+    """Downloads the files of instances that live on different gateways in parallel and merges them
+
+    Each gateway receives one POST /files/api/v1.1 request with the selections of its instances. Gateways are
+    contacted concurrently over a pool of keep-alive connections and their archives are spooled (in memory up to
+    @spool_memory bytes, then on disk). The merged archive starts streaming as soon as the first gateway finishes
+    and includes the archives of the others in the order they finish, so the total time is close to the time
+    of the slowest gateway. Members are renamed to $GATEWAY_ID/$PATH, members with ".." components or backslashes
+    are skipped. The last member is a JSON report (REPORT_NAME) with the outcome of each gateway and the names of
+    the members it skipped.
+
+    Arguments:
+        resolve: Callable which receives a list of gateway ids and returns {unique_id: {"host": str, ...}}
+        is_healthy: Optional callable which returns False for gateway ids that should not be contacted
+        workers: Maximum number of gateways to download from at the same time
+        connect_timeout: Seconds to wait for a connection to a gateway
+        read_timeout: Seconds to wait for each read from a gateway
+        spool_memory: Bytes of each gateway archive to keep in memory before spilling to disk
+        verify_tls: Whether to verify the TLS certificates of gateways
+    """
+    def __init__(self, resolve, is_healthy=None, workers=16, connect_timeout=10.0, read_timeout=300.0,
+                 spool_memory=64 * 1024 * 1024, verify_tls=True):
+        # type: (Callable[[List[str]], Dict[str, Dict[str, Any]]], Optional[Callable[[str], bool]], int, float, float, int, bool) -> None
+        self.resolve = resolve
+        self.is_healthy = is_healthy
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.spool_memory = spool_memory
+        self.verify_tls = verify_tls
+
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='federated')
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max(1, workers), pool_maxsize=max(1, workers))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self.log = logging.getLogger('FederatedFetcher')
+
+    def partition(self, data):
+        # type: (Dict[str, Any]) -> Dict[str, Dict[str, Any]]
+        """Groups the selections in @data ({instanceURI: selection}) by the gateway id of the instance"""
+        ret = {}  # type: Dict[str, Dict[str, Any]]
+        for instance_uri, selection in data.items():
+            ret.setdefault(gateway_of_instance(instance_uri), {})[instance_uri] = selection
+        return ret
+
+    def download(self, host, selections, cancelled):
+        # type: (str, Dict[str, Any], threading.Event) -> tempfile.SpooledTemporaryFile
+        """POSTs @selections to ${host}/files/api/v1.1 and returns the spooled zip archive that it replies with"""
+        url = '/'.join((host.rstrip('/'), 'files/api/v1.1'))
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_memory)
+
+        try:
+            with self._session.post(url, json=selections, stream=True, verify=self.verify_tls,
+                                    timeout=(self.connect_timeout, self.read_timeout)) as resp:
+                if resp.status_code != 200:
+                    raise ValueError("%s replied with HTTP %d: %s" % (url, resp.status_code, resp.text[:200]))
+
+                for chunk in resp.iter_content(chunk_size=256 * 1024):
+                    if cancelled.is_set():
+                        raise ValueError("Cancelled")
+                    spool.write(chunk)
+        except BaseException:
+            spool.close()
+            raise
+
+        spool.seek(0)
+        return spool
+
+    @classmethod
+    def safe_member_name(cls, name):
+        # type: (str) -> Optional[str]
+        """Returns @name relative to the root of the archive without empty and "." components, None if it contains
+        ".." components or backslashes
+
+        Cluster gateways name members after their absolute paths so a leading "/" is stripped, not rejected.
+        """
+        if '\\' in name:
+            return None
+
+        parts = [p for p in name.split('/') if p not in ['', '.']]
+        if not parts or '..' in parts:
+            return None
+        return '/'.join(parts)
+
+    @classmethod
+    def iter_zip_members(cls, spool, prefix, rejected=None):
+        # type: (tempfile.SpooledTemporaryFile, str, Optional[List[str]]) -> Iterator[archive_formats.Member]
+        """Yields the files in the zip archive @spool as archive members whose names start with @prefix
+
+        Members whose names contain ".." components or backslashes (see safe_member_name()) are skipped and their
+        names are appended to @rejected (if not None). All members are yielded as regular files.
+        """
+        with zipfile.ZipFile(spool) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+
+                safe_name = cls.safe_member_name(info.filename)
+                if safe_name is None:
+                    if rejected is not None:
+                        rejected.append(info.filename)
+                    continue
+
+                def chunks(info=info):
+                    with zf.open(info) as f:
+                        for chunk in iter(lambda: f.read(256 * 1024), b''):
+                            yield chunk
+
+                # VV: Keep just the permissions so that a gateway cannot smuggle in e.g. symbolic links
+                file_mode = stat.S_IFREG | (stat.S_IMODE(info.external_attr >> 16) or 0o644)
+                name = '/'.join((prefix, safe_name))
+                yield name, datetime.datetime(*info.date_time), file_mode, info.file_size, chunks()
+
+    def iter_members(self, data):
+        # type: (Dict[str, Any]) -> Iterator[archive_formats.Member]
+        """Fetches the files in @data ({instanceURI: selection}, see /files/api/v1.1 of cluster_gateway) from
+        their gateways and yields them as archive members, followed by the report"""
+        per_gateway = self.partition(data)
+        gateways = self.resolve(list(per_gateway))
+        report = {}  # type: Dict[str, Dict[str, Any]]
+        cancelled = threading.Event()
+        futures = {}  # type: Dict[concurrent.futures.Future, Tuple[str, float]]
+
+        for gateway_id, selections in per_gateway.items():
+            if gateway_id not in gateways:
+                report[gateway_id] = {'status': 'unknown', 'error': 'Gateway is not in the registry', 'files': 0}
+            elif self.is_healthy is not None and self.is_healthy(gateway_id) is False:
+                report[gateway_id] = {'status': 'unhealthy', 'error': 'Gateway is unhealthy', 'files': 0}
+            else:
+                future = self._pool.submit(self.download, gateways[gateway_id]['host'], selections, cancelled)
+                futures[future] = (gateway_id, time.time())
+
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                gateway_id, started = futures[future]
+                try:
+                    spool = future.result()
+                except Exception as e:
+                    self.log.warning("Could not fetch files from %s: %s" % (gateway_id, e))
+                    report[gateway_id] = {'status': 'failed', 'error': str(e), 'files': 0,
+                                          'seconds': time.time() - started}
+                    continue
+
+                files = 0
+                rejected = []  # type: List[str]
+                try:
+                    for member in self.iter_zip_members(spool, gateway_id, rejected):
+                        files += 1
+                        yield member
+                    if files == 0 and rejected:
+                        # VV: Do not report an archive whose members were all skipped as a success
+                        report[gateway_id] = {'status': 'failed', 'error': 'All %d members have unsafe names' % len(
+                            rejected), 'files': 0, 'seconds': time.time() - started, 'rejected': rejected}
+                    else:
+                        report[gateway_id] = {'status': 'ok', 'error': None, 'files': files,
+                                              'seconds': time.time() - started, 'rejected': rejected}
+                except zipfile.BadZipFile as e:
+                    report[gateway_id] = {'status': 'failed', 'error': 'Invalid archive: %s' % e, 'files': files,
+                                          'seconds': time.time() - started, 'rejected': rejected}
+                finally:
+                    if rejected:
+                        self.log.warning("Skipped %d members with unsafe names from %s" % (len(rejected), gateway_id))
+                    spool.close()
+        finally:
+            cancelled.set()
+            for future in futures:
+                if future.cancel() is False and future.done() and future.exception() is None:
+                    future.result().close()
+
+        contents = json.dumps(report, indent=2).encode('utf-8')
+        yield REPORT_NAME, datetime.datetime.now(), stat.S_IFREG | 0o644, len(contents), iter([contents])
+
+    def stream(self, data, archive_format=archive_formats.FORMAT_ZIP, level=None):
+        # type: (Dict[str, Any], str, Optional[int]) -> Iterator[bytes]
+        return archive_formats.stream_archive(self.iter_members(data), archive_format, level)
@@ -0,0 +1,375 @@
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+import collections
+import logging
+import os
+import re
+import stat
+import threading
+import time
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from st4sd_datastore.directory_walker import DirectoryWalker, SYMLINKS_FILES
+
+FileInfo = collections.namedtuple('FileInfo', ['size', 'mtime', 'mode'])
+
+
+def glob_to_regex(pattern):
+    # type: (str) -> re.Pattern
+    """Compiles a glob @pattern into a regular expression that matches relative paths
+
+    "*" and "?" do not match "/", "[...]" and "[!...]" are character classes and "**" matches any number of
+    directories, e.g. "stages/**/*.csv" matches both "stages/a.csv" and "stages/stage0/A/a.csv"
+    """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            # VV: Same as fnmatch: only "!" negates the class, a leading "^" (or "[") is a literal character
+            body = re.sub(r'([&~|])', r'\\\1', pattern[i + 1:end].replace('\\', '\\\\'))
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            elif body.startswith(('^', '[')):
+                body = '\\' + body
+            parts.append('[%s]' % body)
+            i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+
+    return re.compile('(?s:%s)\\Z' % ''.join(parts))
+
+
+def file_matches(info, min_size=None, max_size=None, modified_after=None, modified_before=None):
+    # type: (FileInfo, Optional[int], Optional[int], Optional[float], Optional[float]) -> bool
+    """Returns True if @info satisfies all the filters that are not None (see SELECTION_FILTERS in file_selection)"""
+    if min_size is not None and info.size < min_size:
+        return False
+    if max_size is not None and info.size > max_size:
+        return False
+    if modified_after is not None and info.mtime <= modified_after:
+        return False
+    if modified_before is not None and info.mtime >= modified_before:
+        return False
+    return True
+
+
+class FileManifest(object):
+    """An index path -> FileInfo(size, mtime, mode) of all files and directories under an experiment instance
+
+    The index is built once with os.scandir() and then refreshed incrementally: a refresh stats the known
+    directories and only rescans those whose mtime changed. Refreshes happen at most once every @ttl seconds.
+    Files which are modified in place do not bump the mtime of their parent directory, therefore the manifest
+    is fully rebuilt once it is older than @max_age seconds.
+
+    The manifest remembers when it noticed that files were created, modified, or deleted. changes() uses these
+    records to report what changed after a point in time without walking the instance directory.
+
+    Full rebuilds use @walker (a DirectoryWalker with the "files" symlink mode), give it a thread pool to scan
+    sub-directories in parallel.
+    """
+    def __init__(self, root, ttl=5.0, max_age=300.0, walker=None):
+        # type: (str, float, float, Optional[DirectoryWalker]) -> None
+        self.root = os.path.abspath(root)
+        self.ttl = ttl
+        self.max_age = max_age
+        self.walker = walker or DirectoryWalker(symlinks=SYMLINKS_FILES)
+
+        self._lock = threading.RLock()
+        self._entries = {}  # type: Dict[str, FileInfo]
+        self._children = {}  # type: Dict[str, List[str]]
+        self._built_at = None  # type: Optional[float]
+        self._checked_at = None  # type: Optional[float]
+
+        # VV: path -> time the manifest noticed that the file was created or modified, ordered by time
+        self._changed = collections.OrderedDict()  # type: Dict[str, float]
+        # VV: path -> (time the manifest noticed the deletion, whether path was a directory), ordered by time
+        self._deleted = collections.OrderedDict()  # type: Dict[str, Tuple[float, bool]]
+        # VV: The manifest knows about the changes which happened after this time (None till the first build)
+        self._history_since = None  # type: Optional[float]
+
+        self.log = logging.getLogger('FileManifest')
+
+    def _record_deletion(self, path, info):
+        # type: (str, FileInfo) -> None
+        self._deleted[path] = (time.time(), stat.S_ISDIR(info.mode))
+        self._deleted.move_to_end(path)
+
+    def _record_change(self, path, info, old_info):
+        # type: (str, FileInfo, Optional[FileInfo]) -> None
+        """Records that file @path changed if its FileInfo is not @old_info, the first build records nothing"""
+        if self._history_since is None or info == old_info or stat.S_ISDIR(info.mode):
+            return
+        self._changed[path] = time.time()
+        self._changed.move_to_end(path)
+
+    def _set_entry(self, path, info):
+        # type: (str, FileInfo) -> Optional[FileInfo]
+        """Updates the FileInfo of @path and returns the old one"""
+        old_info = self._entries.get(path)
+        self._entries[path] = info
+        self._record_change(path, info, old_info)
+        return old_info
+
+    def _forget(self, path):
+        # type: (str) -> None
+        """Removes @path, and everything under it, from the index"""
+        info = self._entries.pop(path, None)
+        if info is not None:
+            self._record_deletion(path, info)
+        for name in self._children.pop(path, []):
+            self._forget(os.path.join(path, name))
+
+    def _trim_history(self):
+        """Discards the oldest records of changed and deleted paths so that they do not grow without bound"""
+        limit = len(self._entries) + 1024
+        while len(self._changed) > limit:
+            _, when = self._changed.popitem(last=False)
+            self._history_since = max(self._history_since, when)
+        while len(self._deleted) > limit:
+            _, (when, _) = self._deleted.popitem(last=False)
+            self._history_since = max(self._history_since, when)
+
+    def _scan_dir(self, path):
+        # type: (str) -> None
+        """Rescans the contents of directory @path and recursively scans any sub-directories it did not know of
+
+        Sub-directories which are already indexed are left alone, refresh() checks their mtime separately.
+        """
+        old_children = set(self._children.get(path, []))
+        children = []
+        new_dirs = []
+
+        try:
+            it = os.scandir(path)
+        except OSError:
+            self._forget(path)
+            return
+
+        with it:
+            for entry in it:
+                full = os.path.join(path, entry.name)
+                try:
+                    # VV: Follow symbolic links (just like os.path.exists() does) but do not recurse into
+                    # symbolic links to directories so that we never walk outside the instance or loop
+                    st = entry.stat()
+                    is_link = entry.is_symlink()
+                except OSError:
+                    continue
+
+                children.append(entry.name)
+                old_info = self._set_entry(full, FileInfo(st.st_size, st.st_mtime, st.st_mode))
+
+                if stat.S_ISDIR(st.st_mode) and not is_link:
+                    if old_info is None or not stat.S_ISDIR(old_info.mode) or full not in self._children:
+                        self._forget_children(full)
+                        new_dirs.append(full)
+                elif old_info is not None and stat.S_ISDIR(old_info.mode):
+                    self._forget_children(full)
+
+        for name in old_children.difference(children):
+            self._forget(os.path.join(path, name))
+
+        self._children[path] = children
+
+        for sub in new_dirs:
+            self._scan_dir(sub)
+
+    def _walk(self):
+        """Indexes everything under the root directory from scratch"""
+        for path, _, entries in self.walker.iter_dirs(self.root, with_stats=True):
+            if entries is None:
+                self._entries.pop(path, None)
+                continue
+
+            self._children[path] = [entry.name for entry, _ in entries]
+            for entry, st in entries:
+                self._entries[entry.path] = FileInfo(st.st_size, st.st_mtime, st.st_mode)
+
+    def _forget_children(self, path):
+        # type: (str) -> None
+        for name in self._children.pop(path, []):
+            self._forget(os.path.join(path, name))
+
+    def rebuild(self):
+        """Walks the entire instance directory from scratch and records the paths that no longer exist"""
+        with self._lock:
+            started = time.time()
+            old_entries = self._entries
+            self._entries = {}
+            self._children = {}
+
+            try:
+                st = os.stat(self.root)
+            except OSError:
+                self.log.warning("Instance directory %s does not exist" % self.root)
+            else:
+                self._entries[self.root] = FileInfo(st.st_size, st.st_mtime, st.st_mode)
+                if stat.S_ISDIR(st.st_mode):
+                    self._walk()
+
+            for path, info in old_entries.items():
+                if path not in self._entries:
+                    self._record_deletion(path, info)
+
+            # VV: This is how files which were modified in place (or changed while their parent directory was
+            # being rescanned) end up in the records
+            for path, info in self._entries.items():
+                self._record_change(path, info, old_entries.get(path))
+
+            if self._history_since is None:
+                self._history_since = started
+
+            self._trim_history()
+            # VV: The index contains all the changes which happened before the rebuild started
+            self._built_at = self._checked_at = started
+
+    def refresh(self, force=False):
+        # type: (bool) -> None
+        """Brings the index up to date, unless it was checked less than @ttl seconds ago and @force is False"""
+        with self._lock:
+            now = time.time()
+            if self._built_at is None or now - self._built_at > self.max_age:
+                self.rebuild()
+                return
+
+            if force is False and now - self._checked_at < self.ttl:
+                return
+
+            # VV: Only directories are stat()ed here, files are re-stated only when their parent directory changes.
+            # Rescanning a directory updates the FileInfo of its sub-directories, compare against the old ones
+            known = [(path, self._entries.get(path)) for path in self._children]
+            for path, old_info in known:
+                if path not in self._children:
+                    # VV: Removed while rescanning one of its parents
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    self._forget(path)
+                    continue
+
+                if old_info is None or st.st_mtime != old_info.mtime or not stat.S_ISDIR(st.st_mode):
+                    self._set_entry(path, FileInfo(st.st_size, st.st_mtime, st.st_mode))
+                    if stat.S_ISDIR(st.st_mode):
+                        self._scan_dir(path)
+                    else:
+                        self._forget_children(path)
+
+            self._trim_history()
+            self._checked_at = now
+
+    def walk_files(self, path=None):
+        # type: (Optional[str]) -> Iterator[Tuple[str, FileInfo]]
+        """Returns (path, FileInfo) for every non-directory under @path (defaults to the instance root)"""
+        path = os.path.abspath(path or self.root)
+        with self._lock:
+            self.refresh()
+            if path == self.root:
+                items = list(self._entries.items())
+            else:
+                prefix = path.rstrip('/') + '/'
+                items = [(k, v) for k, v in self._entries.items() if k.startswith(prefix)]
+
+        return iter(sorted((k, v) for k, v in items if not stat.S_ISDIR(v.mode)))
+
+    def match_files(self, patterns):
+        # type: (List[str]) -> List[str]
+        """Returns the sorted paths of files whose path relative to the instance root matches any of the glob
+        @patterns (see glob_to_regex(), a leading "/" is ignored)
+        """
+        regexes = [glob_to_regex(p.lstrip('/')) for p in patterns]
+        prefix_len = len(self.root.rstrip('/')) + 1
+
+        return [path for path, _ in self.walk_files() if any(r.match(path[prefix_len:]) for r in regexes)]
+
+    def changes(self, since=None):
+        # type: (Optional[float]) -> Tuple[float, bool, List[Tuple[str, FileInfo]], List[str]]
+        """Refreshes the manifest and returns what changed after the epoch timestamp @since
+
+        Changes are timestamped when the manifest notices them, which is never earlier than the time they happened.
+        A file which is modified in place is noticed when the manifest is rebuilt (see @max_age).
+
+        Returns:
+            A (checked_at, reset, changed, deleted) tuple. @changed contains the sorted (path, FileInfo) of files
+            which were created or modified after @since and @deleted the sorted paths of files which were deleted
+            after @since. If @since is None, or the manifest cannot tell what changed after @since (e.g. it was
+            built after @since), @reset is True, @changed contains all files and @deleted is empty.
+            The manifest contains every change which happened before @checked_at, use it as the @since of the
+            next call.
+        """
+        with self._lock:
+            self.refresh()
+
+            if since is None or self._history_since is None or since < self._history_since:
+                files = [(k, v) for k, v in self._entries.items() if not stat.S_ISDIR(v.mode)]
+                return self._checked_at, True, sorted(files), []
+
+            changed = []
+            for path in reversed(self._changed):
+                if self._changed[path] < since:
+                    break
+                info = self._entries.get(path)
+                if info is not None and not stat.S_ISDIR(info.mode):
+                    changed.append((path, info))
+
+            deleted = []
+            for path in reversed(self._deleted):
+                when, was_dir = self._deleted[path]
+                if when < since:
+                    break
+                if was_dir is False and path not in self._entries:
+                    deleted.append(path)
+
+            return self._checked_at, False, sorted(changed), sorted(deleted)
+
+
+class ManifestCache(object):
+    """Keeps the FileManifest of at most @max_instances experiment instances, evicts the least recently used"""
+    def __init__(self, max_instances=1024, ttl=5.0, max_age=300.0, walker=None):
+        # type: (int, float, float, Optional[DirectoryWalker]) -> None
+        self.max_instances = max_instances
+        self.ttl = ttl
+        self.max_age = max_age
+        self.walker = walker
+
+        self._lock = threading.RLock()
+        self._manifests = collections.OrderedDict()  # type: Dict[str, FileManifest]
+
+    def get(self, instance_root):
+        # type: (str) -> FileManifest
+        instance_root = os.path.abspath(instance_root)
+
+        with self._lock:
+            try:
+                manifest = self._manifests.pop(instance_root)
+            except KeyError:
+                manifest = FileManifest(instance_root, ttl=self.ttl, max_age=self.max_age, walker=self.walker)
+
+            self._manifests[instance_root] = manifest
+
+            while len(self._manifests) > max(1, self.max_instances):
+                self._manifests.popitem(last=False)
+
+        return manifest
+
+    def invalidate(self, instance_root):
+        # type: (str) -> None
+        with self._lock:
+            self._manifests.pop(os.path.abspath(instance_root), None)
@@ -0,0 +1,237 @@
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+import collections
+import concurrent.futures
+import logging
+import os
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from st4sd_datastore.file_manifest import FileInfo
+
+# VV: Reasons for skipping a file
+SKIP_MISSING = 'missing'
+SKIP_MAX_BYTES = 'max_bytes'
+SKIP_MAX_FILES_TOTAL = 'max_files_total'
+
+# VV: A candidate is (group, path, FileInfo), the FileInfo may be None if the caller has not stat()ed the file yet
+Candidate = Tuple[str, str, Optional[FileInfo]]
+
+# VV: Optional numeric filters of selections, see file_matches()
+SELECTION_FILTERS = ['min_size', 'max_size', 'modified_after', 'modified_before']
+
+
+class InvalidSelection(ValueError):
+    """Raised when a selection of files does not follow the schema that parse_selection() expects"""
+
+
+def parse_selection(selection):
+    # type: (Union[List[str], Dict[str, Any]]) -> Tuple[List[str], List[str], Dict[str, float], Dict[str, str]]
+    """Validates a selection of files and returns (paths, glob patterns, filters, checksums)
+
+    A selection is either a list of absolute paths or a dictionary with the optional keys:
+        paths: list of absolute paths
+        glob: a glob pattern, or a list of them, relative to the instance root (e.g. "stages/stage2/**/*.csv")
+        min_size, max_size: bounds (in bytes) for the size of files that the glob patterns match
+        modified_after, modified_before: bounds (epoch seconds) for the mtime of files that the glob patterns match
+        checksums: {absolute path: sha256} of files that the client already has
+
+    Raises:
+        InvalidSelection: if @selection does not follow the schema
+    """
+    if isinstance(selection, list):
+        selection = {'paths': selection}
+    elif not isinstance(selection, dict):
+        raise InvalidSelection("Expected a list of paths or a dictionary, not %s" % type(selection).__name__)
+
+    paths = selection.get('paths') or []
+    if not isinstance(paths, list) or any(not isinstance(x, str) or not x for x in paths):
+        raise InvalidSelection("\"paths\" must be a list of non-empty strings, not %s" % (paths,))
+
+    patterns = selection.get('glob') or []
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    if not isinstance(patterns, list) or any(not isinstance(x, str) for x in patterns):
+        raise InvalidSelection("\"glob\" must be a string or a list of strings, not %s" % (patterns,))
+
+    filters = {}
+    for name in SELECTION_FILTERS:
+        value = selection.get(name)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise InvalidSelection("\"%s\" must be a number, not %r" % (name, value))
+        filters[name] = value
+
+    checksums = selection.get('checksums') or {}
+    if not isinstance(checksums, dict) or any(not isinstance(x, str) for x in checksums.values()):
+        raise InvalidSelection("\"checksums\" must be a dictionary {path: sha256}, not %s" % (checksums,))
+
+    return paths, patterns, filters, checksums
+
+
+class SelectionReport(object):
+    """The outcome of FileSelector.select()
+
+    Attributes:
+        selected: The selected paths, in the order they were offered
+        total_bytes: The bytes that the selected files count towards the budget
+        skipped: [{"group": str, "path": str, "reason": str, "size": Optional[int]}] for files that were examined
+            but not selected
+        capped: {group: number of files} that were left out because the group hit max_files_per_group
+        stop_reason: None if all candidates were examined, else the budget that ran out (SKIP_MAX_BYTES or
+            SKIP_MAX_FILES_TOTAL)
+        not_considered: Number of candidates that were not examined because a budget ran out
+    """
+    def __init__(self):
+        self.selected = []  # type: List[str]
+        self.total_bytes = 0
+        self.skipped = []  # type: List[Dict[str, Any]]
+        self.capped = {}  # type: Dict[str, int]
+        self.stop_reason = None  # type: Optional[str]
+        self.not_considered = 0
+
+    def skip(self, group, path, reason, size=None):
+        # type: (str, str, str, Optional[int]) -> None
+        self.skipped.append({'group': group, 'path': path, 'reason': reason, 'size': size})
+
+    def to_dict(self):
+        # type: () -> Dict[str, Any]
+        return {
+            'selected': len(self.selected),
+            'totalBytes': self.total_bytes,
+            'skipped': self.skipped,
+            'capped': self.capped,
+            'stopReason': self.stop_reason,
+            'notConsidered': self.not_considered,
+        }
+
+
+def stat_file(path):
+    # type: (str) -> Optional[FileInfo]
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return FileInfo(st.st_size, st.st_mtime, st.st_mode)
+
+
+class FileSelector(object):
+    """Picks files out of a list of candidates so that they fit in a budget of bytes and files
+
+    Files are considered in order. Each file costs min(size, max_file_size) bytes, files which do not fit in the
+    remaining bytes are skipped, and selection stops as soon as the bytes or the total files run out. Candidates
+    whose FileInfo is unknown are stat()ed on a thread pool, at most @window ahead of the one being examined, so
+    that a selection which stops early does not stat the remaining files.
+
+    Arguments:
+        max_bytes: Byte budget (None or a negative number for unlimited)
+        max_file_size: Files larger than this count as max_file_size bytes (None or negative for no cap)
+        max_files_per_group: Maximum files per group (e.g. experiment instance), None for unlimited
+        max_files_total: Maximum files in total, None for unlimited
+        workers: Threads which stat() files, 0 to stat() them in the calling thread
+        window: Maximum number of candidates which are stat()ed ahead of the one being examined
+    """
+    def __init__(self, max_bytes=None, max_file_size=None, max_files_per_group=None, max_files_total=None,
+                 workers=8, window=64):
+        # type: (Optional[int], Optional[int], Optional[int], Optional[int], int, int) -> None
+        self.max_bytes = max_bytes if max_bytes is not None and max_bytes >= 0 else None
+        self.max_file_size = max_file_size if max_file_size is not None and max_file_size >= 0 else None
+        self.max_files_per_group = max_files_per_group
+        self.max_files_total = max_files_total
+        self.window = max(1, window)
+
+        self._pool = None  # type: Optional[concurrent.futures.ThreadPoolExecutor]
+        if workers > 0:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='select')
+
+        self.log = logging.getLogger('FileSelector')
+
+    def stat_many(self, paths):
+        # type: (List[str]) -> List[Optional[FileInfo]]
+        """Returns the FileInfo (None if it does not exist) of each path in @paths, uses the thread pool"""
+        if self._pool is None:
+            return [stat_file(path) for path in paths]
+        return list(self._pool.map(stat_file, paths))
+
+    def select(self, candidates):
+        # type: (Iterable[Candidate]) -> SelectionReport
+        report = SelectionReport()
+        group_files = {}  # type: Dict[str, int]
+        remaining_bytes = self.max_bytes
+
+        candidates = iter(candidates)
+        # VV: Holds (group, path, FileInfo/Future/None) for the next @window candidates
+        pending = collections.deque()
+
+        def fill():
+            while len(pending) < self.window:
+                try:
+                    group, path, info = next(candidates)
+                except StopIteration:
+                    return
+                if info is None and self._pool is not None:
+                    info = self._pool.submit(stat_file, path)
+                pending.append((group, path, info))
+
+        def discard(info):
+            if isinstance(info, concurrent.futures.Future):
+                info.cancel()
+
+        try:
+            while True:
+                fill()
+                if not pending:
+                    break
+
+                group, path, info = pending.popleft()
+
+                if self.max_files_per_group is not None and group_files.get(group, 0) >= self.max_files_per_group:
+                    report.capped[group] = report.capped.get(group, 0) + 1
+                    discard(info)
+                    continue
+
+                if isinstance(info, concurrent.futures.Future):
+                    info = info.result()
+                elif info is None:
+                    info = stat_file(path)
+
+                if info is None:
+                    report.skip(group, path, SKIP_MISSING)
+                    continue
+
+                cost = info.size
+                if self.max_file_size is not None:
+                    cost = min(cost, self.max_file_size)
+
+                if remaining_bytes is not None and cost > remaining_bytes:
+                    self.log.warning("Will not return file %s because we would exceed max number of bytes "
+                                     "(%d + %d > %d)" % (path, report.total_bytes, cost, self.max_bytes))
+                    report.skip(group, path, SKIP_MAX_BYTES, info.size)
+                    continue
+
+                report.selected.append(path)
+                report.total_bytes += cost
+                group_files[group] = group_files.get(group, 0) + 1
+
+                if remaining_bytes is not None:
+                    remaining_bytes -= cost
+                    if remaining_bytes <= 0:
+                        report.stop_reason = SKIP_MAX_BYTES
+                        break
+
+                if self.max_files_total is not None and len(report.selected) >= self.max_files_total:
+                    self.log.warning("Hit maximum number of files (%d) per request" % self.max_files_total)
+                    report.stop_reason = SKIP_MAX_FILES_TOTAL
+                    break
+        finally:
+            # VV: Do not waste the pool on stat() operations whose result nobody needs
+            for _, _, info in pending:
+                discard(info)
+
+        if report.stop_reason is not None:
+            report.not_considered = len(pending) + sum(1 for _ in candidates)
+
+        return report
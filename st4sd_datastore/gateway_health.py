@@ -0,0 +1,192 @@
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+import concurrent.futures
+import fcntl
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class GatewayProber(object):
+    """Periodically GETs the /hello/ endpoint of every gateway in a registry and keeps track of their health
+
+    A gateway is healthy while it has failed fewer than @unhealthy_after consecutive probes, its health is
+    None (unknown) till it is probed for the first time. The latency of successful probes is smoothed with an
+    exponential moving average (@alpha is the weight of the newest sample).
+
+    Processes which serve the same registry (e.g. gunicorn workers) share the health of gateways through @store.
+    Only the process which holds an exclusive lock on @lock_location probes the gateways, the others try to take
+    over the lock every @interval seconds in case the prober process exits.
+
+    Arguments:
+        gateways: Callable which returns {unique_id: {"host": str, ...}} (e.g. the get_all() of a GatewayRegistry)
+        interval: Seconds between rounds of probes
+        timeout: Seconds to wait for each /hello/ reply
+        alpha: Weight of the newest latency sample in the moving average
+        unhealthy_after: Number of consecutive failed probes after which a gateway is unhealthy
+        workers: Number of gateways to probe in parallel
+        verify_tls: Whether to verify the TLS certificates of gateways
+        store: Optional object with put_health({unique_id: health}) and get_health(unique_id) methods
+            (e.g. a GatewayRegistry) to share the health of gateways with other processes
+        lock_location: Optional path of the lock file which elects the process that probes gateways
+    """
+    def __init__(self, gateways, interval=30.0, timeout=5.0, alpha=0.3, unhealthy_after=2, workers=8,
+                 verify_tls=True, store=None, lock_location=None):
+        # type: (Callable[[], Dict[str, Dict[str, Any]]], float, float, float, int, int, bool, Optional[Any], Optional[str]) -> None
+        self.gateways = gateways
+        self.interval = interval
+        self.timeout = timeout
+        self.alpha = alpha
+        self.unhealthy_after = max(1, unhealthy_after)
+        self.verify_tls = verify_tls
+        self.store = store
+        self.lock_location = lock_location
+
+        self._lock_fd = None  # type: Optional[int]
+        self._lock = threading.Lock()
+        self._health = {}  # type: Dict[str, Dict[str, Any]]
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='probe')
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+        self.log = logging.getLogger('GatewayProber')
+
+    def _session(self):
+        # type: () -> requests.Session
+        """Returns the requests.Session of this thread so that probes re-use keep-alive connections"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def probe(self, host):
+        # type: (str) -> Tuple[bool, float, Optional[str]]
+        """GETs ${host}/hello/ and returns (success, latency in seconds, error message)"""
+        url = '/'.join((host.rstrip('/'), 'hello/'))
+        start = time.monotonic()
+
+        try:
+            resp = self._session().get(url, timeout=self.timeout, verify=self.verify_tls)
+            latency = time.monotonic() - start
+            if resp.status_code != 200:
+                return False, latency, "HTTP %d" % resp.status_code
+            if resp.json() != 'hello':
+                return False, latency, "Unexpected reply %s" % resp.text[:100]
+        except Exception as e:
+            return False, time.monotonic() - start, str(e)
+
+        return True, latency, None
+
+    def _record(self, unique_id, host, outcome):
+        # type: (str, str, Tuple[bool, float, Optional[str]]) -> None
+        success, latency, error = outcome
+
+        with self._lock:
+            health = self._health.get(unique_id)
+            if health is None or health['host'] != host:
+                health = self._health[unique_id] = {
+                    'host': host, 'latencyEMA': None, 'consecutiveFailures': 0, 'lastError': None}
+
+            health['lastChecked'] = time.time()
+            if success:
+                health['consecutiveFailures'] = 0
+                health['lastError'] = None
+                if health['latencyEMA'] is None:
+                    health['latencyEMA'] = latency
+                else:
+                    health['latencyEMA'] = self.alpha * latency + (1 - self.alpha) * health['latencyEMA']
+            else:
+                health['consecutiveFailures'] += 1
+                health['lastError'] = error
+
+            health['healthy'] = health['consecutiveFailures'] < self.unhealthy_after
+
+    def probe_all(self):
+        """Probes all gateways once (in parallel) and forgets the health of gateways that left the registry"""
+        gateways = {uid: gw['host'] for uid, gw in self.gateways().items()}
+
+        futures = {self._pool.submit(self.probe, host): (uid, host) for uid, host in gateways.items()}
+        for future in concurrent.futures.as_completed(futures):
+            uid, host = futures[future]
+            self._record(uid, host, future.result())
+
+        with self._lock:
+            for uid in set(self._health).difference(gateways):
+                del self._health[uid]
+
+    def health(self, unique_id):
+        # type: (str) -> Dict[str, Any]
+        """Returns {"healthy": Optional[bool], "latencyEMA": Optional[float], "lastChecked": Optional[float],
+        "lastError": Optional[str], "consecutiveFailures": int} for @unique_id"""
+        if self.store is not None:
+            health = self.store.get_health(unique_id)
+        else:
+            with self._lock:
+                health = self._health.get(unique_id)
+
+        if health is None:
+            return {'healthy': None, 'latencyEMA': None, 'lastChecked': None, 'lastError': None,
+                    'consecutiveFailures': 0}
+        return {k: v for k, v in health.items() if k != 'host'}
+
+    def _is_prober(self):
+        # type: () -> bool
+        """Returns True if this process should probe the gateways i.e. it holds the lock on @lock_location"""
+        if self.lock_location is None or self._lock_fd is not None:
+            return True
+
+        fd = os.open(self.lock_location, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        self._lock_fd = fd
+        self.log.info("This process (%d) now probes the gateways" % os.getpid())
+
+        # VV: Pick up where the previous prober left off so that consecutive failures keep adding up
+        if self.store is not None:
+            with self._lock:
+                for uid in self.gateways():
+                    health = self.store.get_health(uid)
+                    if health is not None:
+                        self._health[uid] = dict(health)
+        return True
+
+    def _loop(self):
+        while self._stop.is_set() is False:
+            try:
+                if self._is_prober():
+                    self.probe_all()
+                    if self.store is not None:
+                        with self._lock:
+                            health = {uid: dict(h) for uid, h in self._health.items()}
+                        self.store.put_health(health)
+            except Exception as e:
+                self.log.warning("Failed to probe gateways: %s" % e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """Starts probing in a background (daemon) thread"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='gateway-prober', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
@@ -7,42 +7,107 @@ import threading
 import json
 import os
 import logging
+import sqlite3
+import time
 
 
 
-from typing import Dict, List, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 
 class GatewayRegistry(object):
-    def __init__(self):
+    """An in-memory map of unique_id -> gateway which is persisted in a JSON file
+
+    Other processes (e.g. other gunicorn workers) may update the JSON file. The registry checks at most once every
+    @check_interval seconds whether the file changed (its mtime, inode, or size) and reloads it only if it did,
+    lookups in between touch just the in-memory map. The health of gateways (see GatewayProber) is shared the
+    same way via a second JSON file.
+    """
+    def __init__(self, check_interval=1.0):
+        # type: (float) -> None
         self._lock = threading.RLock()
         self._gateways = {}  # type: Dict[str, Dict[str, Union[str, int]]]
 
         self._cache_location = 'cache_gateway_registry.json'
+        self.check_interval = check_interval
+        # VV: (st_mtime_ns, st_ino, st_size) of the file that _gateways reflects, None if there was no file
+        self._signature = None  # type: Optional[Tuple[int, int, int]]
+        self._checked_at = None  # type: Optional[float]
+
+        self._health_location = 'cache_gateway_health.json'
+        self._health = {}  # type: Dict[str, Dict[str, Any]]
+        self._health_signature = None  # type: Optional[Tuple[int, int, int]]
+        self._health_checked_at = None  # type: Optional[float]
 
         self.log = logging.getLogger('GatewayRegistry')
 
         self.load()
 
+    def _file_signature(self, location=None):
+        # type: (Optional[str]) -> Optional[Tuple[int, int, int]]
+        try:
+            st = os.stat(location or self._cache_location)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_ino, st.st_size
+
     def store(self):
         with self._lock:
-            with open(self._cache_location, 'w') as f:
+            # VV: Write to a temporary file and rename it so that other processes never read a half-written file
+            tmp_location = '%s.%d.tmp' % (self._cache_location, os.getpid())
+            with open(tmp_location, 'w') as f:
                 json.dump(self._gateways, f)
+            os.replace(tmp_location, self._cache_location)
+
+            self._signature = self._file_signature()
+            self._checked_at = time.time()
 
     def load(self):
         with self._lock:
-            if os.path.exists(self._cache_location):
+            signature = self._file_signature()
+            self._checked_at = time.time()
+
+            if signature is None:
+                return
+
+            try:
                 with open(self._cache_location, 'r') as f:
-                    self._gateways = json.load(f)
+                    gateways = json.load(f)
+            except ValueError as e:
+                # VV: Another process may be in the middle of rewriting the file, keep what we have and retry later
+                self.log.warning("Could not parse %s: %s - will retry" % (self._cache_location, e))
+                return
 
-    def get(self, unique_id):
-        self.load()
+            self._gateways = gateways
+            self._signature = signature
+
+    def refresh(self, force=False):
+        # type: (bool) -> None
+        """Reloads the registry if the backing file changed since the last time it was loaded or stored"""
+        with self._lock:
+            if force is False and self._checked_at is not None and \
+                    time.time() - self._checked_at < self.check_interval:
+                return
+
+            self._checked_at = time.time()
+            if self._file_signature() != self._signature:
+                self.load()
 
+    def get(self, unique_id):
         with self._lock:
+            self.refresh()
             return self._gateways[unique_id]
 
+    def get_many(self, unique_ids):
+        # type: (Iterable[str]) -> Dict[str, Dict[str, Union[str, int]]]
+        """Returns {unique_id: gateway} for the @unique_ids which are in the registry, skips unknown ids"""
+        with self._lock:
+            self.refresh()
+            return {uid: self._gateways[uid] for uid in unique_ids if uid in self._gateways}
+
     def put(self, unique_id, host, label):
         with self._lock:
+            self.refresh(force=True)
             self._gateways[unique_id] = {
                 'unique_id': unique_id,
                 'host': host,
@@ -58,11 +123,263 @@ class GatewayRegistry(object):
             'label': label,
         }
         with self._lock:
+            self.refresh(force=True)
             assert self.get(unique_id) == entry
             del self._gateways[unique_id]
 
             self.store()
 
+    def get_all(self):
+        # type: () -> Dict[str, Dict[str, Union[str, int]]]
+        with self._lock:
+            self.refresh()
+            return dict(self._gateways)
+
+    def get_by_label(self, label):
+        # type: (str) -> Dict[str, Dict[str, Union[str, int]]]
+        """Returns {unique_id: gateway} for the gateways with @label"""
+        with self._lock:
+            self.refresh()
+            return {uid: gw for uid, gw in self._gateways.items() if gw['label'] == label}
+
     def contains(self, unique_id):
         with self._lock:
+            self.refresh()
             return unique_id in self._gateways
+
+    def put_health(self, health):
+        # type: (Dict[str, Dict[str, Any]]) -> None
+        """Replaces the health of all gateways ({unique_id: health}) so that other processes can read it"""
+        with self._lock:
+            tmp_location = '%s.%d.tmp' % (self._health_location, os.getpid())
+            with open(tmp_location, 'w') as f:
+                json.dump(health, f)
+            os.replace(tmp_location, self._health_location)
+
+            self._health = dict(health)
+            self._health_signature = self._file_signature(self._health_location)
+            self._health_checked_at = time.time()
+
+    def get_health(self, unique_id):
+        # type: (str) -> Optional[Dict[str, Any]]
+        """Returns the last health that put_health() (of any process) stored for @unique_id, None if there is none"""
+        with self._lock:
+            if self._health_checked_at is None or time.time() - self._health_checked_at >= self.check_interval:
+                self._health_checked_at = time.time()
+                signature = self._file_signature(self._health_location)
+                if signature != self._health_signature:
+                    try:
+                        with open(self._health_location, 'r') as f:
+                            self._health = json.load(f)
+                        self._health_signature = signature
+                    except (OSError, ValueError) as e:
+                        self.log.warning("Could not read %s: %s - will retry" % (self._health_location, e))
+
+            return self._health.get(unique_id)
+
+
+class SQLiteGatewayRegistry(object):
+    """A GatewayRegistry which is persisted in an SQLite database in WAL mode
+
+    Each put()/delete() is a transaction which touches a single row and multiple processes (e.g. gunicorn workers)
+    can safely share the database. WAL mode needs shared memory so @location must be on a local disk, not on a
+    network filesystem. Lookups are served from an in-memory copy of the table which is reloaded when another
+    connection commits a change (checked at most once every @check_interval seconds with "PRAGMA data_version").
+
+    The first time the database is opened, if it is empty and @json_location exists, the gateways in the JSON file
+    (see GatewayRegistry) are imported into the database. put()/delete() do not touch the JSON file, call
+    export_json() before going back to a GatewayRegistry so that it does not lose registrations.
+
+    The health of gateways (see GatewayProber) is kept in a second table so that all processes see the same health.
+    """
+    def __init__(self, location='cache_gateway_registry.sqlite', check_interval=1.0,
+                 json_location='cache_gateway_registry.json', busy_timeout=30.0):
+        # type: (str, float, Optional[str], float) -> None
+        self._lock = threading.RLock()
+        self._gateways = {}  # type: Dict[str, Dict[str, Union[str, int]]]
+        self._health = {}  # type: Dict[str, Dict[str, Any]]
+
+        self._location = location
+        self._json_location = json_location
+        self.check_interval = check_interval
+        self._data_version = None  # type: Optional[int]
+        self._checked_at = None  # type: Optional[float]
+
+        self.log = logging.getLogger('GatewayRegistry')
+
+        # VV: Transactions are explicit (isolation_level=None) so that writes can BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(location, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS gateways ('
+                           'unique_id TEXT PRIMARY KEY, host TEXT NOT NULL, label TEXT NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS gateways_label ON gateways (label)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS health (unique_id TEXT PRIMARY KEY, health TEXT NOT NULL)')
+
+        if json_location:
+            self._import_json(json_location)
+
+        self.load()
+
+    def _import_json(self, json_location):
+        # type: (str) -> None
+        if os.path.exists(json_location) is False:
+            return
+
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                # VV: Import the JSON file just once, so that deleted gateways do not come back after a restart
+                imported = self._conn.execute("SELECT value FROM meta WHERE key = 'imported_json'").fetchone()
+                if imported is None and self._conn.execute('SELECT COUNT(*) FROM gateways').fetchone()[0] == 0:
+                    with open(json_location, 'r') as f:
+                        gateways = json.load(f)
+
+                    self._conn.executemany(
+                        'INSERT INTO gateways (unique_id, host, label) VALUES (?, ?, ?)',
+                        [(gw['unique_id'], gw['host'], gw['label']) for gw in gateways.values()])
+                    self.log.warning("Imported %d gateways from %s into %s" % (
+                        len(gateways), json_location, self._location))
+
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported_json', ?)",
+                                   (json_location,))
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            else:
+                self._conn.execute('COMMIT')
+
+    def export_json(self, json_location=None):
+        # type: (Optional[str]) -> int
+        """Atomically writes the gateways in the database to the JSON file of a GatewayRegistry
+
+        Arguments:
+            json_location: Path of the JSON file, None for the @json_location of the constructor
+
+        Returns:
+            The number of gateways it exported
+        """
+        json_location = json_location or self._json_location
+        if not json_location:
+            raise ValueError("There is no JSON file to export the gateways to")
+
+        with self._lock:
+            rows = self._conn.execute('SELECT unique_id, host, label FROM gateways').fetchall()
+        gateways = {uid: {'unique_id': uid, 'host': host, 'label': label} for uid, host, label in rows}
+
+        tmp_location = '%s.%d.tmp' % (json_location, os.getpid())
+        with open(tmp_location, 'w') as f:
+            json.dump(gateways, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_location, json_location)
+
+        self.log.info("Exported %d gateways from %s to %s" % (len(gateways), self._location, json_location))
+        return len(gateways)
+
+    def load(self):
+        with self._lock:
+            self._checked_at = time.time()
+            self._data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            rows = self._conn.execute('SELECT unique_id, host, label FROM gateways').fetchall()
+            self._gateways = {uid: {'unique_id': uid, 'host': host, 'label': label} for uid, host, label in rows}
+            rows = self._conn.execute('SELECT unique_id, health FROM health').fetchall()
+            self._health = {uid: json.loads(health) for uid, health in rows}
+
+    def refresh(self, force=False):
+        # type: (bool) -> None
+        """Reloads the in-memory copy if another connection changed the database since the last load()"""
+        with self._lock:
+            if force is False and self._checked_at is not None and \
+                    time.time() - self._checked_at < self.check_interval:
+                return
+
+            self._checked_at = time.time()
+            if self._conn.execute('PRAGMA data_version').fetchone()[0] != self._data_version:
+                self.load()
+
+    def get(self, unique_id):
+        with self._lock:
+            self.refresh()
+            return self._gateways[unique_id]
+
+    def get_many(self, unique_ids):
+        # type: (Iterable[str]) -> Dict[str, Dict[str, Union[str, int]]]
+        """Returns {unique_id: gateway} for the @unique_ids which are in the registry, skips unknown ids"""
+        with self._lock:
+            self.refresh()
+            return {uid: self._gateways[uid] for uid in unique_ids if uid in self._gateways}
+
+    def get_all(self):
+        # type: () -> Dict[str, Dict[str, Union[str, int]]]
+        with self._lock:
+            self.refresh()
+            return dict(self._gateways)
+
+    def get_by_label(self, label):
+        # type: (str) -> Dict[str, Dict[str, Union[str, int]]]
+        """Returns {unique_id: gateway} for the gateways with @label"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT unique_id, host, label FROM gateways WHERE label = ?', (label,)).fetchall()
+        return {uid: {'unique_id': uid, 'host': host, 'label': label} for uid, host, label in rows}
+
+    def put(self, unique_id, host, label):
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO gateways (unique_id, host, label) VALUES (?, ?, ?) '
+                'ON CONFLICT (unique_id) DO UPDATE SET host = excluded.host, label = excluded.label',
+                (unique_id, host, label))
+            self._gateways[unique_id] = {
+                'unique_id': unique_id,
+                'host': host,
+                'label': label,
+            }
+
+    def delete(self, unique_id, host, label):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    'SELECT unique_id, host, label FROM gateways WHERE unique_id = ?', (unique_id,)).fetchone()
+                if row is None:
+                    raise KeyError(unique_id)
+                assert row == (unique_id, host, label)
+                self._conn.execute('DELETE FROM gateways WHERE unique_id = ?', (unique_id,))
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            else:
+                self._conn.execute('COMMIT')
+
+            self._gateways.pop(unique_id, None)
+
+    def contains(self, unique_id):
+        with self._lock:
+            self.refresh()
+            return unique_id in self._gateways
+
+    def put_health(self, health):
+        # type: (Dict[str, Dict[str, Any]]) -> None
+        """Replaces the health of all gateways ({unique_id: health}) so that other processes can read it"""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('DELETE FROM health')
+                self._conn.executemany('INSERT INTO health (unique_id, health) VALUES (?, ?)',
+                                       [(uid, json.dumps(h)) for uid, h in health.items()])
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            else:
+                self._conn.execute('COMMIT')
+
+            self._health = dict(health)
+
+    def get_health(self, unique_id):
+        # type: (str) -> Optional[Dict[str, Any]]
+        """Returns the last health that put_health() (of any process) stored for @unique_id, None if there is none"""
+        with self._lock:
+            self.refresh()
+            return self._health.get(unique_id)
@@ -5,11 +5,15 @@
 
 from __future__ import annotations
 
+import collections
+import hashlib
+import json
 import logging
 import os
+import threading
 import time
 import uuid
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 
 import experiment.model.data
 import experiment.model.graph
@@ -17,14 +21,89 @@ import experiment.model.storage
 import experiment.service.db
 import requests
 
+from st4sd_datastore.document_spool import DocumentSpool
+
+
+class DocumentBatch(object):
+    """Coalesces the documents that a series of updates of one experiment instance upsert
+
+    A document replaces any earlier document of the same instance with the same key, just like
+    _upsert_documents() of experiment.service.db.Mongo does: components are matched on their stage and name,
+    while there is a single experiment and a single user-metadata document. Documents of other types are never
+    superseded. Components that just finished and the experiment document are recorded by reference and are
+    generated once, when the batch is upserted (see Reporter.upsert_batch()).
+    """
+    Document = 'document'
+    Component = 'component'
+    Experiment = 'experiment'
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()  # type: Dict[Tuple[Any, ...], Tuple[str, Any]]
+        self.superseded = 0
+
+    def _put(self, key, kind, payload):
+        # type: (Tuple[Any, ...], str, Any) -> None
+        if key in self._entries:
+            self.superseded += 1
+            del self._entries[key]
+        self._entries[key] = (kind, payload)
+
+    @classmethod
+    def key_of(cls, doc: Dict[str, Any]) -> Optional[Tuple[Any, ...]]:
+        """Returns the key which identifies @doc among the documents of its instance, None if there is none"""
+        doc_type = doc.get('type')
+        if doc_type == 'component':
+            return 'component', doc['stage'], doc['name']
+        elif doc_type in ['experiment', 'user-metadata']:
+            return doc_type,
+        return None
+
+    def add_documents(self, documents: List[Dict[str, Any]]):
+        for doc in documents:
+            key = self.key_of(doc)
+            if key is None:
+                key = ('unkeyed', id(doc))
+            self._put(key, self.Document, doc)
+
+    def add_components(self, components: List[Dict[str, Any]]):
+        """Records components ({"stage": int, "name": str}) whose documents should be generated and upserted"""
+        for comp in components:
+            self._put(('component', comp['stage'], comp['name']), self.Component, (comp['stage'], comp['name']))
+
+    def add_experiment_document(self):
+        self._put(('experiment',), self.Experiment, None)
+
+    def merge(self, other: DocumentBatch):
+        """Adds the entries of @other, which supersede the entries of this batch"""
+        for key, (kind, payload) in other._entries.items():
+            self._put(key, kind, payload)
+        self.superseded += other.superseded
+
+    def entries(self) -> List[Tuple[str, Any]]:
+        """Returns [(kind, payload)] in the order in which the surviving entries were last added"""
+        return list(self._entries.values())
+
+    def __len__(self):
+        return len(self._entries)
+
 
 class Reporter(object):
+    # VV: Maximum number of experiment instances to remember the digests of the written documents for
+    max_remembered_instances = 1024
+
     def __init__(self, mongo_host, mongo_port, mongo_url,
                  database='db', collection='experiments',
                  gateway_registry_url=None, local_gateway_public_url=None,
                  local_gateway_local_url=None,
                  gateway_local_port=5002, own_gateway_id=None,
-                 mongo_username=None, mongo_password=None, mongo_authSource=None):
+                 mongo_username=None, mongo_password=None, mongo_authSource=None,
+                 spool_dir=None, spool_initial_backoff=1.0, spool_max_backoff=60.0):
+        """Connects to the database and waits for the local gateway to start
+
+        If @spool_dir is set, writes which fail because the database is unavailable are spooled in @spool_dir and
+        retried with exponential backoff (see st4sd_datastore.document_spool.DocumentSpool). In that case the
+        Reporter also starts when it cannot connect to the database.
+        """
         self._gateway_url = local_gateway_public_url
         self._gateway_local_port = gateway_local_port
         self._own_gateway_id = own_gateway_id or str(uuid.getnode())
@@ -32,6 +111,10 @@ class Reporter(object):
         self.log = logging.getLogger("Reporter")
         self.log.info("Connecting")
 
+        # VV: instance URI -> {document key: digest of the document that this reporter last wrote}
+        self._written = collections.OrderedDict()  # type: Dict[str, Dict[Tuple[Any, ...], str]]
+        self._written_lock = threading.Lock()
+
         if mongo_url:
             if (not mongo_host) and (not mongo_port):
                 self.log.info("Will attempt to connect to MongoDB proxy %s instead of %s:%s" % (
@@ -72,8 +155,12 @@ class Reporter(object):
             raise ValueError("Neither mongo_url option was provided, nor mongo_host/mongo_port")
 
         if self._db.is_connected() is False:
-            self.log.critical("Failed to connect!")
-            raise ValueError("Could not connect to %s" % mongo_location)
+            if spool_dir:
+                self.log.critical("Failed to connect to %s - will spool writes till it becomes available" %
+                                  mongo_location)
+            else:
+                self.log.critical("Failed to connect!")
+                raise ValueError("Could not connect to %s" % mongo_location)
         else:
             self.log.info("Successfully connected to DB")
 
@@ -102,20 +189,90 @@ class Reporter(object):
 
         self.log.info("Successfully connected to local gateway")
 
+        self.spool = None  # type: Optional[DocumentSpool]
+        if spool_dir:
+            self.spool = DocumentSpool(spool_dir, self._write_now, initial_backoff=spool_initial_backoff,
+                                       max_backoff=spool_max_backoff)
+            self.spool.start()
+
+    def _write_now(self, documents: List[Dict[str, Any]], register: Optional[str] = None) -> None:
+        """Upserts documents and then, optionally, tells the gateway that the files of an instance changed
+
+        Arguments:
+            documents: The documents to upsert
+            register: The instance URI to register with the local gateway, or None
+        """
+        if documents:
+            self._db._upsert_documents(documents)
+
+        if register:
+            own_gateway_url = self._db._override_local_gateway_url or self._db._own_gateway_url
+            if own_gateway_url:
+                self._db.register_experiment_with_gateway(own_gateway_url, register)
+
+    def _write(self, documents: List[Dict[str, Any]], register: Optional[str] = None) -> None:
+        """Like _write_now() but spools the write if the database is unavailable and there is a spool"""
+        spool = getattr(self, 'spool', None)
+        if spool is not None:
+            spool.submit(documents, register)
+        else:
+            self._write_now(documents, register)
+
+    @classmethod
+    def _digest(cls, doc: Dict[str, Any]) -> str:
+        return hashlib.sha1(json.dumps(doc, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _modified_documents(
+            self,
+            instance_uri: str,
+            documents: List[Dict[str, Any]]
+        ) -> Tuple[List[Dict[str, Any]], Dict[Tuple[Any, ...], str]]:
+        """Returns the @documents which differ from the ones that this reporter last wrote for @instance_uri and
+        the {key: digest} of the keyed ones to pass to _remember_written() after writing them"""
+        with self._written_lock:
+            written = self._written.get(instance_uri, {})
+
+        modified = []
+        digests = {}
+        for doc in documents:
+            key = DocumentBatch.key_of(doc)
+            if key is None:
+                modified.append(doc)
+                continue
+            digest = self._digest(doc)
+            if written.get(key) != digest:
+                modified.append(doc)
+                digests[key] = digest
+
+        return modified, digests
+
+    def _remember_written(self, instance_uri: str, digests: Dict[Tuple[Any, ...], str]):
+        with self._written_lock:
+            written = self._written.pop(instance_uri, {})
+            written.update(digests)
+            self._written[instance_uri] = written
+            while len(self._written) > self.max_remembered_instances:
+                self._written.popitem(last=False)
+
     def add_experiment(self, location, platform):
         self.log.info("Adding experiment at %s" % location)
 
-        return self._db.addExperimentAtLocation(
-            location, platform, self._own_gateway_id, attempt_shadowdir_repair=False)
+        # VV: This is what addExperimentAtLocation() of experiment.service.db.Mongo does
+        expDir = experiment.model.storage.ExperimentInstanceDirectory(location, attempt_shadowdir_repair=False)
+        exp = experiment.model.data.Experiment(expDir, platform=platform, updateInstanceConfiguration=False,
+                                               is_instance=True)
+        instance = exp.generate_instance_location(self._own_gateway_id)
+        self._write(exp.generate_document_description(self._own_gateway_id), register=instance)
+        return True
 
-    def update_experiment_document(self, comp_exp: experiment.model.data.Experiment):
-        """Updates the experiment Document description for an Experiment instance
+    def experiment_document(self, comp_exp: experiment.model.data.Experiment) -> Dict[str, Any]:
+        """Generates the experiment Document description of an Experiment instance
+
+        Waits up to 15 seconds for the output/output.json file of the instance to appear.
 
         Args:
             comp_exp: experiment instance
         """
-        self.log.info("Upserting experiment document for %s" % comp_exp.instanceDirectory.location)
-
         output_file = os.path.join(comp_exp.instanceDirectory.outputDir, 'output.json')
 
         wait_till = time.time() + 15
@@ -123,20 +280,35 @@ class Reporter(object):
             self.log.warning(f"Output file {output_file} does not exist")
             time.sleep(1.0)
 
-        doc = comp_exp.generate_experiment_document_description(self._own_gateway_id)
-        self._db._upsert_documents([doc])
+        return comp_exp.generate_experiment_document_description(self._own_gateway_id)
 
-    def upsert_documents(self, exp: experiment.model.data.Experiment, documents: List[Dict[str, Any]]) -> None:
-        """Annotates documents with instance URI and usperts them
+    def update_experiment_document(self, comp_exp: experiment.model.data.Experiment):
+        """Updates the experiment Document description for an Experiment instance
+
+        Args:
+            comp_exp: experiment instance
+        """
+        self.log.info("Upserting experiment document for %s" % comp_exp.instanceDirectory.location)
+
+        doc = self.experiment_document(comp_exp)
+        self._write([doc])
+
+    def annotate_documents(
+            self,
+            exp: experiment.model.data.Experiment,
+            documents: List[Dict[str, Any]]
+        ) -> List[str]:
+        """Annotates documents with the instance URI (in place)
 
         Arguments:
             exp: Experiment instance
-            documents: List of documents to annotate and then upsert
+            documents: List of documents to annotate
+
+        Returns:
+            A description of each document (e.g. "stage0.hello", "experiment", "user-metadata", "unknown")
         """
         instance_uri = exp.generate_instance_location(self._own_gateway_id)
 
-        self.log.info(f"Upserting {len(documents)} documents for {instance_uri}")
-
         what_updated = []
 
         for doc in documents:
@@ -155,9 +327,77 @@ class Reporter(object):
             else:
                 what_updated.append('unknown')
 
+        return what_updated
+
+    def upsert_documents(self, exp: experiment.model.data.Experiment, documents: List[Dict[str, Any]]) -> None:
+        """Annotates documents with instance URI and usperts them
+
+        Arguments:
+            exp: Experiment instance
+            documents: List of documents to annotate and then upsert
+        """
+        instance_uri = exp.generate_instance_location(self._own_gateway_id)
+
+        self.log.info(f"Upserting {len(documents)} documents for {instance_uri}")
+
+        what_updated = self.annotate_documents(exp, documents)
+
         self.log.info(f"Updated documents are {what_updated}")
 
-        self._db._upsert_documents(documents)
+        self._write(documents)
+
+    def component_document(
+            self,
+            exp: experiment.model.data.Experiment,
+            stage: int,
+            componentName: str
+        ) -> Dict[str, Any]:
+        """Generates the annotated Document description of a component, just like add_data() does"""
+        component = exp.findJob(stage, componentName)
+
+        if component is None:
+            raise ValueError("Could not find component %s in stage %d of experiment at %s" % (
+                componentName, stage, exp.instanceDirectory.location))
+
+        return exp.annotate_component_documents(self._own_gateway_id, [component.documentDescription])[0]
+
+    def upsert_batch(self, exp: experiment.model.data.Experiment, batch: DocumentBatch) -> None:
+        """Generates the documents of a DocumentBatch and upserts them with a single request
+
+        Arguments:
+            exp: Experiment instance that all updates in @batch are for
+            batch: The coalesced updates
+        """
+        documents = []
+        explicit = []
+        components = []
+
+        for kind, payload in batch.entries():
+            if kind == DocumentBatch.Document:
+                explicit.append(payload)
+                documents.append(payload)
+            elif kind == DocumentBatch.Component:
+                components.append(self.component_document(exp, *payload))
+                documents.append(components[-1])
+            elif kind == DocumentBatch.Experiment:
+                documents.append(self.experiment_document(exp))
+
+        what_updated = self.annotate_documents(exp, explicit)
+
+        instance_uri = exp.generate_instance_location(self._own_gateway_id)
+        modified, digests = self._modified_documents(instance_uri, documents)
+
+        self.log.info(f"Upserting {len(modified)} documents for {exp.instanceDirectory.location} in 1 batch "
+                      f"(dropped {batch.superseded} superseded updates and {len(documents) - len(modified)} "
+                      f"unchanged documents), explicit documents are {what_updated}")
+
+        # VV: add_data() tells the gateway that the files of the experiment changed when it modifies the database,
+        # do the same but only if the documents of the finished components actually changed
+        component_ids = set(id(doc) for doc in components)
+        register = instance_uri if any(id(doc) in component_ids for doc in modified) else None
+        if modified:
+            self._write(modified, register)
+            self._remember_written(instance_uri, digests)
 
     def add_data(
             self,
@@ -168,5 +408,18 @@ class Reporter(object):
         self.log.info("Adding %s:%s:%s:%s" % (
             self._own_gateway_id, exp.instanceDirectory.location, stage, componentName))
 
-        return self._db.addData(exp, stage, componentName, update=update,
-                                gateway_id=self._own_gateway_id)
\ No newline at end of file
+        if update is False:
+            return self._db.addData(exp, stage, componentName, update=update,
+                                    gateway_id=self._own_gateway_id)
+
+        # VV: With update=True addData() of experiment.service.db.Mongo upserts the component document and then
+        # registers the instance with the gateway. Skip both if the document is the same as the last one we wrote
+        instance_uri = exp.generate_instance_location(self._own_gateway_id)
+        modified, digests = self._modified_documents(instance_uri, [self.component_document(exp, stage, componentName)])
+        if not modified:
+            self.log.info("The document of %s:%s is unchanged" % (stage, componentName))
+            return False
+
+        self._write(modified, register=instance_uri)
+        self._remember_written(instance_uri, digests)
+        return True
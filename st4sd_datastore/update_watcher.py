@@ -0,0 +1,230 @@
+# Copyright IBM Inc. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+# Author: Vassilis Vassiliadis
+
+"""Wakes up the reporter as soon as new update (trigger) files appear in the directory it monitors"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import re
+import select
+import struct
+import time
+
+from typing import Optional, Tuple
+
+# VV: How to detect new trigger files:
+#   auto: inotify if the kernel supports it, polling otherwise
+#   inotify: inotify, raise an exception if it is not available
+#   poll: check the modification time of the directory every poll_interval seconds
+WATCH_AUTO = 'auto'
+WATCH_INOTIFY = 'inotify'
+WATCH_POLL = 'poll'
+WATCH_MODES = [WATCH_AUTO, WATCH_INOTIFY, WATCH_POLL]
+
+# VV: From <sys/inotify.h>
+IN_MOVED_TO = 0x00000080
+IN_CLOSE_WRITE = 0x00000008
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+_pattern_trigger = re.compile(r'.+-([0-9]+|begin)\.json$')
+
+
+def is_trigger_file(name):
+    # type: (str) -> bool
+    """Returns True if @name looks like the name of an update file i.e. ${anything}-${number or "begin"}.json"""
+    return _pattern_trigger.match(name) is not None
+
+
+class _Inotify(object):
+    """A minimal wrapper of the inotify API of libc"""
+    def __init__(self, path, mask):
+        # type: (str, int) -> None
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        inotify_init1 = getattr(libc, 'inotify_init1', None)
+        if inotify_init1 is None:
+            raise OSError(errno.ENOSYS, "libc does not support inotify")
+
+        self.fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_init1(): %s" % os.strerror(err))
+
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask)) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch(%s): %s" % (path, os.strerror(err)))
+
+    def fileno(self):
+        # type: () -> int
+        return self.fd
+
+    def drain(self):
+        # type: () -> Tuple[bool, bool]
+        """Reads all queued events, returns (saw a trigger file, the event queue overflowed)"""
+        triggered = overflowed = False
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(buf):
+                _, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    overflowed = True
+                elif is_trigger_file(os.fsdecode(name)):
+                    triggered = True
+
+        return triggered, overflowed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class UpdateWatcher(object):
+    """Blocks till new trigger files appear in a directory
+
+    With inotify, wait() returns as soon as a trigger file is closed after writing or is moved into the directory.
+    Kernel events do not cover files that other nodes write on shared filesystems (e.g. GPFS, NFS) so the
+    modification time of the directory is also checked every @poll_interval seconds - that is the only
+    mechanism in "poll" mode.
+
+    Files tend to arrive in bursts (e.g. many components finishing together), after the first event wait() keeps
+    collecting events till there are none for @debounce seconds, but for no longer than @max_delay seconds.
+
+    Arguments:
+        path: The directory to watch
+        mode: One of WATCH_MODES
+        poll_interval: Seconds between checks of the modification time of the directory
+        rescan_interval: wait() returns False after this many seconds without events so that the caller rescans the
+            directory anyway, None to wait forever
+        debounce: Seconds without new events after which a burst is considered over
+        max_delay: Maximum seconds to spend collecting a burst of events
+    """
+    def __init__(self, path, mode=WATCH_AUTO, poll_interval=1.0, rescan_interval=60.0, debounce=0.1, max_delay=1.0):
+        # type: (str, str, float, Optional[float], float, float) -> None
+        if mode not in WATCH_MODES:
+            raise ValueError("Unknown watch mode \"%s\", expected one of %s" % (mode, WATCH_MODES))
+
+        self.path = path
+        self.poll_interval = max(0.01, poll_interval)
+        self.rescan_interval = rescan_interval
+        self.debounce = max(0.0, debounce)
+        self.max_delay = max(self.debounce, max_delay)
+        self.log = logging.getLogger('UpdateWatcher')
+
+        self._inotify = None  # type: Optional[_Inotify]
+        # VV: wake() writes to this pipe to interrupt wait() from other threads
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+
+        if mode != WATCH_POLL:
+            try:
+                self._inotify = _Inotify(path, IN_CLOSE_WRITE | IN_MOVED_TO)
+            except (OSError, AttributeError) as e:
+                if mode == WATCH_INOTIFY:
+                    raise
+                self.log.warning("Cannot use inotify to watch %s (%s) - will poll every %s seconds" % (
+                    path, e, self.poll_interval))
+
+        self.mode = WATCH_INOTIFY if self._inotify is not None else WATCH_POLL
+        self._signature = self._dir_signature()
+
+    def _dir_signature(self):
+        # type: () -> Optional[Tuple[int, int, int]]
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_ino, st.st_size
+
+    def _changed(self, timeout):
+        # type: (float) -> bool
+        """Waits up to @timeout seconds for an event or a change to the directory, returns True if there was one"""
+        fds = [self._wake_r]
+        if self._inotify is not None:
+            fds.append(self._inotify.fileno())
+
+        readable, _, _ = select.select(fds, [], [], timeout)
+
+        triggered = False
+        if self._wake_r in readable:
+            try:
+                while os.read(self._wake_r, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            triggered = True
+
+        if self._inotify is not None and self._inotify.fileno() in readable:
+            events, overflowed = self._inotify.drain()
+            if overflowed:
+                self.log.warning("Lost inotify events for %s" % self.path)
+            triggered = triggered or events or overflowed
+
+        signature = self._dir_signature()
+        if signature != self._signature:
+            self._signature = signature
+            return True
+        return triggered
+
+    def wait(self):
+        # type: () -> bool
+        """Returns True after a burst of trigger files (or a call to wake()), False if @rescan_interval seconds
+        passed without one"""
+        started = time.monotonic()
+
+        while True:
+            waited = time.monotonic() - started
+            if self.rescan_interval is not None and waited >= self.rescan_interval:
+                self._signature = self._dir_signature()
+                return False
+
+            timeout = self.poll_interval
+            if self.rescan_interval is not None:
+                timeout = min(timeout, self.rescan_interval - waited)
+
+            if self._changed(timeout):
+                break
+
+        # VV: Debounce - keep collecting events till the burst is over
+        burst_started = time.monotonic()
+        while self.debounce > 0:
+            remaining = self.max_delay - (time.monotonic() - burst_started)
+            if remaining <= 0 or self._changed(min(self.debounce, remaining)) is False:
+                break
+
+        return True
+
+    def wake(self):
+        """Makes wait() return True as if a new trigger file appeared, can be called from any thread"""
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            # VV: The pipe is full so wait() is going to wake up anyway
+            pass
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        if self._wake_r is not None:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = None